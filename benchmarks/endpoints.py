@@ -0,0 +1,337 @@
+"""
+Throughput, latency, SQL statements and memory of every API resource against
+seeded databases of different sizes, with a JSON baseline to catch
+regressions.
+
+For every database size the app is created with create_app against a file
+database filled by seed-db. Every case then runs --requests requests through
+the test client and records the throughput, the p50 and p99 latency and the
+SQL statements per request. A separate pass under tracemalloc records the
+peak memory of a request. Read cases run before the write cases, which work
+on rows they create themselves.
+
+Usage:
+    python benchmarks/endpoints.py [--sizes 1000 10000 100000] [--requests 200]
+        [--output baseline.json] [--compare baseline.json] [--threshold 10]
+        [--db-dir DIR]
+
+With --compare, the results are checked against a baseline written earlier
+with --output. A metric that is worse than the baseline by more than
+--threshold percent is reported as a regression and the script exits with 1.
+Seeding 100k recipes takes a minute or two; --db-dir keeps the seeded
+databases between runs.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import event
+
+from climatecook import create_app, db
+from climatecook.models import FoodItem, FoodItemEquivalent, Ingredient, Recipe
+from climatecook.seed import seed_db
+
+NDJSON = "application/x-ndjson"
+
+# metric: True if a higher value is better
+METRICS = {
+    "throughput": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "sql_per_request": False,
+    "peak_kib": False,
+}
+
+
+class Context(object):
+    """
+    Ids of the seeded and created rows that the cases pick from.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.recipe_ids = []
+        self.ingredients = []
+        self.food_item_ids = []
+        self.equivalents = []
+        self.words = []
+        self.created_recipe_ids = []
+        self.counter = 0
+
+    def load(self, sample=5000):
+        self.recipe_ids = [id for (id,) in db.session.query(Recipe.id).limit(sample * 10)]
+        self.ingredients = db.session.query(Ingredient.recipe_id, Ingredient.id).limit(sample).all()
+        self.food_item_ids = [id for (id,) in db.session.query(FoodItem.id).limit(sample)]
+        self.equivalents = db.session.query(FoodItemEquivalent.food_item_id, FoodItemEquivalent.id) \
+            .limit(sample).all()
+        self.words = sorted({word for (name,) in db.session.query(FoodItem.name).limit(sample)
+            for word in name.split() if not word.isdigit()})
+
+    def next(self):
+        self.counter += 1
+        return self.counter
+
+
+def _get(url):
+    return lambda ctx: ("GET", url(ctx) if callable(url) else url, {})
+
+
+def _recipe_item(ctx):
+    return "/api/recipes/{0}/".format(ctx.rng.choice(ctx.recipe_ids))
+
+
+def _ingredient_item(ctx):
+    return "/api/recipes/{0}/ingredients/{1}/".format(*ctx.rng.choice(ctx.ingredients))
+
+
+def _food_item(ctx):
+    return "/api/food-items/{0}/".format(ctx.rng.choice(ctx.food_item_ids))
+
+
+def _food_item_equivalent(ctx):
+    return "/api/food-items/{0}/equivalents/{1}/".format(*ctx.rng.choice(ctx.equivalents))
+
+
+def _recipe_post(ctx):
+    return "POST", "/api/recipes/", {"json": {"name": "benchmark recipe {0}".format(ctx.next())}}
+
+
+def _recipe_put(ctx):
+    recipe_id = ctx.rng.choice(ctx.created_recipe_ids)
+    return "PUT", "/api/recipes/{0}/".format(recipe_id), {
+        "json": {"id": recipe_id, "name": "benchmark recipe {0}".format(ctx.next())}}
+
+
+def _ingredient_post(ctx):
+    food_item_id, equivalent_id = ctx.rng.choice(ctx.equivalents)
+    return "POST", "/api/recipes/{0}/".format(ctx.rng.choice(ctx.created_recipe_ids)), {"json": {
+        "food_item_id": food_item_id,
+        "food_item_equivalent_id": equivalent_id,
+        "quantity": round(ctx.rng.uniform(0.1, 2.0), 2),
+    }}
+
+
+def _food_item_put(ctx):
+    food_item_id = ctx.rng.choice(ctx.food_item_ids)
+    return "PUT", "/api/food-items/{0}/".format(food_item_id), {"json": {
+        "id": food_item_id,
+        "name": "benchmark food item {0}".format(ctx.next()),
+        "emission_per_kg": round(ctx.rng.uniform(0.1, 20.0), 2),
+    }}
+
+
+def _bulk_import(ctx):
+    lines = []
+    for _ in range(100):
+        lines.append(json.dumps({
+            "name": "benchmark import {0}".format(ctx.next()),
+            "emission_per_kg": 1.5,
+            "equivalents": [{"unit_type": "kilogram", "conversion_factor": 1}],
+        }))
+    return "POST", "/api/food-items/bulk", {"data": "\n".join(lines), "content_type": NDJSON}
+
+
+def _recipe_delete(ctx):
+    return "DELETE", "/api/recipes/{0}/".format(ctx.created_recipe_ids.pop()), {}
+
+
+# name, request factory, share of --requests to run
+CASES = [
+    ("recipes_collection", _get("/api/recipes/"), 1),
+    ("recipes_collection_compact", _get("/api/recipes/?compact=1&limit=1000"), 0.25),
+    ("recipes_export", _get("/api/recipes/export"), 0.02),
+    ("recipes_ranking", _get("/api/recipes/ranking?k=50"), 1),
+    ("recipes_ranking_vegan", _get("/api/recipes/ranking?vegan=1&order=desc"), 1),
+    ("recipe_item", _get(_recipe_item), 1),
+    ("ingredient_item", _get(_ingredient_item), 1),
+    ("ingredient_substitutes", _get(lambda ctx: _ingredient_item(ctx) + "substitutes?vegan=1"), 1),
+    ("emissions_report", _get("/api/reports/emissions"), 0.25),
+    ("food_items_collection", _get("/api/food-items/"), 1),
+    ("food_items_search", _get(lambda ctx: "/api/food-items/?q=" + ctx.rng.choice(ctx.words)), 1),
+    ("food_items_prefix", _get(lambda ctx: "/api/food-items/?name=" + ctx.rng.choice(ctx.words)[:3]), 1),
+    ("food_items_suggest", _get(lambda ctx: "/api/food-items/suggest?prefix=" + ctx.rng.choice(ctx.words)[:2]), 1),
+    ("food_item", _get(_food_item), 1),
+    ("food_item_equivalent", _get(_food_item_equivalent), 1),
+    ("recipe_post", _recipe_post, 1),
+    ("recipe_put", _recipe_put, 1),
+    ("ingredient_post", _ingredient_post, 1),
+    ("food_item_put", _food_item_put, 0.25),
+    ("food_items_bulk_import", _bulk_import, 0.1),
+    ("recipe_delete", _recipe_delete, 0.5),
+]
+
+
+def _percentile(sorted_values, percent):
+    index = min(int(round(percent / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _send(client, ctx, factory):
+    method, url, kwargs = factory(ctx)
+    # Not buffered, so that a streamed body is not held in memory by the client
+    resp = client.open(url, method=method, buffered=False, **kwargs)
+    if resp.status_code >= 400:
+        raise RuntimeError("{0} {1} gave {2}: {3}".format(method, url, resp.status_code, resp.get_data()[:200]))
+    for _ in resp.iter_encoded():
+        pass
+    resp.close()
+    if method == "POST" and url == "/api/recipes/":
+        ctx.created_recipe_ids.append(int(resp.headers["Location"].rstrip("/").rsplit("/", 1)[1]))
+    return resp
+
+
+def run_case(client, ctx, factory, requests, statements):
+    _send(client, ctx, factory)
+    latencies = []
+    sql = 0
+    start = time.perf_counter()
+    for _ in range(requests):
+        statements[0] = 0
+        request_start = time.perf_counter()
+        _send(client, ctx, factory)
+        latencies.append(time.perf_counter() - request_start)
+        sql += statements[0]
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    tracemalloc.start()
+    for _ in range(3):
+        _send(client, ctx, factory)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "requests": requests,
+        "throughput": round(requests / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "sql_per_request": round(sql / float(requests), 2),
+        "peak_kib": round(peak / 1024.0, 1),
+    }
+
+
+def _seeded_database(size, args, directory):
+    path = os.path.join(directory, "benchmark-{0}-{1}-{2}.db".format(size, args.max_ingredients, args.seed))
+    if os.path.exists(path):
+        return path
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path + ".tmp"})
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        counts = seed_db(food_items=max(size // 10, 500), recipes=size, max_ingredients=args.max_ingredients,
+            seed=args.seed)
+        print("seeded {0} food items, {1} equivalents, {2} recipes, {3} ingredients in {4:.1f} s".format(
+            *(counts + (time.perf_counter() - start,))), file=sys.stderr)
+        db.session.remove()
+        db.engine.dispose()
+    os.rename(path + ".tmp", path)
+    return path
+
+
+def run_size(size, args, directory):
+    seeded = _seeded_database(size, args, directory)
+    # The write cases change the database, so they run against a copy
+    path = os.path.join(directory, "run-{0}.db".format(size))
+    shutil.copyfile(seeded, path)
+    try:
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path})
+        statements = [0]
+        with app.app_context():
+            @event.listens_for(db.engine, "before_cursor_execute")
+            def count_statement(*args):
+                statements[0] += 1
+
+            ctx = Context(random.Random(args.seed))
+            ctx.load()
+        client = app.test_client()
+        results = {}
+        for name, factory, share in CASES:
+            requests = max(3, int(args.requests * share))
+            results[name] = run_case(client, ctx, factory, requests, statements)
+            print("{0:>7} {1:<28}{2:>10.1f}/s {3:>9.3f} ms {4:>9.3f} ms {5:>7.1f} sql {6:>10.1f} KiB".format(
+                size, name, *(results[name][metric] for metric in METRICS)), file=sys.stderr)
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        return results
+    finally:
+        os.unlink(path)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results to a baseline.
+
+    : return: list of (size, case, metric, baseline value, value, change %)
+        for the metrics that got worse by more than threshold percent
+    """
+    regressions = []
+    for size, cases in results.items():
+        for case, metrics in cases.items():
+            old = baseline.get(size, {}).get(case)
+            if old is None:
+                continue
+            for metric, higher_is_better in METRICS.items():
+                before, after = old.get(metric), metrics[metric]
+                if not before:
+                    continue
+                change = (after - before) / float(before) * 100
+                if (-change if higher_is_better else change) > threshold:
+                    regressions.append((size, case, metric, before, after, round(change, 1)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--max-ingredients", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results to")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    parser.add_argument("--db-dir", help="keep the seeded databases in this directory")
+    args = parser.parse_args()
+
+    directory = args.db_dir or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok=True)
+    try:
+        results = {str(size): run_size(size, args, directory) for size in args.sizes}
+    finally:
+        if not args.db_dir:
+            shutil.rmtree(directory)
+
+    document = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "max_ingredients": args.max_ingredients,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for size, case, metric, before, after, change in regressions:
+            print("REGRESSION {0} {1} {2}: {3} -> {4} ({5:+.1f}%)".format(size, case, metric, before, after, change))
+        if regressions:
+            sys.exit(1)
+        print("No regressions above {0}%".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
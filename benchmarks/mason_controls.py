@@ -0,0 +1,106 @@
+"""
+Cost of the static parts of the Mason documents: the JSON schemas, and the
+namespace and control blocks that are the same in every response.
+
+Reports the time per schema call, the time and the retained memory per
+collection document header (namespace, self and add/search/suggest
+controls), and the time per GET of the collections and of a food item.
+
+Usage:
+    python benchmarks/mason_controls.py [--rounds 10000]
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from climatecook import create_app, db
+from climatecook.api import api
+from climatecook.models import FoodItem, FoodItemEquivalent, Recipe
+from climatecook.resources.food_items import FoodItemBuilder, FoodItemCollection
+from climatecook.resources.recipes import IngredientBuilder, RecipeBuilder, RecipeCollection
+
+
+def _populate():
+    for i in range(1, 101):
+        db.session.add(FoodItem(id=i, name="food-item-{}".format(i), emission_per_kg=1.0))
+        db.session.add(FoodItemEquivalent(id=i, food_item_id=i, unit_type="kilogram", conversion_factor=1.0))
+        db.session.add(Recipe(id=i, name="recipe-{}".format(i)))
+    db.session.commit()
+
+
+def _headers():
+    food_items = FoodItemBuilder()
+    food_items.add_namespace("clicook", "/api/link-relations/")
+    food_items.add_control("self", api.url_for(FoodItemCollection))
+    food_items.add_control_add_food_item()
+    food_items.add_control_search_food_items()
+    food_items.add_control_suggest_food_items()
+    recipes = RecipeBuilder()
+    recipes.add_namespace("clicook", "/api/link-relations/")
+    recipes.add_control("self", api.url_for(RecipeCollection))
+    recipes.add_control_add_recipe()
+    return food_items, recipes
+
+
+def bench_schemas(rounds):
+    schemas = [
+        FoodItemBuilder.food_item_schema,
+        FoodItemBuilder.food_item_equivalent_schema,
+        RecipeBuilder.recipe_schema,
+        IngredientBuilder.ingredient_schema,
+    ]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for schema in schemas:
+            schema()
+    return (time.perf_counter() - start) / (rounds * len(schemas)) * 1e6
+
+
+def bench_headers(rounds):
+    _headers()
+    tracemalloc.start()
+    start = time.perf_counter()
+    documents = [_headers() for _ in range(rounds)]
+    elapsed = time.perf_counter() - start
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del documents
+    return elapsed / rounds * 1e6, retained / rounds
+
+
+def bench_requests(client, url, rounds):
+    client.get(url)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        client.get(url)
+    return (time.perf_counter() - start) / rounds * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=10000)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "RECIPE_CACHE_MAX_SIZE": 0})
+    try:
+        with app.app_context():
+            db.create_all()
+            _populate()
+        with app.test_request_context():
+            print("schema call:          {:8.2f} us".format(bench_schemas(args.rounds)))
+            per_header, retained = bench_headers(args.rounds)
+            print("collection headers:   {:8.2f} us {:8.0f} bytes".format(per_header, retained))
+        client = app.test_client()
+        request_rounds = max(args.rounds // 20, 1)
+        for url in ("/api/food-items/", "/api/recipes/", "/api/food-items/1/"):
+            print("GET {:<18}{:8.3f} ms".format(url, bench_requests(client, url, request_rounds)))
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Mixed read/write throughput of the API with the default and the production
+SQLite engine profile.
+
+Reader threads fetch recipe and food item documents while writer threads add
+ingredients to recipes. Every request goes through the Flask test client
+against a file database, so the numbers include the full request handling.
+
+Usage:
+    python benchmarks/sqlite_profile.py [--seconds 5] [--readers 8] [--writers 2]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from climatecook import create_app, db
+from climatecook.models import FoodItem, FoodItemEquivalent, Recipe
+
+RECIPES = 200
+FOOD_ITEMS = 200
+
+
+def _populate():
+    for i in range(1, FOOD_ITEMS + 1):
+        db.session.add(FoodItem(id=i, name="food-item-{}".format(i), emission_per_kg=float(i % 17 + 1)))
+        db.session.add(FoodItemEquivalent(id=i, food_item_id=i, unit_type="kilogram", conversion_factor=1.0))
+    for i in range(1, RECIPES + 1):
+        db.session.add(Recipe(id=i, name="recipe-{}".format(i)))
+    db.session.commit()
+
+
+def _reader(client, stop, counts, seed):
+    rnd = random.Random(seed)
+    while not stop.is_set():
+        if rnd.random() < 0.5:
+            resp = client.get("/api/recipes/{}/".format(rnd.randint(1, RECIPES)))
+        else:
+            resp = client.get("/api/food-items/{}/".format(rnd.randint(1, FOOD_ITEMS)))
+        counts["reads" if resp.status_code == 200 else "errors"] += 1
+
+
+def _writer(client, stop, counts, seed):
+    rnd = random.Random(seed)
+    while not stop.is_set():
+        food_item_id = rnd.randint(1, FOOD_ITEMS)
+        try:
+            resp = client.post("/api/recipes/{}/".format(rnd.randint(1, RECIPES)), json={
+                "food_item_id": food_item_id,
+                "food_item_equivalent_id": food_item_id,
+                "quantity": rnd.uniform(0.1, 2.0)
+            })
+            counts["writes" if resp.status_code == 201 else "errors"] += 1
+        except Exception:
+            # e.g. "database is locked" raised through the test client
+            counts["errors"] += 1
+
+
+def run(profile, seconds, readers, writers):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DATABASE_PROFILE": profile,
+    })
+    with app.app_context():
+        db.create_all()
+        _populate()
+        db.session.remove()
+
+    stop = threading.Event()
+    counts = []
+    threads = []
+    for i in range(readers + writers):
+        worker = _reader if i < readers else _writer
+        thread_counts = {"reads": 0, "writes": 0, "errors": 0}
+        counts.append(thread_counts)
+        threads.append(threading.Thread(target=worker, args=(app.test_client(), stop, thread_counts, i)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+    return {key: sum(c[key] for c in counts) / elapsed for key in ("reads", "writes", "errors")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    args = parser.parse_args()
+
+    print("{:<12}{:>12}{:>12}{:>12}".format("profile", "reads/s", "writes/s", "errors/s"))
+    for profile in ("default", "production"):
+        result = run(profile, args.seconds, args.readers, args.writers)
+        print("{:<12}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+            profile, result["reads"], result["writes"], result["errors"]))
+
+
+if __name__ == "__main__":
+    main()
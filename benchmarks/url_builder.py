@@ -0,0 +1,53 @@
+"""
+Time to build the item URLs of 100k rows with api.url_for and with the
+compiled UrlBuilder, for each item resource. Also checks that both give the
+same URLs.
+
+Usage:
+    python benchmarks/url_builder.py [--items 100000]
+"""
+import argparse
+import time
+
+from climatecook import create_app
+from climatecook.api import api
+from climatecook.resources.food_items import FoodItemEquivalentResource, FoodItemResource
+from climatecook.resources.recipes import IngredientItem, RecipeItem
+from climatecook.resources.urls import url_for
+
+CASES = [
+    ("RecipeItem", RecipeItem, lambda i: {"recipe_id": i}),
+    ("IngredientItem", IngredientItem, lambda i: {"recipe_id": i // 10, "ingredient_id": i}),
+    ("FoodItemResource", FoodItemResource, lambda i: {"food_item_id": i}),
+    ("FoodItemEquivalentResource", FoodItemEquivalentResource,
+        lambda i: {"food_item_id": i // 4, "food_item_equivalent_id": i}),
+]
+
+
+def _time(build, resource, values):
+    start = time.perf_counter()
+    urls = [build(resource, **v) for v in values]
+    return time.perf_counter() - start, urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=100000)
+    args = parser.parse_args()
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    print("{:<28}{:>14}{:>14}{:>10}".format("resource", "api.url_for", "UrlBuilder", "speedup"))
+    with app.test_request_context():
+        for name, resource, make_values in CASES:
+            values = [make_values(i) for i in range(1, args.items + 1)]
+            url_for(resource, **values[0])
+            reference_time, reference = _time(api.url_for, resource, values)
+            compiled_time, compiled = _time(url_for, resource, values)
+            if compiled != reference:
+                raise AssertionError("UrlBuilder output differs from api.url_for for {0}".format(name))
+            print("{:<28}{:>12.3f} s{:>12.3f} s{:>9.1f}x".format(
+                name, reference_time, compiled_time, reference_time / compiled_time))
+
+
+if __name__ == "__main__":
+    main()
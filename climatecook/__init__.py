@@ -12,7 +12,14 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        DATABASE_PROFILE="default",
+        RECIPE_CACHE_MAX_SIZE=16 * 1024 * 1024,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_LEVEL=6,
+        INSTRUMENT_REQUESTS=True,
+        METRICS_DIR=None,
+        QUERY_BUDGET_MODE=None
     )
 
     if test_config is None:
@@ -25,10 +32,25 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from climatecook import db_profile
+    db_profile.configure_engine_options(app)
     db.init_app(app)
+    db_profile.register_pragmas(app)
+
+    from climatecook import instrumentation, query_budget
+    instrumentation.init_app(app)
+    query_budget.init_app(app)
 
     from climatecook import models
     app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.seed_db_command)
+    app.cli.add_command(models.migrate_db_command)
+    app.cli.add_command(models.recompute_emissions_command)
+
+    from climatecook import compression, metrics, static_assets
+    metrics.init_app(app)
+    compression.init_app(app)
+    app.cli.add_command(static_assets.build_static_command)
 
     from climatecook import api
     app.register_blueprint(api.api_bp)
@@ -0,0 +1,150 @@
+import itertools
+import threading
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+
+from climatecook import db
+from climatecook.models import COLLECTION_VERSION_TABLES, CollectionVersion, FoodItem, FoodItemEquivalent, Ingredient
+
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+HISTOGRAM_BINS = 20
+
+# Tables whose writes change the report
+TABLES = tuple(model.__tablename__ for model in COLLECTION_VERSION_TABLES)
+
+# Columns of the array returned by load_columns
+RECIPE_ID, FOOD_ITEM_ID, QUANTITY, CONVERSION_FACTOR, EMISSION_PER_KG, VEGAN = range(6)
+
+
+def get_version():
+    """
+    Version stamp of the report: the collection versions of the TABLES,
+    which triggers bump on every write.
+
+    : return: tuple of (stamp, updated_at of the latest write or None)
+    """
+    rows = db.session.query(CollectionVersion.name, CollectionVersion.version, CollectionVersion.updated_at) \
+        .filter(CollectionVersion.name.in_(TABLES)).all()
+    versions = {name: (version, updated_at) for name, version, updated_at in rows}
+    stamp = tuple(versions.get(name, (0, None))[0] for name in TABLES)
+    updated_at = max((updated_at for _, updated_at in versions.values()), default=None)
+    return stamp, updated_at
+
+
+def load_columns():
+    """
+    Reads every ingredient joined with its food item and equivalent in one
+    query into a float array with one row per ingredient and the columns
+    RECIPE_ID, FOOD_ITEM_ID, QUANTITY, CONVERSION_FACTOR, EMISSION_PER_KG and
+    VEGAN. The rows are read straight from the DBAPI cursor, which skips
+    building a result row object per ingredient.
+    """
+    query = select([Ingredient.recipe_id, Ingredient.food_item_id, Ingredient.quantity,
+            FoodItemEquivalent.conversion_factor, FoodItem.emission_per_kg, FoodItem.vegan]) \
+        .select_from(Ingredient.__table__
+            .join(FoodItem.__table__, FoodItem.id == Ingredient.food_item_id)
+            .join(FoodItemEquivalent.__table__, FoodItemEquivalent.id == Ingredient.food_item_equivalent_id))
+    result = db.session.execute(query)
+    try:
+        values = np.fromiter(itertools.chain.from_iterable(result.cursor), dtype=np.float64)
+    finally:
+        result.close()
+    return values.reshape(-1, 6)
+
+
+def _summary(values):
+    """
+    Count, mean, standard deviation, extremes, PERCENTILES and a histogram of
+    HISTOGRAM_BINS equal bins of an array of values.
+    """
+    if len(values) == 0:
+        return {"count": 0, "mean": None, "std": None, "min": None, "max": None,
+            "percentiles": {"p{0}".format(p): None for p in PERCENTILES},
+            "histogram": {"edges": [], "counts": []}}
+    counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+    return {
+        "count": int(len(values)),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "percentiles": {"p{0}".format(p): float(value)
+            for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+    }
+
+
+def _mean(values):
+    return {"count": int(len(values)), "mean": float(values.mean()) if len(values) else None}
+
+
+def emissions_report(columns):
+    """
+    Computes the emissions statistics of the catalog from the array of
+    load_columns with vectorized NumPy operations.
+
+    The recipe statistics cover the recipes that have ingredients. A recipe
+    is vegan when all of its food items are. The food item statistics cover
+    the food items used by recipes, and every one of them gets its emissions
+    and its share of the emissions of the whole catalog, largest first.
+    """
+    emissions = columns[:, QUANTITY] * columns[:, CONVERSION_FACTOR] * columns[:, EMISSION_PER_KG]
+    total = float(emissions.sum())
+
+    recipe_ids, recipe_index = np.unique(columns[:, RECIPE_ID], return_inverse=True)
+    recipe_totals = np.bincount(recipe_index, weights=emissions, minlength=len(recipe_ids))
+    non_vegan = np.bincount(recipe_index, weights=1.0 - columns[:, VEGAN], minlength=len(recipe_ids))
+    vegan = non_vegan == 0
+
+    food_item_ids, first, food_item_index = np.unique(columns[:, FOOD_ITEM_ID], return_index=True,
+        return_inverse=True)
+    food_item_totals = np.bincount(food_item_index, weights=emissions, minlength=len(food_item_ids))
+    shares = food_item_totals / total if total else np.zeros(len(food_item_ids))
+    order = np.argsort(-food_item_totals, kind="stable")
+
+    return {
+        "ingredients": int(len(columns)),
+        "emissions_total": total,
+        "recipes": dict(_summary(recipe_totals), vegan=_mean(recipe_totals[vegan]),
+            non_vegan=_mean(recipe_totals[~vegan])),
+        "food_items": dict(_summary(columns[first, EMISSION_PER_KG]), shares=[
+            {"food_item_id": int(food_item_id), "emissions": float(emission), "share": float(share)}
+            for food_item_id, emission, share in zip(
+                food_item_ids[order].tolist(), food_item_totals[order].tolist(), shares[order].tolist())
+        ]),
+    }
+
+
+class ReportCache(object):
+    """
+    Holds the serialized report with the version stamp it was computed at.
+    A lookup with a different stamp is a miss, so the report is recomputed
+    after any write, also when another process made it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry = None
+
+    def get(self, stamp):
+        with self._lock:
+            if self._entry is not None and self._entry[0] == stamp:
+                return self._entry[1]
+            return None
+
+    def put(self, stamp, document):
+        with self._lock:
+            self._entry = (stamp, document)
+
+
+def get_report_cache():
+    """
+    Returns the emissions report cache of the current application, creating
+    it on first use.
+    """
+    cache = current_app.extensions.get("emissions_report")
+    if cache is None:
+        cache = current_app.extensions.setdefault("emissions_report", ReportCache())
+    return cache
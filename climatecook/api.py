@@ -1,39 +1,54 @@
-import json
-
-from flask import Blueprint, redirect, Response
+from flask import Blueprint, current_app, redirect, Response
 from flask_restful import Api
 
+from climatecook import metrics
+from climatecook.instrumentation import dumps
+
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
 
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
 NAMESPACE = "https://climatecook.docs.apiary.io/#reference/link-relations"
 PROFILES = "https://climatecook.docs.apiary.io/#reference/profiles"
 
 # this import must be placed after we create api to avoid issues with
 # circular imports
-from climatecook.resources.recipes import IngredientItem, RecipeCollection, RecipeItem
+from climatecook.resources.recipes import (IngredientItem, IngredientSubstitutes, RecipeCollection, RecipeExport,
+        RecipeItem, RecipeRanking)
 from climatecook.resources.food_items import (FoodItemCollection, FoodItemResource,
-        FoodItemEquivalentResource)
+        FoodItemEquivalentResource, FoodItemSuggestions, FoodItemBulkImport)
 from climatecook.resources.masonbuilder import MasonBuilder
+from climatecook.resources.reports import EmissionsReport
 
 api.add_resource(RecipeCollection, "/recipes/")
+api.add_resource(RecipeExport, "/recipes/export")
+api.add_resource(RecipeRanking, "/recipes/ranking")
 api.add_resource(RecipeItem, "/recipes/<recipe_id>/")
 api.add_resource(IngredientItem, "/recipes/<recipe_id>/ingredients/<ingredient_id>/")
+api.add_resource(IngredientSubstitutes, "/recipes/<recipe_id>/ingredients/<ingredient_id>/substitutes")
 
 api.add_resource(FoodItemCollection, "/food-items/")
+api.add_resource(FoodItemSuggestions, "/food-items/suggest")
+api.add_resource(FoodItemBulkImport, "/food-items/bulk")
 api.add_resource(FoodItemResource, "/food-items/<food_item_id>/")
 api.add_resource(FoodItemEquivalentResource, "/food-items/<food_item_id>/equivalents/<food_item_equivalent_id>/")
 
+api.add_resource(EmissionsReport, "/reports/emissions")
+
 
 @api_bp.route("/")
 def api_entry():
     masonBuilder = MasonBuilder()
     masonBuilder.add_namespace("clicook", "/api/link-relations/")
-    masonBuilder.add_control("clicook:recipes-all", api.url_for(RecipeCollection), title="Recipes")
-    masonBuilder.add_control("clicook:food-items-all", api.url_for(FoodItemCollection), title="Food items")
+    masonBuilder.add_static_control("clicook:recipes-all", lambda: dict(
+        href=api.url_for(RecipeCollection), title="Recipes"))
+    masonBuilder.add_static_control("clicook:food-items-all", lambda: dict(
+        href=api.url_for(FoodItemCollection), title="Food items"))
+    masonBuilder.add_static_control("clicook:emissions-report", lambda: dict(
+        href=api.url_for(EmissionsReport), title="Emissions report"))
     # TODO: ADD MISSING CONTROLS FOR API ENTRY
-    return Response(json.dumps(masonBuilder), 200, mimetype=MASON)
+    return Response(dumps(masonBuilder), 200, mimetype=MASON)
 
 
 @api_bp.route("/link-relations/")
@@ -44,3 +59,8 @@ def redirect_to_apiary_link_rels():
 @api_bp.route("/profiles/")
 def redirect_to_apiary_profiles():
     return redirect(PROFILES)
+
+
+@api_bp.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(current_app), 200, content_type=metrics.CONTENT_TYPE)
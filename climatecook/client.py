@@ -1,7 +1,16 @@
 from flask import Blueprint, render_template, abort
 from jinja2 import TemplateNotFound
 
-client_bp = Blueprint("client", __name__, url_prefix="/client", static_folder="static", template_folder="static/html")
+from climatecook.static_assets import asset_url, send_asset
+
+# The static files are served by the static view below, which adds the
+# precompressed and versioned variants
+client_bp = Blueprint("client", __name__, url_prefix="/client", template_folder="static/html")
+
+
+@client_bp.context_processor
+def inject_asset_url():
+    return {"asset_url": asset_url}
 
 
 @client_bp.route('/')
@@ -10,3 +19,8 @@ def index():
         return render_template('index.html')
     except TemplateNotFound:
         abort(404)
+
+
+@client_bp.route('/static/<path:filename>')
+def static(filename):
+    return send_asset(filename)
@@ -0,0 +1,98 @@
+import gzip
+import zlib
+
+from flask import current_app, request
+
+# Media types that are worth compressing, besides any text/* type. Mason
+# collections compress about 10x.
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/javascript",
+    "application/vnd.mason+json",
+    "application/x-ndjson",
+    "image/svg+xml",
+}
+
+
+def init_app(app):
+    """
+    Registers gzip compression of the responses of the app. Uses the
+    COMPRESS_MIN_SIZE and COMPRESS_LEVEL config values.
+    """
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+    app.after_request(compress_response)
+
+
+def is_compressible(mimetype):
+    return mimetype is not None and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def accepts_gzip():
+    return request.accept_encodings["gzip"] > 0
+
+
+def compress_response(response):
+    """
+    Compresses the body of a response with gzip if the client accepts it and
+    the body is compressible and at least COMPRESS_MIN_SIZE bytes. Streamed
+    responses are always compressed, chunk by chunk as they are sent, since
+    their size is not known up front.
+
+    Files sent with send_file are left alone; the static files have
+    precompressed siblings instead.
+    """
+    if response.status_code == 304:
+        response.vary.add("Accept-Encoding")
+        if accepts_gzip():
+            _weaken_etag(response)
+        return response
+    if (
+        response.status_code < 200
+        or response.status_code == 204
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or "no-transform" in response.headers.get("Cache-Control", "")
+        or not is_compressible(response.mimetype)
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if not accepts_gzip():
+        return response
+
+    level = current_app.config["COMPRESS_LEVEL"]
+    if response.is_streamed:
+        response.response = _compress_stream(response.iter_encoded(), response.response, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        response.set_data(gzip.compress(data, level))
+    response.headers["Content-Encoding"] = "gzip"
+    _weaken_etag(response)
+    return response
+
+
+def _weaken_etag(response):
+    # The gzipped body is not byte for byte the same representation, so a
+    # strong validator must not be shared with the identity encoding.
+    # Conditional requests compare weakly, so both still match the same ETag.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def _compress_stream(chunks, source, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Closes e.g. a stream_with_context generator if the client goes away
+        if hasattr(source, "close"):
+            source.close()
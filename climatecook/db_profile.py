@@ -0,0 +1,78 @@
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from climatecook import db
+
+PROFILES = ("default", "production")
+
+# Applied on every new SQLite connection of the production profile. WAL lets
+# readers run while a write is in progress, and with WAL synchronous=NORMAL
+# is still safe against corruption, only the last commits can be lost on a
+# power failure.
+PRODUCTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# Flask-SQLAlchemy opens a new SQLite connection for every checkout by
+# default, which would re-run the pragmas on every request. Keep a pool of
+# connections instead; they are only used by one thread at a time.
+PRODUCTION_ENGINE_OPTIONS = {
+    "poolclass": QueuePool,
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "connect_args": {"check_same_thread": False, "timeout": 5},
+}
+
+
+def configure_engine_options(app):
+    """
+    Adds the engine options of the configured DATABASE_PROFILE to the
+    SQLALCHEMY_ENGINE_OPTIONS of the app. Options set explicitly in the
+    config take priority. Must be called before db.init_app.
+    """
+    profile = app.config["DATABASE_PROFILE"]
+    if profile not in PROFILES:
+        raise ValueError("Unknown DATABASE_PROFILE {0}".format(profile))
+    if profile != "production" or not _is_sqlite_file(app.config["SQLALCHEMY_DATABASE_URI"]):
+        return
+
+    options = dict(PRODUCTION_ENGINE_OPTIONS)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+def register_pragmas(app):
+    """
+    Registers a connect event on the engine of the app that applies the
+    pragmas of the configured DATABASE_PROFILE, updated with SQLITE_PRAGMAS
+    from the config, to every new connection. Must be called after
+    db.init_app.
+    """
+    if app.config["DATABASE_PROFILE"] != "production":
+        return
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = dict(PRODUCTION_PRAGMAS)
+    pragmas.update(app.config.get("SQLITE_PRAGMAS", {}))
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {0}={1}".format(name, value))
+        cursor.close()
+
+
+def _is_sqlite_file(uri):
+    url = make_url(uri)
+    return url.drivername.startswith("sqlite") and url.database not in (None, "", ":memory:")
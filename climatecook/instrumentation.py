@@ -0,0 +1,141 @@
+import json
+import logging
+import time
+
+from flask import _app_ctx_stack, g, request
+from sqlalchemy import event
+
+from climatecook import db
+
+logger = logging.getLogger("climatecook.requests")
+
+
+class RequestTimings(object):
+    """
+    Time spent by one request in SQL statements, URL building and JSON
+    serialization, in seconds. The rest of the time goes to the views and
+    the document builders.
+    """
+
+    __slots__ = ("start", "sql_count", "sql_time", "url_count", "url_time", "serialize_time")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.url_count = 0
+        self.url_time = 0.0
+        self.serialize_time = 0.0
+
+    def server_timing(self):
+        """
+        Formats the timings measured so far as a Server-Timing header value.
+        """
+        total = time.perf_counter() - self.start
+        return ", ".join((
+            'sql;dur={0:.3f};desc="{1} statements"'.format(self.sql_time * 1000, self.sql_count),
+            'url;dur={0:.3f};desc="{1} urls"'.format(self.url_time * 1000, self.url_count),
+            "serialize;dur={0:.3f}".format(self.serialize_time * 1000),
+            "total;dur={0:.3f}".format(total * 1000),
+        ))
+
+    def fields(self):
+        return {
+            "duration_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "sql_count": self.sql_count,
+            "sql_ms": round(self.sql_time * 1000, 3),
+            "url_count": self.url_count,
+            "url_ms": round(self.url_time * 1000, 3),
+            "serialize_ms": round(self.serialize_time * 1000, 3),
+        }
+
+
+def get_timings():
+    """
+    Returns the RequestTimings of the current request, or None outside of a
+    request or when the instrumentation is disabled.
+    """
+    ctx = _app_ctx_stack.top
+    if ctx is None:
+        return None
+    return getattr(ctx.g, "timings", None)
+
+
+def dumps(obj):
+    """
+    json.dumps that adds its time to the serialization time of the request.
+    """
+    timings = get_timings()
+    if timings is None:
+        return json.dumps(obj)
+    start = time.perf_counter()
+    try:
+        return json.dumps(obj)
+    finally:
+        timings.serialize_time += time.perf_counter() - start
+
+
+def init_app(app):
+    """
+    Registers the request hooks and the SQL events that measure each
+    request, when INSTRUMENT_REQUESTS is set. The timings are sent in a
+    Server-Timing header, and a structured line is logged to the
+    climatecook.requests logger once the response has been sent, so that it
+    also covers the body of streamed responses. Must be called after
+    db.init_app.
+    """
+    if not app.config["INSTRUMENT_REQUESTS"]:
+        return
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        _end_statement(conn)
+
+    @event.listens_for(engine, "handle_error")
+    def fail_statement(exception_context):
+        if exception_context.connection is not None:
+            _end_statement(exception_context.connection)
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def _end_statement(conn):
+    starts = conn.info.get("statement_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    timings = get_timings()
+    if timings is not None:
+        timings.sql_count += 1
+        timings.sql_time += elapsed
+
+
+def start_request():
+    g.timings = RequestTimings()
+
+
+def finish_request(response):
+    timings = g.get("timings")
+    if timings is None:
+        return response
+    response.headers["Server-Timing"] = timings.server_timing()
+    fields = {
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+    }
+
+    def log_request():
+        fields.update(timings.fields())
+        logger.info(json.dumps(fields), extra={"timings": fields})
+
+    response.call_on_close(log_request)
+    return response
@@ -0,0 +1,330 @@
+import bisect
+import functools
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import current_app, request
+
+from climatecook.instrumentation import get_timings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+SQL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# name: (type, help, buckets)
+METRICS = {
+    "climatecook_http_requests_total": (
+        "counter", "Requests by resource, method and status.", None),
+    "climatecook_http_request_duration_seconds": (
+        "histogram", "Time from the start of the request until the body has been sent.", DURATION_BUCKETS),
+    "climatecook_http_response_size_bytes": (
+        "histogram", "Size of the response body as sent, after compression.", SIZE_BUCKETS),
+    "climatecook_http_request_sql_statements": (
+        "histogram", "SQL statements executed per request.", SQL_BUCKETS),
+    "climatecook_cache_requests_total": (
+        "counter", "Cache lookups by cache and result.", None),
+}
+
+CACHES = ("recipe",)
+
+_HEADER = struct.Struct("Q")
+_LENGTH = struct.Struct("I")
+_VALUE = struct.Struct("d")
+
+
+class DictStore(object):
+    """
+    Metric values of a single process, kept in memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def add_many(self, amounts):
+        with self._lock:
+            for key, amount in amounts:
+                self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class MmapStore(object):
+    """
+    Metric values of one process in a memory mapped file, so that the
+    processes of a multi-process server can be aggregated by reading the
+    files of all of them. Only the owning process writes to its file, which
+    needs no locking between processes.
+
+    The file starts with the number of bytes in use, followed by entries of
+    a key length, the UTF-8 key padded to 8 bytes and a double value. A new
+    entry is written completely before the used size is updated, so readers
+    never see a partial entry.
+    """
+
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._positions = {}
+        # The store lives as long as its process, so the descriptor is not closed
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        size = os.fstat(self._fd).st_size
+        if size < self.INITIAL_SIZE:
+            os.ftruncate(self._fd, self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._map = mmap.mmap(self._fd, size)
+        self._used = _HEADER.unpack_from(self._map, 0)[0]
+        if self._used == 0:
+            self._used = _HEADER.size
+            _HEADER.pack_into(self._map, 0, self._used)
+        for key, _, position in _read_entries(self._map, self._used):
+            self._positions[key] = position
+
+    def _add_entry(self, key):
+        encoded = key.encode("utf-8")
+        padded = _LENGTH.size + len(encoded)
+        padded += -padded % 8
+        end = self._used + padded + _VALUE.size
+        if end > len(self._map):
+            size = len(self._map)
+            while size < end:
+                size *= 2
+            self._map.close()
+            os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+        _LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _LENGTH.size:self._used + _LENGTH.size + len(encoded)] = encoded
+        position = self._used + padded
+        _VALUE.pack_into(self._map, position, 0.0)
+        self._used = end
+        _HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def add_many(self, amounts):
+        with self._lock:
+            for key, amount in amounts:
+                position = self._positions.get(key)
+                if position is None:
+                    position = self._add_entry(key)
+                value = _VALUE.unpack_from(self._map, position)[0]
+                _VALUE.pack_into(self._map, position, value + amount)
+
+    def collect(self):
+        with self._lock:
+            return {key: value for key, value, _ in _read_entries(self._map, self._used)}
+
+
+def _read_entries(data, used):
+    position = _HEADER.size
+    while position < used:
+        length = _LENGTH.unpack_from(data, position)[0]
+        start = position + _LENGTH.size
+        key = bytes(data[start:start + length]).decode("utf-8")
+        padded = _LENGTH.size + length
+        position += padded + (-padded % 8)
+        yield key, _VALUE.unpack_from(data, position)[0], position
+        position += _VALUE.size
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        return {}
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    return {key: value for key, value, _ in _read_entries(data, used)}
+
+
+def get_store():
+    """
+    Returns the metric store of the current process. With METRICS_DIR set
+    every process gets its own file in that directory, also after a fork.
+    """
+    stores = current_app.extensions.setdefault("metrics", {})
+    pid = os.getpid()
+    store = stores.get(pid)
+    if store is None:
+        directory = current_app.config["METRICS_DIR"]
+        if directory:
+            store = MmapStore(os.path.join(directory, "metrics-{0}.db".format(pid)))
+        else:
+            store = DictStore()
+        store = stores.setdefault(pid, store)
+    return store
+
+
+def collect():
+    """
+    Returns the metric values summed over all processes.
+    """
+    directory = current_app.config["METRICS_DIR"]
+    if not directory:
+        return get_store().collect()
+    get_store()
+    values = {}
+    for path in glob.glob(os.path.join(directory, "metrics-*.db")):
+        for key, value in _read_file(path).items():
+            values[key] = values.get(key, 0.0) + value
+    return values
+
+
+@functools.lru_cache(maxsize=None)
+def _key(name, labels):
+    """
+    Returns the store key of a sample. The labels are a tuple of (label,
+    value) pairs, and there is a bounded number of them, so the keys are
+    cached.
+    """
+    return json.dumps([name, sorted(labels)])
+
+
+def _observe(amounts, name, value, labels):
+    # Buckets are stored as plain counts and made cumulative when rendered
+    buckets = METRICS[name][2]
+    index = bisect.bisect_left(buckets, value)
+    bound = buckets[index] if index < len(buckets) else "+Inf"
+    amounts.append((_key(name + "_bucket", labels + (("le", bound),)), 1.0))
+    amounts.append((_key(name + "_sum", labels), value))
+    amounts.append((_key(name + "_count", labels), 1.0))
+
+
+def count_cache_lookup(cache, hit):
+    """
+    Counts a lookup of one of the CACHES as a hit or a miss.
+    """
+    key = _key("climatecook_cache_requests_total", (("cache", cache), ("result", "hit" if hit else "miss")))
+    get_store().add_many(((key, 1.0),))
+
+
+def init_app(app):
+    """
+    Registers the hook that records the metrics of every request to a
+    Flask-RESTful resource. Uses the timings of the instrumentation, so it
+    records nothing when INSTRUMENT_REQUESTS is off. Registered before the
+    compression, the hook runs after it and sees the compressed size.
+    """
+    app.after_request(record_request)
+
+
+def get_resource_methods(app):
+    """
+    Returns (resource name, method) for every method of the Flask-RESTful
+    resources of the app.
+    """
+    pairs = []
+    for view in app.view_functions.values():
+        resource = getattr(view, "view_class", None)
+        if resource is not None:
+            for method in sorted(resource.methods):
+                pairs.append((resource.__name__, method))
+    return sorted(pairs)
+
+
+def record_request(response):
+    resource = getattr(current_app.view_functions.get(request.endpoint), "view_class", None)
+    timings = get_timings()
+    if resource is None or timings is None:
+        return response
+    store = get_store()
+    labels = (("method", request.method), ("resource", resource.__name__))
+    status = str(response.status_code)
+
+    # Response.close runs the close callbacks after closing the body, so the
+    # size of a streamed body is known by the time it is recorded
+    size = [0]
+    if response.is_streamed:
+        response.response = _count_stream(response.iter_encoded(), response.response, size)
+    else:
+        size[0] = response.calculate_content_length() or 0
+
+    def record():
+        amounts = [(_key("climatecook_http_requests_total", labels + (("status", status),)), 1.0)]
+        _observe(amounts, "climatecook_http_request_duration_seconds", time.perf_counter() - timings.start, labels)
+        _observe(amounts, "climatecook_http_response_size_bytes", size[0], labels)
+        _observe(amounts, "climatecook_http_request_sql_statements", timings.sql_count, labels)
+        store.add_many(amounts)
+
+    response.call_on_close(record)
+    return response
+
+
+def _count_stream(chunks, source, size):
+    try:
+        for chunk in chunks:
+            size[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+
+
+def render(app):
+    """
+    Renders the metrics of all processes in the Prometheus text format. The
+    histograms of every resource method are included even before their first
+    request, and the hit ratio of every cache is derived from its lookups.
+    """
+    samples = {}
+    for key, value in collect().items():
+        name, labels = json.loads(key)
+        samples[(name, tuple(tuple(label) for label in labels))] = value
+
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append("# HELP {0} {1}".format(name, description))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        if kind == "counter":
+            series = sorted(labels for sample, labels in samples if sample == name)
+            if name == "climatecook_cache_requests_total":
+                series = sorted(set(series) | {
+                    (("cache", cache), ("result", result)) for cache in CACHES for result in ("hit", "miss")})
+            for labels in series:
+                lines.append(_sample(name, labels, samples.get((name, labels), 0.0)))
+            continue
+        series = {labels for sample, labels in samples if sample == name + "_count"}
+        series |= {(("method", method), ("resource", resource)) for resource, method in get_resource_methods(app)}
+        for labels in sorted(series):
+            total = 0.0
+            for bound in buckets + ("+Inf",):
+                bucket_labels = tuple(sorted(labels + (("le", bound),)))
+                total += samples.get((name + "_bucket", bucket_labels), 0.0)
+                lines.append(_sample(name + "_bucket", labels + (("le", bound),), total))
+            lines.append(_sample(name + "_sum", labels, samples.get((name + "_sum", labels), 0.0)))
+            lines.append(_sample(name + "_count", labels, samples.get((name + "_count", labels), 0.0)))
+
+    lines.append("# HELP climatecook_cache_hit_ratio Share of the cache lookups that were hits.")
+    lines.append("# TYPE climatecook_cache_hit_ratio gauge")
+    for cache in CACHES:
+        hits = samples.get(("climatecook_cache_requests_total", (("cache", cache), ("result", "hit"))), 0.0)
+        misses = samples.get(("climatecook_cache_requests_total", (("cache", cache), ("result", "miss"))), 0.0)
+        ratio = hits / (hits + misses) if hits + misses else float("nan")
+        lines.append(_sample("climatecook_cache_hit_ratio", (("cache", cache),), ratio))
+    return "\n".join(lines) + "\n"
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join('{0}="{1}"'.format(label, _escape(str(label_value)))
+            for label, label_value in labels) + "}"
+    if value != value:
+        text = "NaN"
+    elif float(value).is_integer():
+        text = str(int(value))
+    else:
+        text = repr(float(value))
+    return "{0} {1}".format(name, text)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,8 +1,12 @@
+import datetime
 import enum
+import math
+import re
 
 import click
 from flask.cli import with_appcontext
-from sqlalchemy import CheckConstraint
+from sqlalchemy import CheckConstraint, DDL, event, func, inspect, select
+from sqlalchemy.sql import column, table
 from climatecook import db
 
 
@@ -12,16 +16,193 @@ def init_db_command():
     db.create_all()
 
 
+@click.command("seed-db")
+@click.option("--food-items", default=1000, type=click.IntRange(0), help="Number of food items to add.")
+@click.option("--recipes", default=10000, type=click.IntRange(0), help="Number of recipes to add.")
+@click.option("--min-ingredients", default=5, type=click.IntRange(0), help="Fewest ingredients per recipe.")
+@click.option("--max-ingredients", default=40, type=click.IntRange(0), help="Most ingredients per recipe.")
+@click.option("--zipf", default=1.1, type=click.FloatRange(0), help="Exponent of the ingredient popularity.")
+@click.option("--seed", default=0, type=int, help="Random seed, the same seed gives the same data.")
+@with_appcontext
+def seed_db_command(food_items, recipes, min_ingredients, max_ingredients, zipf, seed):
+    """
+    Adds synthetic data for load and scale testing.
+    """
+    from climatecook.seed import seed_db
+
+    if min_ingredients > max_ingredients:
+        raise click.BadParameter("must not be more than --max-ingredients", param_hint="--min-ingredients")
+    if recipes and max_ingredients and not food_items:
+        raise click.BadParameter("recipes with ingredients need food items", param_hint="--food-items")
+    counts = seed_db(food_items, recipes, min_ingredients, max_ingredients, zipf, seed)
+    click.echo("Added {0} food items, {1} equivalents, {2} recipes and {3} ingredients".format(*counts))
+
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """
+    Brings a database created by an older version up to date with the
+    models by adding the missing tables, columns and indexes.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+
+    columns = [c["name"] for c in inspector.get_columns("recipe")]
+    if "emissions_total" not in columns:
+        db.session.execute("ALTER TABLE recipe ADD COLUMN emissions_total FLOAT NOT NULL DEFAULT 0")
+        db.session.commit()
+        recompute_emissions()
+        click.echo("Added column recipe.emissions_total")
+
+    # SQLite can only add a NOT NULL column with a constant default, so the
+    # existing rows are stamped with the time of the migration
+    now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+    for model in (Recipe, Ingredient, FoodItem, FoodItemEquivalent):
+        name = model.__tablename__
+        if "updated_at" not in [c["name"] for c in inspector.get_columns(name)]:
+            db.session.execute("ALTER TABLE {0} ADD COLUMN updated_at DATETIME NOT NULL DEFAULT '{1}'".format(
+                name, now))
+            db.session.commit()
+            click.echo("Added column {0}.updated_at".format(name))
+
+    for model_table in db.metadata.sorted_tables:
+        existing = [i["name"] for i in inspector.get_indexes(model_table.name)]
+        for index in model_table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                click.echo("Created index {0}".format(index.name))
+
+    for statement in COLLECTION_VERSION_DDL:
+        db.engine.execute(statement)
+
+    if "food_item_fts" not in inspector.get_table_names():
+        for statement in FOOD_ITEM_SEARCH_DDL:
+            db.engine.execute(statement)
+        db.engine.execute("INSERT INTO food_item_fts(food_item_fts) VALUES ('rebuild')")
+        click.echo("Created full-text search table food_item_fts")
+
+
+@click.command("recompute-emissions")
+@click.option("--check", is_flag=True, help="Only report stale totals, do not fix them.")
+@with_appcontext
+def recompute_emissions_command(check):
+    """
+    Rebuilds the stored emissions totals of all recipes from their ingredients
+    and reports the recipes whose stored total had drifted.
+    """
+    stale = recompute_emissions(update=not check)
+    for recipe_id, stored, actual in stale:
+        click.echo("Recipe {0}: stored {1}, actual {2}".format(recipe_id, stored, actual))
+    click.echo("{0} stale emissions totals {1}".format(len(stale), "found" if check else "fixed"))
+    if check and stale:
+        raise SystemExit(1)
+
+
+def startswith_nocase(column, prefix):
+    """
+    Case-insensitive prefix filter for a name column. Unlike startswith(),
+    which appends the wildcard in SQL, the whole pattern is passed as one
+    parameter so that SQLite can answer the LIKE from the NOCASE index of
+    the column.
+
+    : param column: the column to filter
+    : param str prefix: the prefix to match
+    """
+    escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return column.like(escaped + "%", escape="\\")
+
+
+def recipe_emissions_query():
+    """
+    Query that aggregates the emissions of every recipe from its ingredients
+    in a single grouped statement. Recipes without ingredients get a total
+    of 0.
+
+    : return: query of (recipe id, emissions total) tuples
+    """
+    emissions_total = func.coalesce(func.sum(
+        FoodItem.emission_per_kg
+        * Ingredient.quantity
+        * FoodItemEquivalent.conversion_factor), 0)
+    return db.session.query(Recipe.id, emissions_total) \
+        .outerjoin(Ingredient, Ingredient.recipe_id == Recipe.id) \
+        .outerjoin(FoodItem, FoodItem.id == Ingredient.food_item_id) \
+        .outerjoin(FoodItemEquivalent, FoodItemEquivalent.id == Ingredient.food_item_equivalent_id) \
+        .group_by(Recipe.id)
+
+
+def recompute_emissions(update=True):
+    """
+    Compares the stored emissions total of every recipe to the value
+    aggregated from its ingredients.
+
+    : param bool update: write the aggregated values over the stale ones
+    : return: list of (recipe id, stored total, actual total) for stale recipes
+    """
+    stored = dict(db.session.query(Recipe.id, Recipe.emissions_total).all())
+    stale = []
+    for recipe_id, actual in recipe_emissions_query():
+        if not math.isclose(stored[recipe_id], actual, rel_tol=1e-9, abs_tol=1e-9):
+            stale.append((recipe_id, stored[recipe_id], actual))
+
+    if update and stale:
+        db.session.bulk_update_mappings(Recipe, [
+            {"id": recipe_id, "emissions_total": actual} for recipe_id, _, actual in stale
+        ])
+        db.session.commit()
+    return stale
+
+
 class Recipe(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # recipe_category_id = db.Column(db.Integer, db.ForeignKey('recipe_category.id', ondelete="SET NULL"), nullable=True)
-    name = db.Column(db.String(64), nullable=False)
+    name = db.Column(db.String(64), nullable=False, index=True)
+    emissions_total = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     # recipe_category = db.relationship("RecipeCategory", back_populates="recipes")
     # ratings = db.relationship("Rating", back_populates="recipe", cascade="all,delete")
     ingredients = db.relationship("Ingredient", back_populates="recipe", cascade="all,delete")
 
-    __table_args__ = (CheckConstraint('length(name) >= 1', name='cc_recipe_name'),)
+    __table_args__ = (
+        CheckConstraint('length(name) >= 1', name='cc_recipe_name'),
+        db.Index("ix_recipe_name_nocase", name.collate("NOCASE")),
+        db.Index("ix_recipe_emissions_total", emissions_total, id),
+    )
+
+    @staticmethod
+    def add_emissions(recipe_id, delta):
+        """
+        Adds delta to the stored emissions total of a recipe. The addition is
+        done in SQL so that concurrent writers don't overwrite each other.
+        The recipe is marked updated even when delta is 0, as its ingredients
+        have changed and so has its document.
+
+        : param int recipe_id: id of the recipe to update
+        : param float delta: change of the emissions total
+        """
+        Recipe.query.filter_by(id=recipe_id).update(
+            {Recipe.emissions_total: Recipe.emissions_total + delta, Recipe.updated_at: datetime.datetime.utcnow()},
+            synchronize_session=False)
+
+    @staticmethod
+    def get_version(recipe_id):
+        """
+        Version stamp of a recipe document: the update time of the recipe and
+        the number and latest update time of its ingredients.
+
+        : param recipe_id: id of the recipe
+        : return: tuple of (id, updated_at, ingredient count, ingredients updated_at),
+            or None if the recipe doesn't exist
+        """
+        return db.session.query(Recipe.id, Recipe.updated_at, func.count(Ingredient.id),
+                func.max(Ingredient.updated_at)) \
+            .outerjoin(Ingredient, Ingredient.recipe_id == Recipe.id) \
+            .filter(Recipe.id == recipe_id) \
+            .group_by(Recipe.id) \
+            .first()
 
 
 # class RecipeCategory(db.Model):
@@ -44,10 +225,13 @@ class Recipe(db.Model):
 
 class Ingredient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False)
-    food_item_id = db.Column(db.Integer, db.ForeignKey('food_item.id'), nullable=False)
-    food_item_equivalent_id = db.Column(db.Integer, db.ForeignKey('food_item_equivalent.id'), nullable=False)
+    recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id', ondelete="CASCADE"), nullable=False, index=True)
+    food_item_id = db.Column(db.Integer, db.ForeignKey('food_item.id'), nullable=False, index=True)
+    food_item_equivalent_id = db.Column(db.Integer, db.ForeignKey('food_item_equivalent.id'), nullable=False,
+        index=True)
     quantity = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     recipe = db.relationship("Recipe", back_populates="ingredients")
     food_item = db.relationship("FoodItem")
@@ -55,15 +239,29 @@ class Ingredient(db.Model):
 
     __table_args__ = (CheckConstraint('quantity > 0', name='cc_ingredient_quantity'),)
 
+    def get_emissions(self):
+        """
+        Emissions of this ingredient based on its current food item,
+        equivalent and quantity. Uses the ids instead of the relationships so
+        that the value is correct even before pending changes are flushed.
+        """
+        food_item = FoodItem.query.get(self.food_item_id)
+        food_item_equivalent = FoodItemEquivalent.query.get(self.food_item_equivalent_id)
+        if food_item is None or food_item_equivalent is None:
+            return 0.0
+        return food_item.emission_per_kg * self.quantity * food_item_equivalent.conversion_factor
+
 
 class FoodItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # food_item_category_id = db.Column(db.Integer, db.ForeignKey('food_item_category.id'), nullable=True)
-    name = db.Column(db.String(128), nullable=False)
+    name = db.Column(db.String(128), nullable=False, index=True)
     emission_per_kg = db.Column(db.Float, nullable=False)
     vegan = db.Column(db.Boolean, nullable=False, default=0)
     organic = db.Column(db.Boolean, nullable=False, default=0)
     domestic = db.Column(db.Boolean, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     # food_item_category = db.relationship("FoodItemCategory", back_populates="food_items")
     food_item_equivalents = db.relationship("FoodItemEquivalent", back_populates="food_item", cascade="all,delete")
@@ -71,14 +269,151 @@ class FoodItem(db.Model):
     __table_args__ = (
         CheckConstraint('length(name) >= 1', name='cc_food_item_name'),
         CheckConstraint('emission_per_kg > 0', name='cc_emission_per_kg'),
+        db.Index("ix_food_item_name_nocase", name.collate("NOCASE")),
     )
 
+    @staticmethod
+    def get_version(food_item_id):
+        """
+        Version stamp of a food item document: the update time of the food
+        item and the number and latest update time of its equivalents.
+
+        : param food_item_id: id of the food item
+        : return: tuple of (updated_at, equivalent count, equivalents updated_at),
+            or None if the food item doesn't exist
+        """
+        return db.session.query(FoodItem.updated_at, func.count(FoodItemEquivalent.id),
+                func.max(FoodItemEquivalent.updated_at)) \
+            .outerjoin(FoodItemEquivalent, FoodItemEquivalent.food_item_id == FoodItem.id) \
+            .filter(FoodItem.id == food_item_id) \
+            .group_by(FoodItem.id) \
+            .first()
+
+    @staticmethod
+    def touch(food_item_id):
+        """
+        Marks a food item updated when its equivalents change, so that the
+        Last-Modified of its document also moves when one is deleted.
+
+        : param int food_item_id: id of the food item to update
+        """
+        FoodItem.query.filter_by(id=food_item_id).update(
+            {FoodItem.updated_at: datetime.datetime.utcnow()},
+            synchronize_session=False)
+
+    def set_emission_per_kg(self, emission_per_kg):
+        """
+        Sets the emissions per kg and applies the resulting change to the
+        stored emissions total of every recipe that uses this food item.
+        """
+        delta = emission_per_kg - self.emission_per_kg
+        self.emission_per_kg = emission_per_kg
+        if delta == 0:
+            return
+
+        used_quantity = select([func.sum(Ingredient.quantity * FoodItemEquivalent.conversion_factor)]) \
+            .where(Ingredient.food_item_equivalent_id == FoodItemEquivalent.id) \
+            .where(Ingredient.food_item_id == self.id) \
+            .where(Ingredient.recipe_id == Recipe.id) \
+            .as_scalar()
+        recipe_ids = select([Ingredient.recipe_id]).where(Ingredient.food_item_id == self.id)
+        Recipe.query.filter(Recipe.id.in_(recipe_ids)).update(
+            {Recipe.emissions_total: Recipe.emissions_total + delta * used_quantity},
+            synchronize_session=False)
+
+
+# Full-text index over the food item names. The FTS5 table only stores the
+# index, the names are read from food_item ("external content"), and the
+# triggers keep the index in sync with every write to the name column. The
+# porter tokenizer stems the words so that "tomato" also finds "tomatoes",
+# and the prefix indexes keep short as-you-type prefixes cheap.
+FOOD_ITEM_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS food_item_fts USING fts5("
+    "name, content='food_item', content_rowid='id', tokenize='porter unicode61', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS food_item_fts_insert AFTER INSERT ON food_item BEGIN "
+    "INSERT INTO food_item_fts(rowid, name) VALUES (new.id, new.name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS food_item_fts_delete AFTER DELETE ON food_item BEGIN "
+    "INSERT INTO food_item_fts(food_item_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS food_item_fts_update AFTER UPDATE OF id, name ON food_item BEGIN "
+    "INSERT INTO food_item_fts(food_item_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO food_item_fts(rowid, name) VALUES (new.id, new.name); "
+    "END",
+]
+
+food_item_fts = table("food_item_fts", column("rowid"), column("food_item_fts"), column("rank"))
+
+
+for statement in FOOD_ITEM_SEARCH_DDL:
+    event.listen(FoodItem.__table__, "after_create", DDL(statement))
+event.listen(FoodItem.__table__, "after_drop", DDL("DROP TABLE IF EXISTS food_item_fts"))
+
+
+class CollectionVersion(db.Model):
+    """
+    Version counter of a collection, bumped by triggers on every insert,
+    update and delete of its table. Lets collection resources validate
+    cached documents with a single primary key lookup.
+    """
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+def _collection_version_triggers(name):
+    return [
+        "CREATE TRIGGER IF NOT EXISTS {0}_version_{1} AFTER {2} ON {0} BEGIN "
+        "INSERT INTO collection_version(name, version, updated_at) "
+        "VALUES ('{0}', 1, strftime('%Y-%m-%d %H:%M:%S', 'now')) "
+        "ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at; "
+        "END".format(name, operation.lower(), operation)
+        for operation in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+def get_collection_version(name):
+    """
+    : param str name: table name of the collection
+    : return: tuple of (version, updated_at), version 0 for a collection that
+        has never been written to
+    """
+    row = db.session.query(CollectionVersion.version, CollectionVersion.updated_at) \
+        .filter(CollectionVersion.name == name).first()
+    if row is None:
+        return (0, None)
+    return tuple(row)
+
+
+def search_food_items(query, terms):
+    """
+    Filters a FoodItem query to the items whose name matches the search terms
+    and orders them by relevance. Every word of the terms must match a word
+    in the name either after stemming or as a prefix.
+
+    : param query: FoodItem query to filter
+    : param str terms: the search terms as typed by the user
+    : return: the filtered and ordered query, or None if terms has no words
+    """
+    words = re.findall(r"\w+", terms)
+    if not words:
+        return None
+    # Prefix queries are not stemmed, so "tomatoes"* alone wouldn't match the
+    # stored stem "tomato"
+    match = " AND ".join('("{0}" OR "{0}"*)'.format(word) for word in words)
+    return query.join(food_item_fts, food_item_fts.c.rowid == FoodItem.id) \
+        .filter(food_item_fts.c.food_item_fts.op("MATCH")(match)) \
+        .order_by(food_item_fts.c.rank, FoodItem.name, FoodItem.id)
+
 
 class FoodItemEquivalent(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    food_item_id = db.Column(db.Integer, db.ForeignKey('food_item.id', ondelete="CASCADE"), nullable=False)
+    food_item_id = db.Column(db.Integer, db.ForeignKey('food_item.id', ondelete="CASCADE"), nullable=False,
+        index=True)
     unit_type = db.Column(db.String, nullable=False)
     conversion_factor = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     food_item = db.relationship("FoodItem", back_populates="food_item_equivalents")
 
@@ -88,6 +423,38 @@ class FoodItemEquivalent(db.Model):
         db.UniqueConstraint("unit_type", "food_item_id", name="tuc_unit_type_food_item_id")
     )
 
+    def set_conversion_factor(self, conversion_factor):
+        """
+        Sets the conversion factor and applies the resulting change to the
+        stored emissions total of every recipe that uses this equivalent.
+        """
+        delta = conversion_factor - self.conversion_factor
+        self.conversion_factor = conversion_factor
+        if delta == 0:
+            return
+
+        used_emissions = select([func.sum(Ingredient.quantity * FoodItem.emission_per_kg)]) \
+            .where(Ingredient.food_item_id == FoodItem.id) \
+            .where(Ingredient.food_item_equivalent_id == self.id) \
+            .where(Ingredient.recipe_id == Recipe.id) \
+            .as_scalar()
+        recipe_ids = select([Ingredient.recipe_id]).where(Ingredient.food_item_equivalent_id == self.id)
+        Recipe.query.filter(Recipe.id.in_(recipe_ids)).update(
+            {Recipe.emissions_total: Recipe.emissions_total + delta * used_emissions},
+            synchronize_session=False)
+
+
+# Ingredients and equivalents have no collection resource, but their
+# versions tell when the emissions report is out of date
+COLLECTION_VERSION_TABLES = (Recipe, FoodItem, Ingredient, FoodItemEquivalent)
+COLLECTION_VERSION_DDL = [statement for model in COLLECTION_VERSION_TABLES
+    for statement in _collection_version_triggers(model.__tablename__)]
+
+# DDL() runs the statements through %-formatting
+for model in COLLECTION_VERSION_TABLES:
+    for statement in _collection_version_triggers(model.__tablename__):
+        event.listen(model.__table__, "after_create", DDL(statement.replace("%", "%%")))
+
 
 class EquivalentUnitType(enum.Enum):
     C = 'cup'
@@ -0,0 +1,90 @@
+import bisect
+import threading
+
+from flask import current_app
+
+
+def normalize_name(name):
+    """
+    Normalizes a name for prefix matching: case-folded with runs of whitespace
+    collapsed into single spaces.
+    """
+    return " ".join(name.casefold().split())
+
+
+class NameIndex(object):
+    """
+    In-memory prefix index over (id, name) pairs. The entries are kept in a
+    list sorted by the normalized name, so a prefix lookup is a binary search
+    followed by reading the next k entries.
+
+    The index is built lazily from the loader on first use and after
+    invalidate(). It is stored with the version stamp of the data it was
+    built from, and a lookup with a different stamp rebuilds it, which keeps
+    the index correct when another process writes to the database.
+    """
+
+    def __init__(self, loader):
+        """
+        : param loader: callable returning an iterable of (id, name) pairs
+        """
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._entries = None
+        self._stamp = None
+
+    def _ensure_built(self, stamp):
+        if self._entries is None or self._stamp != stamp:
+            self._entries = sorted((normalize_name(name), id, name) for id, name in self._loader())
+            self._stamp = stamp
+
+    def invalidate(self):
+        """
+        Drops the index so that it is rebuilt from the loader on next use.
+        """
+        with self._lock:
+            self._entries = None
+
+    def suggest(self, stamp, prefix, k):
+        """
+        Returns the first k (id, name) pairs in name order whose normalized
+        name starts with the normalized prefix.
+
+        : param stamp: current version of the names, see get_version
+        """
+        prefix = normalize_name(prefix)
+        with self._lock:
+            self._ensure_built(stamp)
+            entries = self._entries
+            i = bisect.bisect_left(entries, (prefix,))
+            result = []
+            while i < len(entries) and len(result) < k and entries[i][0].startswith(prefix):
+                result.append((entries[i][1], entries[i][2]))
+                i += 1
+            return result
+
+
+def get_version():
+    """
+    Version stamp of the food item name index: the collection version of the
+    food items, which triggers bump on every write.
+    """
+    from climatecook.models import FoodItem, get_collection_version
+    return get_collection_version(FoodItem.__tablename__)[0]
+
+
+def _load_food_item_names():
+    from climatecook import db
+    from climatecook.models import FoodItem
+    return db.session.query(FoodItem.id, FoodItem.name).all()
+
+
+def get_food_item_index():
+    """
+    Returns the food item name index of the current application, creating it
+    on first use.
+    """
+    index = current_app.extensions.get("food_item_names")
+    if index is None:
+        index = current_app.extensions.setdefault("food_item_names", NameIndex(_load_food_item_names))
+    return index
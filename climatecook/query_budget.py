@@ -0,0 +1,92 @@
+import logging
+
+from flask import current_app, request
+
+from climatecook.instrumentation import get_timings
+
+logger = logging.getLogger("climatecook.query_budget")
+
+MODES = ("off", "log", "raise")
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised in "raise" mode when a request issues more SQL statements than the
+    budget of its resource method.
+    """
+
+
+def query_budget(statements):
+    """
+    Declares the maximum number of SQL statements a resource method may
+    issue per request, e.g.
+
+        @query_budget(3)
+        def get(self, recipe_id):
+
+    The budget must not depend on the size of the data, so an N+1 query
+    pattern exceeds it. None declares a method whose statements grow with
+    its input on purpose, and exempts it from the check.
+    """
+    def decorator(func):
+        func.query_budget = statements
+        return func
+    return decorator
+
+
+def get_query_budget(resource, method):
+    """
+    Returns the budget declared for a method of a resource, or raises
+    AttributeError if it has none.
+    """
+    return getattr(resource, method.lower()).query_budget
+
+
+def get_mode(app):
+    """
+    Returns the QUERY_BUDGET_MODE of the app. By default budgets are logged
+    in debug mode and not checked otherwise.
+    """
+    mode = app.config["QUERY_BUDGET_MODE"]
+    if mode is None:
+        mode = "log" if app.debug else "off"
+    if mode not in MODES:
+        raise ValueError("Unknown QUERY_BUDGET_MODE {0}".format(mode))
+    return mode
+
+
+def init_app(app):
+    """
+    Registers the check of the query budgets. It counts the statements with
+    the request instrumentation, so it does nothing when INSTRUMENT_REQUESTS
+    is off. Streamed responses are checked once the body has been sent.
+    """
+    get_mode(app)
+    app.after_request(check_query_budget)
+
+
+def check_query_budget(response):
+    mode = get_mode(current_app)
+    timings = get_timings()
+    resource = getattr(current_app.view_functions.get(request.endpoint), "view_class", None)
+    if mode == "off" or timings is None or resource is None:
+        return response
+    budget = getattr(getattr(resource, request.method.lower(), None), "query_budget", None)
+    if budget is None:
+        return response
+
+    description = "{0} {1}".format(request.method, resource.__name__)
+    if response.is_streamed:
+        response.call_on_close(lambda: _check(description, timings, budget, mode))
+    else:
+        _check(description, timings, budget, mode)
+    return response
+
+
+def _check(description, timings, budget, mode):
+    if timings.sql_count <= budget:
+        return
+    message = "{0} issued {1} SQL statements, its budget is {2}".format(description, timings.sql_count, budget)
+    if mode == "raise":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
@@ -0,0 +1,146 @@
+import collections
+import threading
+
+from flask import current_app
+
+
+class RecipeCache(object):
+    """
+    LRU cache of serialized recipe documents keyed by recipe id. The total
+    size of the cached documents is kept under max_size characters by
+    evicting the least recently used ones.
+
+    Every entry records the food items and equivalents its recipe uses, so
+    that a change to one of them evicts exactly the recipes that depend on
+    it. Entries are also stored with the version stamp of the recipe, and a
+    lookup with a different stamp is a miss, which keeps the cache correct
+    when another process writes to the database.
+    """
+
+    def __init__(self, max_size):
+        """
+        : param int max_size: maximum total length of the cached documents
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._food_items = {}
+        self._equivalents = {}
+
+    def _discard(self, recipe_id):
+        entry = self._entries.pop(recipe_id, None)
+        if entry is None:
+            return
+        stamp, document, food_item_ids, equivalent_ids = entry
+        self.size -= len(document)
+        for index, ids in ((self._food_items, food_item_ids), (self._equivalents, equivalent_ids)):
+            for id in ids:
+                recipe_ids = index.get(id)
+                if recipe_ids is not None:
+                    recipe_ids.discard(recipe_id)
+                    if not recipe_ids:
+                        del index[id]
+
+    def get(self, recipe_id, stamp):
+        """
+        Returns the cached document of a recipe if it was stored with the
+        same version stamp, otherwise None.
+        """
+        with self._lock:
+            entry = self._entries.get(recipe_id)
+            if entry is None or entry[0] != stamp:
+                self._discard(recipe_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(recipe_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, recipe_id, stamp, document, food_item_ids, equivalent_ids):
+        """
+        Stores the serialized document of a recipe.
+
+        : param tuple stamp: version stamp the document was built from
+        : param str document: the serialized document
+        : param food_item_ids: ids of the food items used by the recipe
+        : param equivalent_ids: ids of the food item equivalents used by the recipe
+        """
+        if len(document) > self.max_size:
+            return
+        food_item_ids = frozenset(food_item_ids)
+        equivalent_ids = frozenset(equivalent_ids)
+        with self._lock:
+            self._discard(recipe_id)
+            self._entries[recipe_id] = (stamp, document, food_item_ids, equivalent_ids)
+            self.size += len(document)
+            for index, ids in ((self._food_items, food_item_ids), (self._equivalents, equivalent_ids)):
+                for id in ids:
+                    index.setdefault(id, set()).add(recipe_id)
+            while self.size > self.max_size:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_recipe(self, *recipe_ids):
+        """
+        Evicts the given recipes.
+        """
+        with self._lock:
+            for recipe_id in recipe_ids:
+                self._discard(recipe_id)
+
+    def invalidate_food_item(self, food_item_id):
+        """
+        Evicts the recipes that use the food item.
+        """
+        with self._lock:
+            for recipe_id in list(self._food_items.get(food_item_id, ())):
+                self._discard(recipe_id)
+
+    def invalidate_food_item_equivalent(self, food_item_equivalent_id):
+        """
+        Evicts the recipes that use the food item equivalent.
+        """
+        with self._lock:
+            for recipe_id in list(self._equivalents.get(food_item_equivalent_id, ())):
+                self._discard(recipe_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._food_items.clear()
+            self._equivalents.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        : return: dict of the entry count, total size and the hit, miss and
+            eviction counters
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def get_recipe_cache():
+    """
+    Returns the recipe document cache of the current application, creating
+    it on first use with RECIPE_CACHE_MAX_SIZE from the config.
+    """
+    cache = current_app.extensions.get("recipe_cache")
+    if cache is None:
+        cache = current_app.extensions.setdefault("recipe_cache",
+            RecipeCache(current_app.config["RECIPE_CACHE_MAX_SIZE"]))
+    return cache
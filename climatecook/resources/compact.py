@@ -0,0 +1,43 @@
+from flask import request
+from werkzeug.urls import url_quote
+
+from climatecook.api import MASON
+
+COMPACT_VALUES = ("1", "true")
+
+
+def is_compact():
+    """
+    Checks whether the current request asks for the compact representation of
+    a collection, either with the compact query parameter or with the compact
+    parameter of the Mason media type, e.g.
+    "Accept: application/vnd.mason+json; compact=1".
+    """
+    if request.args.get("compact", "").lower() in COMPACT_VALUES:
+        return True
+    for value, quality in request.accept_mimetypes:
+        mimetype, _, params = value.partition(";")
+        if mimetype.strip() != MASON or quality <= 0:
+            continue
+        for param in params.split(";"):
+            name, _, param_value = param.partition("=")
+            if name.strip() == "compact" and param_value.strip().strip('"').lower() in COMPACT_VALUES:
+                return True
+    return False
+
+
+def uri_template(resource, **variables):
+    """
+    Builds an RFC 6570 URI template for the route of a resource, e.g.
+    uri_template(FoodItemResource, food_item_id="id") gives
+    "/api/food-items/{id}/".
+
+    : param resource: the resource class
+    : param variables: template variable name for each route argument
+    """
+    from climatecook.api import api
+
+    href = api.url_for(resource, **{arg: "{" + name + "}" for arg, name in variables.items()})
+    for name in variables.values():
+        href = href.replace(url_quote("{" + name + "}"), "{" + name + "}")
+    return href
@@ -0,0 +1,47 @@
+import hashlib
+
+from flask import request, Response
+
+
+def get_validators(stamp, last_modified):
+    """
+    Builds the validators of the representation at the current request URL.
+    The ETag is a hash of the URL and the version stamp, so it changes
+    whenever any part of the stamp does.
+
+    : param tuple stamp: values that change whenever the representation changes
+    : param datetime last_modified: last change of the representation, may be None
+    : return: tuple of (etag, last_modified)
+    """
+    digest = hashlib.sha1(repr((request.full_path, stamp)).encode("utf-8")).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    return digest, last_modified
+
+
+def get_not_modified_response(etag, last_modified):
+    """
+    Checks the conditional headers of the request against the validators.
+    If-None-Match takes precedence over If-Modified-Since as in RFC 7232.
+
+    : return: 304 response, or None if the representation must be sent
+    """
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        not_modified = last_modified <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        not_modified = False
+    if not not_modified:
+        return None
+    return add_validators(Response(None, 304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    """
+    Sets the ETag and Last-Modified headers of a response.
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
@@ -3,48 +3,102 @@ import json
 from flask import request, Response
 from flask_restful import Resource, reqparse
 
+from sqlalchemy.exc import IntegrityError
+
 from climatecook import db
-from climatecook.api import api, MASON
-from climatecook.resources.masonbuilder import MasonBuilder
+from climatecook.api import MASON, NDJSON
+from climatecook.instrumentation import dumps
+from climatecook.query_budget import query_budget
+from climatecook.resources.compact import is_compact, uri_template
+from climatecook.resources.conditional import add_validators, get_not_modified_response, get_validators
+from climatecook.resources.masonbuilder import MasonBuilder, frozen
+from climatecook.resources.pagination import PaginationError, add_page_controls, get_page_args, paginate
+from climatecook.resources.urls import url_for
 from climatecook.models import FoodItem, FoodItemEquivalent, EquivalentUnitType, Ingredient
+from climatecook.models import get_collection_version, search_food_items, startswith_nocase
+from climatecook.name_index import get_food_item_index
+from climatecook.name_index import get_version as get_name_version
+from climatecook.recipe_cache import get_recipe_cache
+from climatecook.substitute_index import get_substitute_index
 
 
 class FoodItemCollection(Resource):
 
+    @query_budget(2)
     def get(self):
+        compact = is_compact()
+        version, updated_at = get_collection_version(FoodItem.__tablename__)
+        validators = get_validators((version, compact), updated_at)
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            not_modified.vary.add("Accept")
+            return not_modified
+
         body = FoodItemBuilder()
         body.add_namespace("clicook", "/api/link-relations/")
-        body.add_control("self", api.url_for(FoodItemCollection))
+        body.add_control("self", url_for(FoodItemCollection))
         from climatecook.resources.recipes import RecipeCollection
-        body.add_control("clicook:recipes-all", api.url_for(RecipeCollection), title="Recipes")
+        body.add_static_control("clicook:recipes-all", lambda: dict(
+            href=url_for(RecipeCollection), title="Recipes"))
         body.add_control_add_food_item()
+        body.add_control_search_food_items()
+        body.add_control_suggest_food_items()
 
-        items = []
         parser = reqparse.RequestParser()
         parser.add_argument('name', type=str, help='Name of the food item')
+        parser.add_argument('q', type=str, help='Search terms for a ranked full-text search')
         args = parser.parse_args()
+        try:
+            limit, after, before = get_page_args()
+        except PaginationError as e:
+            return MasonBuilder.get_error_response(400, str(e), "")
+
+        query = FoodItem.query
         if 'name' in args and args['name'] is not None:
             name = args['name']
-            food_items = FoodItem.query.filter(FoodItem.name.startswith(name)).order_by(FoodItem.name).all()
+            query = query.filter(startswith_nocase(FoodItem.name, name))
+        if args['q'] is not None:
+            # Ranked search returns the best matches only, so it isn't paginated
+            query = search_food_items(query, args['q'])
+            food_items = query.limit(limit).all() if query is not None else []
         else:
-            food_items = FoodItem.query.order_by(FoodItem.name).all()
-
-        for food_item in food_items:
-            item = FoodItemBuilder()
-            item['name'] = food_item.name
-            item['emission_per_kg'] = food_item.emission_per_kg
-            item['vegan'] = food_item.vegan
-            item['domestic'] = food_item.domestic
-            item['organic'] = food_item.organic
-            print(food_item.id)
-            item.add_control("self", api.url_for(FoodItemResource, food_item_id=food_item.id))
-            print(item['@controls']['self'])
-            item.add_control("profile", "/api/profiles/")
-            items.append(item)
-
-        body["items"] = items
-        return Response(json.dumps(body), 200, mimetype=MASON)
+            page = paginate(query, FoodItem.name, FoodItem.id, limit, after, before)
+            add_page_controls(body, FoodItemCollection, page, limit, after, before, name=args['name'],
+                compact=request.args.get("compact"))
+            food_items = page[0]
+
+        def build_items():
+            for food_item in food_items:
+                item = FoodItemBuilder()
+                item['name'] = food_item.name
+                item['emission_per_kg'] = food_item.emission_per_kg
+                item['vegan'] = food_item.vegan
+                item['domestic'] = food_item.domestic
+                item['organic'] = food_item.organic
+                item.add_control("self", url_for(FoodItemResource, food_item_id=food_item.id))
+                item.add_control("profile", "/api/profiles/")
+                yield item
+
+        def build_compact_items():
+            for food_item in food_items:
+                yield {
+                    "id": food_item.id,
+                    "name": food_item.name,
+                    "emission_per_kg": food_item.emission_per_kg,
+                    "vegan": food_item.vegan,
+                    "domestic": food_item.domestic,
+                    "organic": food_item.organic
+                }
+
+        if compact:
+            body.add_control_food_item_template()
+            response = body.stream(build_compact_items(), mimetype=MASON)
+        else:
+            response = body.stream(build_items(), mimetype=MASON)
+        response.vary.add("Accept")
+        return add_validators(response, *validators)
 
+    @query_budget(2)
     def post(self):
         if request.json is None:
             return MasonBuilder.get_error_response(415, "Request content type must be JSON", "")
@@ -100,28 +154,236 @@ class FoodItemCollection(Resource):
         db.session.add(food_item)
         db.session.commit()
         headers = {
-            "Location": api.url_for(FoodItemResource, food_item_id=food_item.id)
+            "Location": url_for(FoodItemResource, food_item_id=food_item.id)
         }
         response = Response(status=201, headers=headers)
         return response
 
 
+class FoodItemBulkImport(Resource):
+    """
+    Imports food items with their equivalents from a newline delimited JSON
+    stream. Each line holds one food item object with an optional list of
+    equivalents. The body is read line by line and the valid items are
+    inserted in batches, one transaction per batch. Invalid lines are reported
+    back instead of failing the whole import.
+    """
+
+    DEFAULT_BATCH_SIZE = 1000
+    MAX_BATCH_SIZE = 10000
+
+    # Issues a few statements per batch, so the statements grow with the body
+    @query_budget(None)
+    def post(self):
+        if request.mimetype != NDJSON:
+            return MasonBuilder.get_error_response(415, "Request content type must be {0}".format(NDJSON), "")
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('batch_size', type=str, help='Number of food items per transaction')
+        args = parser.parse_args()
+        batch_size = FoodItemBulkImport.DEFAULT_BATCH_SIZE
+        if args['batch_size'] is not None:
+            try:
+                batch_size = int(args['batch_size'])
+                if batch_size < 1 or batch_size > FoodItemBulkImport.MAX_BATCH_SIZE:
+                    raise ValueError
+            except ValueError:
+                return MasonBuilder.get_error_response(400,
+                    "Batch size must be between 1 and {0}".format(FoodItemBulkImport.MAX_BATCH_SIZE), "")
+
+        imported = 0
+        errors = []
+        batch = []
+        for line_number, line in enumerate(request.stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                batch.append((line_number,) + FoodItemBulkImport.parse_line(line))
+            except ValueError as e:
+                errors.append({"line": line_number, "message": str(e)})
+                continue
+            if len(batch) >= batch_size:
+                imported += FoodItemBulkImport.insert_batch(batch, errors)
+                batch = []
+        if batch:
+            imported += FoodItemBulkImport.insert_batch(batch, errors)
+
+        if imported > 0:
+            get_food_item_index().invalidate()
+            get_substitute_index().invalidate()
+
+        body = MasonBuilder()
+        body.add_namespace("clicook", "/api/link-relations/")
+        body.add_control("collection", url_for(FoodItemCollection))
+        body.add_control("profile", "/api/profiles/")
+        body["imported"] = imported
+        body["failed"] = len(errors)
+        body["errors"] = sorted(errors, key=lambda error: error["line"])
+        return Response(dumps(body), 200, mimetype=MASON)
+
+    @staticmethod
+    def parse_line(line):
+        """
+        Parses and validates one line of the import.
+
+        : param bytes line: the JSON encoded food item
+        : return: tuple of (food item row, list of equivalent rows)
+        : raises ValueError: with a description of the first problem found
+        """
+        try:
+            obj = json.loads(line.decode("utf-8"))
+        except ValueError:
+            raise ValueError("Invalid JSON")
+        if not isinstance(obj, dict):
+            raise ValueError("Food item must be a JSON object")
+
+        missing = [field for field in FoodItemBuilder.food_item_schema()["required"] if field not in obj]
+        if missing:
+            raise ValueError(", ".join("Missing field:{0}".format(field) for field in missing))
+
+        name = obj["name"]
+        if not isinstance(name, str) or len(name) < 1:
+            raise ValueError("Name is too short")
+        elif len(name) > 128:
+            raise ValueError("Name is too long")
+
+        emission_per_kg = obj["emission_per_kg"]
+        if isinstance(emission_per_kg, bool) or not isinstance(emission_per_kg, (int, float)) \
+                or emission_per_kg <= 0:
+            raise ValueError("emission_per_kg must be a positive number")
+
+        row = {"name": name, "emission_per_kg": float(emission_per_kg)}
+        for flag in ("vegan", "organic", "domestic"):
+            value = obj.get(flag)
+            if value is not None and not isinstance(value, bool):
+                raise ValueError("{0} must be a boolean".format(flag))
+            row[flag] = bool(value)
+
+        equivalents = obj.get("equivalents") or []
+        if not isinstance(equivalents, list):
+            raise ValueError("equivalents must be a list")
+        unit_types = [e.value for e in EquivalentUnitType]
+        equivalent_rows = []
+        for equivalent in equivalents:
+            if not isinstance(equivalent, dict) or not set(["unit_type", "conversion_factor"]).issubset(equivalent):
+                raise ValueError("Incomplete equivalent - missing fields")
+            unit_type = equivalent["unit_type"]
+            if unit_type not in unit_types:
+                raise ValueError("Unknown unit type {0}".format(unit_type))
+            if unit_type in [e["unit_type"] for e in equivalent_rows]:
+                raise ValueError("Food item equivalent with unit type {0} already exists".format(unit_type))
+            conversion_factor = equivalent["conversion_factor"]
+            if isinstance(conversion_factor, bool) or not isinstance(conversion_factor, (int, float)) \
+                    or conversion_factor < 0:
+                raise ValueError("Conversion factor must be a positive number")
+            equivalent_rows.append({"unit_type": unit_type, "conversion_factor": float(conversion_factor)})
+        return row, equivalent_rows
+
+    @staticmethod
+    def insert_batch(batch, errors):
+        """
+        Inserts a batch of parsed lines in one transaction with executemany.
+        If the batch fails, its lines are retried one at a time so that only
+        the offending lines are reported.
+
+        : param list batch: (line number, food item row, equivalent rows) tuples
+        : param list errors: list to append the per-line errors to
+        : return: number of imported food items
+        """
+        try:
+            FoodItemBulkImport._insert_rows(batch)
+            db.session.commit()
+            return len(batch)
+        except IntegrityError:
+            db.session.rollback()
+            if len(batch) == 1:
+                errors.append({"line": batch[0][0], "message": "Food item violates database constraints"})
+                return 0
+        return sum(FoodItemBulkImport.insert_batch([line], errors) for line in batch)
+
+    @staticmethod
+    def _insert_rows(batch):
+        food_item_table = FoodItem.__table__
+        # The first row is inserted alone to take the write lock and learn
+        # the next free id. SQLite assigns max(id) + 1, so the following ids
+        # are free too and the rest can go in a single executemany.
+        result = db.session.execute(food_item_table.insert(), batch[0][1])
+        first_id = result.inserted_primary_key[0]
+        food_item_rows = []
+        equivalent_rows = []
+        for offset, (line_number, row, equivalents) in enumerate(batch):
+            food_item_id = first_id + offset
+            if offset > 0:
+                food_item_rows.append(dict(row, id=food_item_id))
+            for equivalent in equivalents:
+                equivalent_rows.append(dict(equivalent, food_item_id=food_item_id))
+        if food_item_rows:
+            db.session.execute(food_item_table.insert(), food_item_rows)
+        if equivalent_rows:
+            db.session.execute(FoodItemEquivalent.__table__.insert(), equivalent_rows)
+
+
+class FoodItemSuggestions(Resource):
+    """
+    Lightweight name completion for food item pickers. Served from the
+    in-memory name index, so only the version of the index is read from the
+    database.
+    """
+
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 100
+
+    # One statement reads the version of the name index, and one more
+    # rebuilds it when it is out of date
+    @query_budget(2)
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('prefix', type=str, default="", help='Beginning of the food item name')
+        parser.add_argument('limit', type=str, help='Maximum number of suggestions')
+        args = parser.parse_args()
+
+        limit = FoodItemSuggestions.DEFAULT_LIMIT
+        if args['limit'] is not None:
+            try:
+                limit = int(args['limit'])
+                if limit < 1 or limit > FoodItemSuggestions.MAX_LIMIT:
+                    raise ValueError
+            except ValueError:
+                return MasonBuilder.get_error_response(400,
+                    "Limit must be between 1 and {0}".format(FoodItemSuggestions.MAX_LIMIT), "")
+
+        suggestions = get_food_item_index().suggest(get_name_version(), args['prefix'], limit)
+        body = {
+            "items": [{"id": id, "name": name} for id, name in suggestions]
+        }
+        return Response(dumps(body), 200, mimetype=MASON)
+
+
 class FoodItemResource(Resource):
 
+    @query_budget(3)
     def get(self, food_item_id):
+        stamp = FoodItem.get_version(food_item_id)
+        if stamp is None:
+            return MasonBuilder.get_error_response(404, "Food item not found.",
+            "FoodItem with id {0} not found".format(food_item_id))
+
+        updated_at, equivalent_count, equivalents_updated_at = stamp
+        validators = get_validators(tuple(stamp), max(updated_at, equivalents_updated_at or updated_at))
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            return not_modified
+
         body = FoodItemBuilder()
         body.add_namespace("clicook", "/api/link-relations/")
         food_item = FoodItem.query.filter_by(id=food_item_id).first()
 
-        if food_item is None:
-            return MasonBuilder.get_error_response(404, "Food item not found.",
-            "FoodItem with id {0} not found".format(food_item_id))
-
-        body.add_control("self", api.url_for(FoodItemResource, food_item_id=food_item.id))
+        body.add_control("self", url_for(FoodItemResource, food_item_id=food_item.id))
         body.add_control_edit_food_item(food_item.id)
         body.add_control_delete_food_item(food_item.id)
         body.add_control_add_food_item_equivalent(food_item.id)
-        body.add_control("collection", api.url_for(FoodItemCollection))
+        body.add_static_control("collection", lambda: dict(href=url_for(FoodItemCollection)))
         body.add_control("profile", "/api/profiles/")
         # TODO: Add control for food-items with equivalents
         body["id"] = food_item.id
@@ -137,14 +399,15 @@ class FoodItemResource(Resource):
             item = FoodItemEquivalentBuilder()
             item['unit_type'] = equivalent.unit_type
             item['conversion_factor'] = equivalent.conversion_factor
-            item.add_control("self", api.url_for(FoodItemEquivalentResource,
+            item.add_control("self", url_for(FoodItemEquivalentResource,
                 food_item_id=food_item.id,
                 food_item_equivalent_id=equivalent.id))
             item.add_control('profile', '/api/profiles/')
             items.append(item)
         body["items"] = items
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return add_validators(Response(dumps(body), 200, mimetype=MASON), *validators)
 
+    @query_budget(6)
     def post(self, food_item_id):
         """
         Add food item equivalent
@@ -187,15 +450,18 @@ class FoodItemResource(Resource):
         )
 
         db.session.add(food_item_equivalent)
+        FoodItem.touch(food_item.id)
         db.session.commit()
+        get_substitute_index().invalidate()
         headers = {
-            "Location": api.url_for(FoodItemEquivalentResource,
+            "Location": url_for(FoodItemEquivalentResource,
                 food_item_id=food_item.id,
                 food_item_equivalent_id=food_item_equivalent.id)
         }
         response = Response(None, 201, headers=headers)
         return response
 
+    @query_budget(4)
     def put(self, food_item_id):
         if request.json is None:
             return MasonBuilder.get_error_response(415, "Request content type must be JSON", "")
@@ -206,6 +472,7 @@ class FoodItemResource(Resource):
             return MasonBuilder.get_error_response(404, "Food item not found.",
             "FoodItem with id {0} not found".format(food_item_id))
 
+        old_id = food_item.id
         keys = request.json.keys()
         if 'name' not in keys:
             return MasonBuilder.get_error_response(400, "Incomplete request - missing fields", ["Missing field:name"])
@@ -228,7 +495,7 @@ class FoodItemResource(Resource):
                 raise ValueError
         except ValueError:
             return MasonBuilder.get_error_response(400, "Emissions per kg must be a positive number", "")
-        food_item.emission_per_kg = emissions
+        food_item.set_emission_per_kg(emissions)
 
         if "id" in keys:
             try:
@@ -254,12 +521,15 @@ class FoodItemResource(Resource):
             food_item.domestic = request.json['domestic']
 
         db.session.commit()
+        get_recipe_cache().invalidate_food_item(old_id)
+        get_substitute_index().invalidate()
         headers = {
-            "Location": api.url_for(FoodItemResource, food_item_id=food_item.id)
+            "Location": url_for(FoodItemResource, food_item_id=food_item.id)
         }
         response = Response(None, 204, headers=headers)
         return response
 
+    @query_budget(4)
     def delete(self, food_item_id):
         food_item = FoodItem.query.filter_by(id=food_item_id).first()
         if food_item is None:
@@ -273,10 +543,12 @@ class FoodItemResource(Resource):
 
         db.session.delete(food_item)
         db.session.commit()
+        get_substitute_index().invalidate()
         return Response(None, 204)
 
 
 class FoodItemEquivalentResource(Resource):
+    @query_budget(1)
     def get(self, food_item_id, food_item_equivalent_id):
         body = FoodItemEquivalentBuilder()
         body.add_namespace("clicook", "/api/link-relations/")
@@ -286,7 +558,12 @@ class FoodItemEquivalentResource(Resource):
             return MasonBuilder.get_error_response(404, "Equivalent not found",
             "FoodItemEquivalent with id {0} not found".format(food_item_equivalent_id))
 
-        body.add_control("self", api.url_for(FoodItemEquivalentResource, food_item_id=food_item_equivalent.food_item_id,
+        validators = get_validators((food_item_equivalent.updated_at,), food_item_equivalent.updated_at)
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            return not_modified
+
+        body.add_control("self", url_for(FoodItemEquivalentResource, food_item_id=food_item_equivalent.food_item_id,
         food_item_equivalent_id=food_item_equivalent.id))
         body.add_control_edit_food_item_equivalent(food_item_equivalent.food_item_id, food_item_equivalent.id)
         body.add_control_delete_food_item_equivalent(food_item_equivalent.food_item_id, food_item_equivalent.id)
@@ -297,8 +574,9 @@ class FoodItemEquivalentResource(Resource):
         body["unit_type"] = food_item_equivalent.unit_type
         body["conversion_factor"] = food_item_equivalent.conversion_factor
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return add_validators(Response(dumps(body), 200, mimetype=MASON), *validators)
 
+    @query_budget(5)
     def put(self, food_item_id, food_item_equivalent_id):
         if request.json is None:
             return MasonBuilder.get_error_response(415, "Request content type must be JSON", "")
@@ -318,6 +596,7 @@ class FoodItemEquivalentResource(Resource):
             return MasonBuilder.get_error_response(400, "Unknown unit type",
                 "Unknown unit type {}".format(unit_type))
         food_item_equivalent.unit_type = unit_type
+        old_id = food_item_equivalent.id
 
         conversion_factor = 0
         try:
@@ -326,7 +605,7 @@ class FoodItemEquivalentResource(Resource):
                 raise ValueError
         except ValueError:
             return MasonBuilder.get_error_response(400, "Conversion factor must be a positive number", "")
-        food_item_equivalent.conversion_factor = conversion_factor
+        food_item_equivalent.set_conversion_factor(conversion_factor)
         if "food_item_id" in keys:
             try:
                 new_food_item_id = int(request.json["food_item_id"])
@@ -352,39 +631,73 @@ class FoodItemEquivalentResource(Resource):
             except ValueError:
                 return MasonBuilder.get_error_response(400, "FoodItemEquivalent id must be a positive integer", "")
 
+        FoodItem.touch(food_item_equivalent.food_item_id)
         db.session.commit()
+        get_recipe_cache().invalidate_food_item_equivalent(old_id)
+        get_substitute_index().invalidate()
         headers = {
-            "Location": api.url_for(FoodItemEquivalentResource, food_item_equivalent_id=food_item_equivalent.id, food_item_id=food_item_id)
+            "Location": url_for(FoodItemEquivalentResource, food_item_equivalent_id=food_item_equivalent.id, food_item_id=food_item_id)
         }
         response = Response(None, 204, headers=headers)
         return response
 
+    @query_budget(4)
     def delete(self, food_item_equivalent_id, food_item_id):
         food_item_equivalent = FoodItemEquivalent.query.filter_by(id=food_item_equivalent_id).first()
         if food_item_equivalent is None:
             return MasonBuilder.get_error_response(404, "FoodItemEquivalent not found.",
             "FoodItemEquivalent with id {0} not found".format(food_item_equivalent_id))
+
+        num_ingredient = Ingredient.query.filter_by(food_item_equivalent_id=food_item_equivalent.id).count()
+        if num_ingredient > 0:
+            return MasonBuilder.get_error_response(409, "Cannot delete food item equivalent in use.",
+            "FoodItemEquivalent is used for {0} ingredients".format(num_ingredient))
+
         db.session.delete(food_item_equivalent)
+        FoodItem.touch(food_item_equivalent.food_item_id)
         db.session.commit()
+        get_substitute_index().invalidate()
         return Response(None, 204)
 
 
 class FoodItemBuilder(MasonBuilder):
 
     def add_control_add_food_item(self):
-        self.add_control(
-            "clicook:add-food-item",
-            href=api.url_for(FoodItemCollection),
+        self.add_static_control("clicook:add-food-item", lambda: dict(
+            href=url_for(FoodItemCollection),
             method="POST",
             encoding="json",
             title="Add a new food item",
             schema=FoodItemBuilder.food_item_schema()
-        )
+        ))
+
+    def add_control_search_food_items(self):
+        self.add_static_control("clicook:search-food-items", lambda: dict(
+            href=url_for(FoodItemCollection) + "?q={q}",
+            isHrefTemplate=True,
+            title="Search food items",
+            schema=FoodItemBuilder.food_item_search_schema()
+        ))
+
+    def add_control_suggest_food_items(self):
+        self.add_static_control("clicook:suggest-food-items", lambda: dict(
+            href=url_for(FoodItemSuggestions) + "?prefix={prefix}",
+            isHrefTemplate=True,
+            title="Suggest food item names",
+            schema=FoodItemBuilder.food_item_suggest_schema()
+        ))
+
+    def add_control_food_item_template(self):
+        self.add_static_control("clicook:item", lambda: dict(
+            href=uri_template(FoodItemResource, food_item_id="id"),
+            isHrefTemplate=True,
+            title="Food item by id"
+        ))
 
     def add_control_edit_food_item(self, food_item_id):
         self.add_control(
             "edit",
-            href=api.url_for(FoodItemResource, food_item_id=food_item_id),
+            href=url_for(FoodItemResource, food_item_id=food_item_id),
             method="PUT",
             encoding="json",
             title="Edit an existing food item",
@@ -394,7 +707,7 @@ class FoodItemBuilder(MasonBuilder):
     def add_control_delete_food_item(self, food_item_id):
         self.add_control(
             "clicook:delete",
-            href=api.url_for(FoodItemResource, food_item_id=food_item_id),
+            href=url_for(FoodItemResource, food_item_id=food_item_id),
             method="DELETE",
             title="Delete an existing food item"
         )
@@ -402,7 +715,7 @@ class FoodItemBuilder(MasonBuilder):
     def add_control_add_food_item_equivalent(self, food_item_id):
         self.add_control(
             "clicook:add-food-item-equivalent",
-            href=api.url_for(FoodItemResource, food_item_id=food_item_id),
+            href=url_for(FoodItemResource, food_item_id=food_item_id),
             method="POST",
             encoding="json",
             title="Add a new food item equivalent",
@@ -410,6 +723,7 @@ class FoodItemBuilder(MasonBuilder):
         )
 
     @staticmethod
+    @frozen
     def food_item_schema():
         schema = {
             "type": "object",
@@ -440,6 +754,35 @@ class FoodItemBuilder(MasonBuilder):
         return schema
 
     @staticmethod
+    @frozen
+    def food_item_search_schema():
+        schema = {
+            "type": "object",
+            "required": ["q"]
+        }
+        props = schema["properties"] = {}
+        props["q"] = {
+            "description": "Words to search for in the food item names",
+            "type": "string"
+        }
+        return schema
+
+    @staticmethod
+    @frozen
+    def food_item_suggest_schema():
+        schema = {
+            "type": "object",
+            "required": ["prefix"]
+        }
+        props = schema["properties"] = {}
+        props["prefix"] = {
+            "description": "Beginning of the food item name",
+            "type": "string"
+        }
+        return schema
+
+    @staticmethod
+    @frozen
     def food_item_equivalent_schema():
         schema = {
             "type": "object",
@@ -466,7 +809,7 @@ class FoodItemEquivalentBuilder(MasonBuilder):
     def add_control_edit_food_item_equivalent(self, food_item_id, food_item_equivalent_id):
         self.add_control(
             "edit",
-            href=api.url_for(FoodItemEquivalentResource, food_item_id=food_item_id,
+            href=url_for(FoodItemEquivalentResource, food_item_id=food_item_id,
             food_item_equivalent_id=food_item_equivalent_id),
             method="PUT",
             encoding="json",
@@ -477,7 +820,7 @@ class FoodItemEquivalentBuilder(MasonBuilder):
     def add_control_delete_food_item_equivalent(self, food_item_id, food_item_equivalent_id):
         self.add_control(
             "clicook:delete",
-            href=api.url_for(FoodItemEquivalentResource, food_item_id=food_item_id,
+            href=url_for(FoodItemEquivalentResource, food_item_id=food_item_id,
             food_item_equivalent_id=food_item_equivalent_id),
             method="DELETE",
             title="Delete an existing equivalent",
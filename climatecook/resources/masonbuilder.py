@@ -1,6 +1,66 @@
-import json
+import functools
 
-from flask import Response
+from flask import current_app, Response, stream_with_context
+
+from climatecook.instrumentation import dumps
+
+
+class FrozenDict(dict):
+    """
+    A dict that cannot be changed after it has been created. Being a dict it
+    is serialized by json.dumps like any other, so frozen structures can be
+    shared between the documents of different responses.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("{0} is immutable".format(type(self).__name__))
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+class FrozenList(list):
+    """
+    A list that cannot be changed after it has been created. A list subclass
+    rather than a tuple so that it still validates as a JSON schema array.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("{0} is immutable".format(type(self).__name__))
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+
+
+def freeze(obj):
+    """
+    Returns a deep copy of a JSON compatible structure made of FrozenDicts
+    and FrozenLists.
+    """
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return FrozenList(freeze(value) for value in obj)
+    return obj
+
+
+def frozen(function):
+    """
+    Decorator that memoizes a function without arguments and freezes its
+    result, for schemas and other structures that never change.
+    """
+    @functools.wraps(function)
+    def wrapper():
+        if wrapper.result is None:
+            wrapper.result = freeze(function())
+        return wrapper.result
+    wrapper.result = None
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def _namespace(uri):
+    return FrozenDict(name=uri)
 
 
 class MasonBuilder(dict):
@@ -43,9 +103,7 @@ class MasonBuilder(dict):
         if "@namespaces" not in self:
             self["@namespaces"] = {}
 
-        self["@namespaces"][ns] = {
-            "name": uri
-        }
+        self["@namespaces"][ns] = _namespace(uri)
 
     def add_control(self, ctrl_name, href, **kwargs):
         """
@@ -67,6 +125,61 @@ class MasonBuilder(dict):
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
 
+    def add_static_control(self, ctrl_name, build):
+        """
+        Adds a control that is identical in every document of this builder
+        class, e.g. a link to a collection or a POST control with its schema.
+        The control is built once per application by calling build and the
+        frozen result is shared by all the documents after that.
+
+        : param str ctrl_name: name of the control (including namespace if any)
+        : param build: callable returning the control properties as a dict,
+            including href
+        """
+        controls = current_app.extensions.setdefault("mason_static_controls", {})
+        key = (type(self), ctrl_name)
+        control = controls.get(key)
+        if control is None:
+            control = controls.setdefault(key, freeze(build()))
+
+        if "@controls" not in self:
+            self["@controls"] = {}
+
+        self["@controls"][ctrl_name] = control
+
+    def stream(self, items, status=200, mimetype="application/vnd.mason+json", batch_size=100):
+        """
+        Returns a streamed response of the object with an "items" array that
+        is filled from an iterable while the response is being sent. The
+        items are serialized and written out batch_size at a time, so with a
+        lazy iterable only one batch of items is in memory at once. The
+        output is the same as json.dumps of the object with "items" added
+        last.
+
+        : param items: iterable of the item objects, e.g. a generator
+        : param int status: HTTP status code
+        : param str mimetype: media type of the response
+        : param int batch_size: number of items serialized per chunk
+        """
+        head = dumps(self)[:-1] + (", " if self else "") + '"items": ['
+        return Response(stream_with_context(MasonBuilder._iter_json(head, items, batch_size)), status,
+            mimetype=mimetype)
+
+    @staticmethod
+    def _iter_json(head, items, batch_size):
+        yield head
+        separator = ""
+        batch = []
+        for item in items:
+            batch.append(dumps(item))
+            if len(batch) >= batch_size:
+                yield separator + ", ".join(batch)
+                separator = ", "
+                batch = []
+        if batch:
+            yield separator + ", ".join(batch)
+        yield "]}"
+
     @staticmethod
     def get_error_response(status: int, message, details):
         """
@@ -81,4 +194,4 @@ class MasonBuilder(dict):
             details = ""
         error.add_error(title=message, details=details)
         error.add_control("profile", "/api/profiles/")
-        return Response(json.dumps(error), status, mimetype="application/vnd.mason+json")
+        return Response(dumps(error), status, mimetype="application/vnd.mason+json")
@@ -0,0 +1,128 @@
+import base64
+import binascii
+import json
+
+from flask_restful import reqparse
+from sqlalchemy import tuple_
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class PaginationError(ValueError):
+    """
+    Raised when the paging parameters of a request are invalid.
+    """
+
+
+def encode_cursor(name, id):
+    """
+    Encodes the sort key of a collection item into an opaque cursor string.
+
+    : param str name: name of the item
+    : param int id: id of the item
+    """
+    raw = json.dumps([name, id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created with encode_cursor back into a (name, id) tuple.
+
+    : param str cursor: the opaque cursor string
+    : raises PaginationError: if the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        name, id = json.loads(raw.decode("utf-8"))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise PaginationError("Invalid cursor")
+    if not isinstance(name, str) or not isinstance(id, int):
+        raise PaginationError("Invalid cursor")
+    return name, id
+
+
+def get_page_args():
+    """
+    Parses the paging query parameters limit, after and before from the
+    current request.
+
+    : return: tuple of (limit, after, before) where after and before are
+        decoded (name, id) tuples or None
+    : raises PaginationError: if any of the parameters is invalid
+    """
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=str, help='Maximum number of items in the page')
+    parser.add_argument('after', type=str, help='Cursor of the item preceding the page')
+    parser.add_argument('before', type=str, help='Cursor of the item following the page')
+    args = parser.parse_args()
+
+    limit = DEFAULT_LIMIT
+    if args['limit'] is not None:
+        try:
+            limit = int(args['limit'])
+        except ValueError:
+            raise PaginationError("Limit must be an integer")
+        if limit < 1 or limit > MAX_LIMIT:
+            raise PaginationError("Limit must be between 1 and {0}".format(MAX_LIMIT))
+
+    if args['after'] is not None and args['before'] is not None:
+        raise PaginationError("Only one of after and before can be given")
+    after = decode_cursor(args['after']) if args['after'] is not None else None
+    before = decode_cursor(args['before']) if args['before'] is not None else None
+    return limit, after, before
+
+
+def paginate(query, name_column, id_column, limit, after=None, before=None):
+    """
+    Fetches one page of a collection ordered by (name, id) using keyset
+    pagination. Only limit + 1 rows are read from the index position given by
+    the cursor, so the cost of a page does not depend on how deep into the
+    collection it is.
+
+    : param query: the query for the collection
+    : param name_column: column holding the name of the items
+    : param id_column: column holding the id of the items
+    : param int limit: maximum number of items in the page
+    : param tuple after: (name, id) of the item preceding the page
+    : param tuple before: (name, id) of the item following the page
+    : return: tuple of (rows, has_prev, has_next)
+    """
+    key = tuple_(name_column, id_column)
+    if before is not None:
+        rows = query.filter(key < tuple_(*before)) \
+            .order_by(name_column.desc(), id_column.desc()) \
+            .limit(limit + 1).all()
+        has_prev = len(rows) > limit
+        return rows[:limit][::-1], has_prev, True
+
+    if after is not None:
+        query = query.filter(key > tuple_(*after))
+    rows = query.order_by(name_column, id_column).limit(limit + 1).all()
+    has_next = len(rows) > limit
+    return rows[:limit], after is not None, has_next
+
+
+def add_page_controls(body, resource, page, limit, after=None, before=None, **params):
+    """
+    Adds the Mason "prev" and "next" controls of a collection page to body.
+    The controls carry the opaque cursor of the first or last item of the
+    page and any extra query parameters, e.g. the name filter.
+
+    : param MasonBuilder body: the collection document
+    : param resource: the collection resource class
+    : param tuple page: the (rows, has_prev, has_next) tuple from paginate
+    : param int limit: page size to carry over to the linked pages
+    """
+    from climatecook.api import api
+
+    rows, has_prev, has_next = page
+    if has_prev:
+        cursor = encode_cursor(rows[0].name, rows[0].id) if rows else encode_cursor(*after)
+        body.add_control("prev", api.url_for(resource, before=cursor, limit=limit, **params),
+            title="Previous page")
+    if has_next:
+        cursor = encode_cursor(rows[-1].name, rows[-1].id) if rows else encode_cursor(*before)
+        body.add_control("next", api.url_for(resource, after=cursor, limit=limit, **params),
+            title="Next page")
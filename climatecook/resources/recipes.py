@@ -1,54 +1,90 @@
-import json
+import csv
+import io
+import itertools
 
-from flask import request, Response
+from flask import request, Response, stream_with_context
 from flask_restful import Resource, reqparse
 
+from sqlalchemy import and_, exists, false
+from sqlalchemy.orm import joinedload
+
 from climatecook import db
-from climatecook.api import api, MASON
-from climatecook.resources.masonbuilder import MasonBuilder
+from climatecook.api import MASON, NDJSON
+from climatecook.instrumentation import dumps
+from climatecook.query_budget import query_budget
+from climatecook.metrics import count_cache_lookup
+from climatecook.resources.compact import is_compact, uri_template
+from climatecook.resources.conditional import add_validators, get_not_modified_response, get_validators
+from climatecook.resources.masonbuilder import MasonBuilder, frozen
+from climatecook.resources.pagination import PaginationError, add_page_controls, get_page_args, paginate
+from climatecook.resources.urls import url_for
 from climatecook.models import Recipe, Ingredient, FoodItem, FoodItemEquivalent
+from climatecook.models import get_collection_version, startswith_nocase
+from climatecook.recipe_cache import get_recipe_cache
+from climatecook.substitute_index import FLAGS, get_substitute_index
+from climatecook.substitute_index import get_version as get_substitute_version
 
 
 class RecipeCollection(Resource):
 
+    @query_budget(2)
     def get(self):
+        compact = is_compact()
+        version, updated_at = get_collection_version(Recipe.__tablename__)
+        validators = get_validators((version, compact), updated_at)
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            not_modified.vary.add("Accept")
+            return not_modified
+
         body = RecipeBuilder()
         body.add_namespace("clicook", "/api/link-relations/")
-        body.add_control("self", api.url_for(RecipeCollection))
+        body.add_control("self", url_for(RecipeCollection))
         from climatecook.resources.food_items import FoodItemCollection
-        body.add_control("clicook:food-items-all", api.url_for(FoodItemCollection), title="Food items")
+        body.add_static_control("clicook:food-items-all", lambda: dict(
+            href=url_for(FoodItemCollection), title="Food items"))
         body.add_control_add_recipe()
 
-        items = []
         parser = reqparse.RequestParser()
         parser.add_argument('name', type=str, help='Name of the recipe')
         args = parser.parse_args()
+        try:
+            limit, after, before = get_page_args()
+        except PaginationError as e:
+            return MasonBuilder.get_error_response(400, str(e), "")
+
+        query = db.session.query(Recipe.id, Recipe.name, Recipe.emissions_total)
         if 'name' in args and args['name'] is not None:
             name = args['name']
-            recipes = Recipe.query.filter(Recipe.name.startswith(name)).order_by(Recipe.name).all()
+            query = query.filter(startswith_nocase(Recipe.name, name))
+        page = paginate(query, Recipe.name, Recipe.id, limit, after, before)
+        add_page_controls(body, RecipeCollection, page, limit, after, before, name=args['name'],
+            compact=request.args.get("compact"))
+        recipes = page[0]
+
+        def build_items():
+            for recipe_id, recipe_name, recipe_emissions in recipes:
+                item = RecipeBuilder()
+                item['id'] = recipe_id
+                item['name'] = recipe_name
+                item.add_control("self", url_for(RecipeItem, recipe_id=recipe_id))
+                item.add_control("profile", "/api/profiles/")
+                item['emissions_total'] = recipe_emissions
+                yield item
+
+        def build_compact_items():
+            for recipe_id, recipe_name, recipe_emissions in recipes:
+                yield {"id": recipe_id, "name": recipe_name, "emissions_total": recipe_emissions}
+
+        if compact:
+            body.add_control_recipe_template()
+            response = body.stream(build_compact_items(), mimetype=MASON)
         else:
-            recipes = Recipe.query.order_by(Recipe.name).all()
-
-        for recipe in recipes:
-            item = RecipeBuilder()
-            item['id'] = recipe.id
-            item['name'] = recipe.name
-            item.add_control("self", api.url_for(RecipeItem, recipe_id=recipe.id))
-            item.add_control("profile", "/api/profiles/")
-            items.append(item)
-
-            ingredients = Ingredient.query.filter_by(recipe_id=recipe.id).all()
-            emissions_total = 0
-            for ingredient in ingredients:
-                emissions_total += ingredient.food_item.emission_per_kg \
-                    * ingredient.quantity \
-                    * ingredient.food_item_equivalent.conversion_factor
-            item['emissions_total'] = emissions_total
-
-        body["items"] = items
-
-        return Response(json.dumps(body), 200, mimetype=MASON)
+            response = body.stream(build_items(), mimetype=MASON)
+        response.vary.add("Accept")
+        return add_validators(response, *validators)
 
+    @query_budget(2)
     def post(self):
         if request.json is None:
             return MasonBuilder.get_error_response(415, "Request content type must be JSON", "")
@@ -69,52 +105,285 @@ class RecipeCollection(Resource):
         db.session.add(recipe)
         db.session.commit()
         headers = {
-            "Location": api.url_for(RecipeItem, recipe_id=recipe.id)
+            "Location": url_for(RecipeItem, recipe_id=recipe.id)
         }
         response = Response(status=201, headers=headers)
         return response
 
 
-class RecipeItem(Resource):
+class RecipeExport(Resource):
+    """
+    Streams every recipe with its ingredients and emissions total, as NDJSON
+    with one recipe per line or as CSV with one ingredient per row. The rows
+    are read from a single ordered query in batches of EXPORT_BATCH_SIZE and
+    written out as they come, so memory use doesn't grow with the catalog.
+    """
+
+    EXPORT_BATCH_SIZE = 1000
+    CSV_FIELDS = ["recipe_id", "recipe_name", "emissions_total", "ingredient_id", "food_item_id",
+        "food_item_name", "food_item_equivalent_id", "unit_type", "quantity", "emissions"]
+
+    @query_budget(1)
+    def get(self):
+        # NDJSON is the default when the client doesn't send an Accept header
+        mimetype = NDJSON
+        if request.accept_mimetypes:
+            mimetype = request.accept_mimetypes.best_match([NDJSON, "text/csv"])
+        if mimetype is None:
+            return MasonBuilder.get_error_response(406, "Export is only available as NDJSON or CSV",
+                "Supported media types are {0} and text/csv".format(NDJSON))
+
+        if mimetype == NDJSON:
+            lines = RecipeExport._ndjson_lines(RecipeExport._recipes())
+        else:
+            lines = RecipeExport._csv_lines(RecipeExport._recipes())
+        headers = {"Content-Disposition": "attachment; filename=recipes.{0}".format(
+            "ndjson" if mimetype == NDJSON else "csv")}
+        return Response(stream_with_context(lines), 200, mimetype=mimetype, headers=headers)
+
+    @staticmethod
+    def _rows():
+        query = db.session.query(
+            Recipe.id, Recipe.name, Recipe.emissions_total,
+            Ingredient.id, Ingredient.food_item_id, FoodItem.name,
+            Ingredient.food_item_equivalent_id, FoodItemEquivalent.unit_type, Ingredient.quantity,
+            FoodItem.emission_per_kg * Ingredient.quantity * FoodItemEquivalent.conversion_factor
+        ) \
+            .outerjoin(Ingredient, Ingredient.recipe_id == Recipe.id) \
+            .outerjoin(FoodItem, FoodItem.id == Ingredient.food_item_id) \
+            .outerjoin(FoodItemEquivalent, FoodItemEquivalent.id == Ingredient.food_item_equivalent_id) \
+            .order_by(Recipe.id, Ingredient.id)
+        return query.yield_per(RecipeExport.EXPORT_BATCH_SIZE)
+
+    @staticmethod
+    def _recipes():
+        """
+        Groups the joined rows into one dict per recipe. The rows are ordered
+        by recipe, so only the current recipe is held in memory.
+        """
+        for (recipe_id, name, emissions_total), rows in itertools.groupby(RecipeExport._rows(), lambda r: r[:3]):
+            ingredients = []
+            for row in rows:
+                if row[3] is None:
+                    continue
+                ingredients.append({
+                    "id": row[3],
+                    "food_item_id": row[4],
+                    "food_item_name": row[5],
+                    "food_item_equivalent_id": row[6],
+                    "unit_type": row[7],
+                    "quantity": row[8],
+                    "emissions": row[9]
+                })
+            yield {
+                "id": recipe_id,
+                "name": name,
+                "emissions_total": emissions_total,
+                "ingredients": ingredients
+            }
+
+    @staticmethod
+    def _ndjson_lines(recipes):
+        for recipe in recipes:
+            yield dumps(recipe) + "\n"
+
+    @staticmethod
+    def _csv_lines(recipes):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(RecipeExport.CSV_FIELDS)
+        for recipe in recipes:
+            # A recipe without ingredients still gets a row
+            for ingredient in recipe["ingredients"] or [{}]:
+                writer.writerow([recipe["id"], recipe["name"], recipe["emissions_total"]] + [
+                    ingredient.get(key) for key in ("id", "food_item_id", "food_item_name",
+                        "food_item_equivalent_id", "unit_type", "quantity", "emissions")])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+class RecipeRanking(Resource):
+    """
+    The k recipes with the lowest (order=asc, the default) or highest
+    (order=desc) emissions total, optionally only vegan recipes, recipes
+    under max_emissions or recipes whose name starts with name. Recipes
+    without ingredients are left out. The stored totals are read in order
+    from the emissions index and the scan stops after k matches, so the
+    cost depends on k and the selectivity of the filters, not on the size
+    of the catalog.
+    """
+
+    DEFAULT_K = 10
+    MAX_K = 100
+    ORDERS = ("asc", "desc")
+    FLAG_VALUES = {"1": True, "true": True, "0": False, "false": False}
+
+    @query_budget(4)
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('order', type=str, default="asc", help='asc for the lowest emissions first')
+        parser.add_argument('k', type=str, help='Number of recipes')
+        parser.add_argument('vegan', type=str, help='Only recipes whose food items are all vegan')
+        parser.add_argument('max_emissions', type=str, help='Highest emissions total to include')
+        parser.add_argument('name', type=str, help='Beginning of the recipe name')
+        args = parser.parse_args()
+
+        order = args['order'].lower()
+        if order not in RecipeRanking.ORDERS:
+            return MasonBuilder.get_error_response(400, "Order must be asc or desc", "")
+        k = RecipeRanking.DEFAULT_K
+        if args['k'] is not None:
+            try:
+                k = int(args['k'])
+                if k < 1 or k > RecipeRanking.MAX_K:
+                    raise ValueError
+            except ValueError:
+                return MasonBuilder.get_error_response(400,
+                    "k must be between 1 and {0}".format(RecipeRanking.MAX_K), "")
+        vegan = RecipeRanking.FLAG_VALUES.get((args['vegan'] or "0").lower())
+        if vegan is None:
+            return MasonBuilder.get_error_response(400, "vegan must be true or false", "")
+        max_emissions = None
+        if args['max_emissions'] is not None:
+            try:
+                max_emissions = float(args['max_emissions'])
+                if max_emissions != max_emissions:
+                    raise ValueError
+            except ValueError:
+                return MasonBuilder.get_error_response(400, "max_emissions must be a number", "")
+
+        # The filters read the ingredients and the food items, and an
+        # ingredient without emissions doesn't change the recipe, so their
+        # versions are part of the validators too
+        versions = [get_collection_version(model.__tablename__) for model in (Recipe, Ingredient, FoodItem)]
+        updated_at = max(filter(None, (updated_at for _, updated_at in versions)), default=None)
+        validators = get_validators(tuple(version for version, _ in versions), updated_at)
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            return not_modified
+
+        query = db.session.query(Recipe.id, Recipe.name, Recipe.emissions_total) \
+            .filter(exists().where(Ingredient.recipe_id == Recipe.id))
+        if vegan:
+            query = query.filter(~exists().where(and_(
+                Ingredient.recipe_id == Recipe.id,
+                Ingredient.food_item_id == FoodItem.id,
+                FoodItem.vegan == false()
+            )))
+        if max_emissions is not None:
+            query = query.filter(Recipe.emissions_total <= max_emissions)
+        if args['name'] is not None:
+            query = query.filter(startswith_nocase(Recipe.name, args['name']))
+        if order == "asc":
+            query = query.order_by(Recipe.emissions_total, Recipe.id)
+        else:
+            query = query.order_by(Recipe.emissions_total.desc(), Recipe.id.desc())
 
-    def get(self, recipe_id):
         body = RecipeBuilder()
         body.add_namespace("clicook", "/api/link-relations/")
-        recipe = Recipe.query.filter_by(id=recipe_id).first()
+        body.add_control("self", url_for(RecipeRanking))
+        body.add_static_control("collection", lambda: dict(href=url_for(RecipeCollection)))
+        body.add_control("profile", "/api/profiles/")
+        items = []
+        for recipe_id, recipe_name, recipe_emissions in query.limit(k):
+            item = RecipeBuilder()
+            item['id'] = recipe_id
+            item['name'] = recipe_name
+            item['emissions_total'] = recipe_emissions
+            item.add_control("self", url_for(RecipeItem, recipe_id=recipe_id))
+            item.add_control("profile", "/api/profiles/")
+            items.append(item)
+        body["items"] = items
+        return add_validators(Response(dumps(body), 200, mimetype=MASON), *validators)
 
-        if recipe is None:
+
+class RecipeItem(Resource):
+
+    @query_budget(2)
+    def get(self, recipe_id):
+        stamp = Recipe.get_version(recipe_id)
+        if stamp is None:
             return MasonBuilder.get_error_response(404, "Recipe not found.",
             "Recipe with id {0} not found".format(recipe_id))
 
-        body.add_control("self", api.url_for(RecipeItem, recipe_id=recipe.id))
+        id, updated_at, ingredient_count, ingredients_updated_at = stamp
+        validators = get_validators(tuple(stamp), max(updated_at, ingredients_updated_at or updated_at))
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            return not_modified
+
+        cache = get_recipe_cache()
+        document = cache.get(id, stamp)
+        count_cache_lookup("recipe", document is not None)
+        if document is None:
+            document, food_item_ids, equivalent_ids = RecipeItem._build_document(id)
+            cache.put(id, stamp, document, food_item_ids, equivalent_ids)
+
+        return add_validators(Response(document, 200, mimetype=MASON), *validators)
+
+    @staticmethod
+    def _build_document(recipe_id):
+        """
+        Builds and serializes the document of an existing recipe.
+
+        : return: tuple of (document, ids of the food items used, ids of the
+            equivalents used)
+        """
+        body = RecipeBuilder()
+        body.add_namespace("clicook", "/api/link-relations/")
+        # One statement loads the recipe with its ingredients, their food items
+        # and equivalents
+        recipe = Recipe.query.options(
+            joinedload(Recipe.ingredients).joinedload(Ingredient.food_item),
+            joinedload(Recipe.ingredients).joinedload(Ingredient.food_item_equivalent)
+        ).filter_by(id=recipe_id).one()
+
+        body.add_control("self", url_for(RecipeItem, recipe_id=recipe.id))
         body.add_control_edit_recipe(recipe.id)
         body.add_control_delete_recipe(recipe.id)
         body.add_control_add_ingredient(recipe.id)
-        body.add_control("collection", api.url_for(RecipeCollection))
+        body.add_static_control("collection", lambda: dict(href=url_for(RecipeCollection)))
         body.add_control("profile", "/api/profiles/")
         body["name"] = recipe.name
         body["id"] = recipe.id
 
         items = []
-        body["emissions_total"] = 0.0
-        ingredients = Ingredient.query.filter_by(recipe_id=recipe_id).all()
-        for ingredient in ingredients:
+        body["emissions_total"] = recipe.emissions_total
+        ingredients = sorted(recipe.ingredients, key=lambda ingredient: ingredient.id)
+        emissions = [RecipeItem._get_emissions(ingredient) for ingredient in ingredients]
+        total = sum(emissions)
+        for ingredient, ingredient_emissions in zip(ingredients, emissions):
             item = IngredientBuilder()
             item["food_item_id"] = ingredient.food_item_id
             item["recipe_id"] = ingredient.recipe_id
             item["food_item_equivalent_id"] = ingredient.food_item_equivalent_id
             item["quantity"] = ingredient.quantity
-            body["emissions_total"] += ingredient.food_item.emission_per_kg \
-                * ingredient.quantity \
-                * ingredient.food_item_equivalent.conversion_factor
-            item.add_control("self", api.url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient.id))
+            item["emissions"] = ingredient_emissions
+            item["emissions_share"] = ingredient_emissions / total if total else 0.0
+            item.add_control("self", url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient.id))
             item.add_control("profile", "/api/profiles/")
             items.append(item)
 
         body["items"] = items
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        food_item_ids = [ingredient.food_item_id for ingredient in ingredients]
+        equivalent_ids = [ingredient.food_item_equivalent_id for ingredient in ingredients]
+        return dumps(body), food_item_ids, equivalent_ids
+
+    @staticmethod
+    def _get_emissions(ingredient):
+        """
+        Emissions of an ingredient loaded with its food item and equivalent.
+        Like Ingredient.get_emissions, an ingredient whose food item or
+        equivalent has been deleted has no emissions.
+        """
+        if ingredient.food_item is None or ingredient.food_item_equivalent is None:
+            return 0.0
+        return ingredient.food_item.emission_per_kg * ingredient.quantity \
+            * ingredient.food_item_equivalent.conversion_factor
 
+    @query_budget(3)
     def put(self, recipe_id):
         if request.json is None:
             return MasonBuilder.get_error_response(415, "Request content type must be JSON", "")
@@ -136,6 +405,7 @@ class RecipeItem(Resource):
             return MasonBuilder.get_error_response(400, "Name is too long", "")
         recipe.name = name
 
+        old_id = recipe.id
         new_id = request.json['id']
         if new_id is not None:
             if new_id != recipe.id and Recipe.query.filter_by(id=new_id).first() is not None:
@@ -147,12 +417,14 @@ class RecipeItem(Resource):
             recipe.id = new_id
 
         db.session.commit()
+        get_recipe_cache().invalidate_recipe(old_id, recipe.id)
         headers = {
-            "Location": api.url_for(RecipeItem, recipe_id=recipe.id)
+            "Location": url_for(RecipeItem, recipe_id=recipe.id)
         }
         response = Response(None, 204, headers=headers)
         return response
 
+    @query_budget(4)
     def delete(self, recipe_id):
         """
         Delete recipe
@@ -162,10 +434,13 @@ class RecipeItem(Resource):
             return MasonBuilder.get_error_response(404, "Recipe not found.",
             "Recipe with id {0} not found".format(recipe_id))
 
+        old_id = recipe.id
         db.session.delete(recipe)
         db.session.commit()
+        get_recipe_cache().invalidate_recipe(old_id)
         return Response(None, 204)
 
+    @query_budget(7)
     def post(self, recipe_id):
         """
         Add new ingredient to recipe
@@ -213,9 +488,11 @@ class RecipeItem(Resource):
         )
 
         db.session.add(ingredient)
+        Recipe.add_emissions(recipe.id, food_item.emission_per_kg * quantity * food_item_equivalent.conversion_factor)
         db.session.commit()
+        get_recipe_cache().invalidate_recipe(recipe.id)
         headers = {
-            "Location": api.url_for(IngredientItem,
+            "Location": url_for(IngredientItem,
                 recipe_id=recipe.id,
                 ingredient_id=ingredient.id)
         }
@@ -225,6 +502,7 @@ class RecipeItem(Resource):
 
 class IngredientItem(Resource):
 
+    @query_budget(1)
     def get(self, recipe_id, ingredient_id):
         body = IngredientBuilder()
         body.add_namespace("clicook", "/api/link-relations/")
@@ -234,9 +512,16 @@ class IngredientItem(Resource):
             return MasonBuilder.get_error_response(404, "Ingredient not found",
             "Ingredient with id {0} not found".format(ingredient_id))
 
-        body.add_control("self", api.url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id))
+        validators = get_validators((ingredient.updated_at,), ingredient.updated_at)
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            return not_modified
+
+        body.add_control("self", url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id))
         body.add_control_edit_ingredient(ingredient.recipe_id, ingredient.id)
         body.add_control_delete_ingredient(ingredient.recipe_id, ingredient.id)
+        body.add_control("clicook:substitutes", url_for(IngredientSubstitutes, recipe_id=ingredient.recipe_id,
+            ingredient_id=ingredient.id))
         body.add_control("profile", "/api/profiles/")
 
         body["id"] = ingredient.id
@@ -245,8 +530,9 @@ class IngredientItem(Resource):
         body["food_item_equivalent_id"] = ingredient.food_item_equivalent_id
         body["quantity"] = ingredient.quantity
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return add_validators(Response(dumps(body), 200, mimetype=MASON), *validators)
 
+    @query_budget(9)
     def put(self, ingredient_id, recipe_id):
         if request.json is None:
             return MasonBuilder.get_error_response(415, "Request content type must be JSON", "")
@@ -261,6 +547,9 @@ class IngredientItem(Resource):
         if not set(["recipe_id", "food_item_id", "food_item_equivalent_id", "quantity"]).issubset(keys):
             return MasonBuilder.get_error_response(400, "Incomplete request - missing fields", "Missing fields")
 
+        old_recipe_id = ingredient.recipe_id
+        old_emissions = ingredient.get_emissions()
+
         new_id = request.json['id']
         if new_id is not None:
             if new_id != ingredient.id and Ingredient.query.filter_by(id=new_id).first() is not None:
@@ -297,40 +586,141 @@ class IngredientItem(Resource):
             return MasonBuilder.get_error_response(400, "Quantity must be a positive number", "")
         ingredient.quantity = quantity
 
+        Recipe.add_emissions(old_recipe_id, -old_emissions)
+        Recipe.add_emissions(ingredient.recipe_id, ingredient.get_emissions())
         db.session.commit()
+        get_recipe_cache().invalidate_recipe(old_recipe_id, ingredient.recipe_id)
         headers = {
-            "Location": api.url_for(IngredientItem, recipe_id=ingredient.recipe_id, ingredient_id=ingredient.id)
+            "Location": url_for(IngredientItem, recipe_id=ingredient.recipe_id, ingredient_id=ingredient.id)
         }
         response = Response(None, 204, headers=headers)
         return response
 
+    @query_budget(5)
     def delete(self, ingredient_id, recipe_id):
         ingredient = Ingredient.query.filter_by(id=ingredient_id).first()
         if ingredient is None:
             return MasonBuilder.get_error_response(404, "Ingredient not found",
             "Ingredient with id {0} not found".format(ingredient_id))
 
+        old_recipe_id = ingredient.recipe_id
+        Recipe.add_emissions(ingredient.recipe_id, -ingredient.get_emissions())
         db.session.delete(ingredient)
         db.session.commit()
+        get_recipe_cache().invalidate_recipe(old_recipe_id)
         return Response(None, 204)
 
 
+class IngredientSubstitutes(Resource):
+    """
+    Food items that can replace an ingredient with lower emissions: they have
+    an equivalent of the same unit type, so the same quantity can be used,
+    and one unit of it emits less. The vegan, organic and domestic flags
+    limit the substitutes to food items that have them. Every substitute
+    shows the emissions saved and the emissions total of the recipe after
+    the substitution. Served from the in-memory substitute index, so only
+    the ingredient and the version of the index are read from the database.
+    """
+
+    DEFAULT_LIMIT = 10
+    MAX_LIMIT = 100
+    FLAG_VALUES = {"1": True, "true": True, "0": False, "false": False}
+
+    # One statement reads the version of the substitute index, and one more
+    # rebuilds it when it is out of date
+    @query_budget(3)
+    def get(self, recipe_id, ingredient_id):
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=str, help='Maximum number of substitutes')
+        for flag in FLAGS:
+            parser.add_argument(flag, type=str, help='Only {0} food items'.format(flag))
+        args = parser.parse_args()
+
+        limit = IngredientSubstitutes.DEFAULT_LIMIT
+        if args['limit'] is not None:
+            try:
+                limit = int(args['limit'])
+                if limit < 1 or limit > IngredientSubstitutes.MAX_LIMIT:
+                    raise ValueError
+            except ValueError:
+                return MasonBuilder.get_error_response(400,
+                    "Limit must be between 1 and {0}".format(IngredientSubstitutes.MAX_LIMIT), "")
+        required = []
+        for flag in FLAGS:
+            value = IngredientSubstitutes.FLAG_VALUES.get((args[flag] or "0").lower())
+            if value is None:
+                return MasonBuilder.get_error_response(400, "{0} must be true or false".format(flag), "")
+            if value:
+                required.append(flag)
+
+        row = db.session.query(Ingredient.quantity, Ingredient.food_item_id, FoodItemEquivalent.unit_type,
+                FoodItemEquivalent.conversion_factor, FoodItem.emission_per_kg, Recipe.emissions_total) \
+            .join(FoodItemEquivalent, FoodItemEquivalent.id == Ingredient.food_item_equivalent_id) \
+            .join(FoodItem, FoodItem.id == Ingredient.food_item_id) \
+            .join(Recipe, Recipe.id == Ingredient.recipe_id) \
+            .filter(Ingredient.id == ingredient_id, Ingredient.recipe_id == recipe_id) \
+            .first()
+        if row is None:
+            return MasonBuilder.get_error_response(404, "Ingredient not found",
+            "Ingredient with id {0} not found in recipe {1}".format(ingredient_id, recipe_id))
+        quantity, food_item_id, unit_type, conversion_factor, emission_per_kg, emissions_total = row
+        emissions = emission_per_kg * quantity * conversion_factor
+
+        body = MasonBuilder()
+        body.add_namespace("clicook", "/api/link-relations/")
+        body.add_control("self", url_for(IngredientSubstitutes, recipe_id=recipe_id, ingredient_id=ingredient_id))
+        body.add_control("up", url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id))
+        body.add_control("profile", "/api/profiles/")
+        body["food_item_id"] = food_item_id
+        body["unit_type"] = unit_type
+        body["emissions"] = emissions
+
+        from climatecook.resources.food_items import FoodItemResource
+        items = []
+        substitutes = get_substitute_index().lower(get_substitute_version(), unit_type,
+            emission_per_kg * conversion_factor, limit, required)
+        for unit_emissions, substitute_id, equivalent_id, name, substitute_emission_per_kg, flags in substitutes:
+            substitute_emissions = unit_emissions * quantity
+            saved = emissions - substitute_emissions
+            item = MasonBuilder()
+            item["food_item_id"] = substitute_id
+            item["food_item_equivalent_id"] = equivalent_id
+            item["name"] = name
+            item["emission_per_kg"] = substitute_emission_per_kg
+            for flag in FLAGS:
+                item[flag] = flag in flags
+            item["emissions"] = substitute_emissions
+            item["emissions_saved"] = saved
+            item["recipe_emissions_total"] = emissions_total - saved
+            item.add_control("self", url_for(FoodItemResource, food_item_id=substitute_id))
+            item.add_control("profile", "/api/profiles/")
+            items.append(item)
+        body["items"] = items
+        return Response(dumps(body), 200, mimetype=MASON)
+
+
 class RecipeBuilder(MasonBuilder):
 
     def add_control_add_recipe(self):
-        self.add_control(
-            "clicook:add-recipe",
-            href=api.url_for(RecipeCollection),
+        self.add_static_control("clicook:add-recipe", lambda: dict(
+            href=url_for(RecipeCollection),
             method="POST",
             encoding="json",
             title="Add a new recipe",
             schema=RecipeBuilder.recipe_schema()
-        )
+        ))
+
+    def add_control_recipe_template(self):
+        self.add_static_control("clicook:item", lambda: dict(
+            href=uri_template(RecipeItem, recipe_id="id"),
+            isHrefTemplate=True,
+            title="Recipe by id"
+        ))
 
     def add_control_edit_recipe(self, recipe_id):
         self.add_control(
             "edit",
-            href=api.url_for(RecipeItem, recipe_id=recipe_id),
+            href=url_for(RecipeItem, recipe_id=recipe_id),
             method="PUT",
             encoding="json",
             title="Edit an existing recipe",
@@ -340,7 +730,7 @@ class RecipeBuilder(MasonBuilder):
     def add_control_delete_recipe(self, recipe_id):
         self.add_control(
             "clicook:delete",
-            href=api.url_for(RecipeItem, recipe_id=recipe_id),
+            href=url_for(RecipeItem, recipe_id=recipe_id),
             method="DELETE",
             title="Delete an existing recipe"
         )
@@ -348,7 +738,7 @@ class RecipeBuilder(MasonBuilder):
     def add_control_add_ingredient(self, recipe_id):
         self.add_control(
             "clicook:add-ingredient",
-            href=api.url_for(RecipeItem, recipe_id=recipe_id),
+            href=url_for(RecipeItem, recipe_id=recipe_id),
             method="POST",
             encoding="json",
             title="Add a new ingredient",
@@ -356,6 +746,7 @@ class RecipeBuilder(MasonBuilder):
         )
 
     @staticmethod
+    @frozen
     def recipe_schema():
         schema = {
             "type": "object",
@@ -375,7 +766,7 @@ class IngredientBuilder(MasonBuilder):
     def add_control_edit_ingredient(self, recipe_id, ingredient_id):
         self.add_control(
             "edit",
-            href=api.url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id),
+            href=url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id),
             method="PUT",
             encoding="json",
             title="Edit an ingredient",
@@ -385,12 +776,13 @@ class IngredientBuilder(MasonBuilder):
     def add_control_delete_ingredient(self, recipe_id, ingredient_id):
         self.add_control(
             "clicook:delete",
-            href=api.url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id),
+            href=url_for(IngredientItem, recipe_id=recipe_id, ingredient_id=ingredient_id),
             method="DELETE",
             title="Delete an ingredient",
         )
 
     @staticmethod
+    @frozen
     def ingredient_schema():
         schema = {
             "type": "object",
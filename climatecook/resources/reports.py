@@ -0,0 +1,48 @@
+from flask import Response
+from flask_restful import Resource
+
+from climatecook.analytics import emissions_report, get_report_cache, get_version, load_columns
+from climatecook.api import MASON
+from climatecook.instrumentation import dumps
+from climatecook.query_budget import query_budget
+from climatecook.resources.compact import uri_template
+from climatecook.resources.conditional import add_validators, get_not_modified_response, get_validators
+from climatecook.resources.masonbuilder import MasonBuilder
+from climatecook.resources.urls import url_for
+
+
+class EmissionsReport(Resource):
+    """
+    Emissions statistics of the whole catalog: the distribution of the
+    recipe totals, vegan and non-vegan means, the distribution of the
+    emissions per kg of the food items in use and the share of every food
+    item in the emissions of the catalog. The report is computed from one
+    query and kept until the next write to recipes, ingredients, food items
+    or equivalents.
+    """
+
+    # One more statement reads the catalog when the report is out of date
+    @query_budget(2)
+    def get(self):
+        stamp, updated_at = get_version()
+        validators = get_validators(stamp, updated_at)
+        not_modified = get_not_modified_response(*validators)
+        if not_modified is not None:
+            return not_modified
+
+        cache = get_report_cache()
+        document = cache.get(stamp)
+        if document is None:
+            from climatecook.resources.food_items import FoodItemResource
+            from climatecook.resources.recipes import RecipeCollection
+            body = MasonBuilder(emissions_report(load_columns()))
+            body.add_namespace("clicook", "/api/link-relations/")
+            body.add_control("self", url_for(EmissionsReport))
+            body.add_control("clicook:recipes-all", url_for(RecipeCollection), title="Recipes")
+            body.add_control("clicook:food-item", uri_template(FoodItemResource, food_item_id="food_item_id"),
+                isHrefTemplate=True, title="Food item by food_item_id")
+            body.add_control("profile", "/api/profiles/")
+            document = dumps(body)
+            cache.put(stamp, document)
+
+        return add_validators(Response(document, 200, mimetype=MASON), *validators)
@@ -0,0 +1,178 @@
+import datetime
+import itertools
+import random
+
+from sqlalchemy import func
+
+from climatecook import db
+from climatecook.models import EquivalentUnitType, FoodItem, FoodItemEquivalent, Ingredient, Recipe
+
+FOODS = [
+    "apple", "bacon", "banana", "barley", "basil", "beef", "beetroot", "broccoli", "butter", "cabbage",
+    "carrot", "cashew", "cauliflower", "celery", "cheddar", "chicken", "chickpea", "chili", "cod", "coconut",
+    "corn", "cream", "cucumber", "egg", "eggplant", "feta", "garlic", "ginger", "honey", "kale",
+    "lamb", "leek", "lemon", "lentil", "lettuce", "mackerel", "milk", "mozzarella", "mushroom", "oat",
+    "olive", "onion", "orange", "parsley", "pasta", "pea", "peanut", "pepper", "pork", "potato",
+    "quinoa", "raspberry", "rice", "rye", "salmon", "shrimp", "spinach", "strawberry", "sugar", "tofu",
+    "tomato", "tuna", "turkey", "walnut", "wheat", "yogurt", "zucchini",
+]
+
+VARIETIES = [
+    "", "fresh", "dried", "frozen", "canned", "smoked", "roasted", "organic", "baby", "wild",
+    "red", "green", "white", "black", "sweet", "ground", "sliced", "whole", "low-fat", "pickled",
+]
+
+DISHES = [
+    "soup", "stew", "salad", "curry", "pie", "casserole", "risotto", "stir-fry", "bowl", "pasta",
+    "omelette", "burger", "wrap", "gratin", "porridge", "smoothie", "sandwich", "tart", "chili", "bake",
+]
+
+# Mass in kg of one unit of a food of density 1 kg/l, and the range of
+# quantities a recipe uses in that unit
+UNITS = {
+    EquivalentUnitType.KG: (1.0, (0.1, 1.5)),
+    EquivalentUnitType.G: (0.001, (5, 500)),
+    EquivalentUnitType.LB: (0.45359237, (0.25, 3)),
+    EquivalentUnitType.OZ: (0.028349523, (1, 16)),
+    EquivalentUnitType.L: (1.0, (0.1, 2)),
+    EquivalentUnitType.ML: (0.001, (5, 500)),
+    EquivalentUnitType.C: (0.2365882, (0.25, 4)),
+    EquivalentUnitType.PT: (0.4731765, (0.5, 2)),
+    EquivalentUnitType.TSP: (0.0049289, (0.5, 4)),
+    EquivalentUnitType.TBSP: (0.0147868, (0.5, 6)),
+}
+
+_VOLUME_UNITS = {
+    EquivalentUnitType.L, EquivalentUnitType.ML, EquivalentUnitType.C, EquivalentUnitType.PT,
+    EquivalentUnitType.TSP, EquivalentUnitType.TBSP,
+}
+
+BATCH_SIZE = 10000
+
+
+def _food_item_names(count, rng):
+    names = [" ".join(filter(None, pair)) for pair in itertools.product(VARIETIES, FOODS)]
+    rng.shuffle(names)
+    for i in range(count):
+        repeat, index = divmod(i, len(names))
+        yield names[index] if repeat == 0 else "{0} {1}".format(names[index], repeat + 1)
+
+
+def _zipf_cum_weights(count, exponent):
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def seed_db(food_items=1000, recipes=10000, min_ingredients=5, max_ingredients=40, exponent=1.1, seed=0):
+    """
+    Adds synthetic food items, equivalents, recipes and ingredients to the
+    database in one transaction. The ingredients are drawn from the food
+    items with Zipfian popularity, so a few food items are used by most
+    recipes. Every food item has a kilogram equivalent and a few others, and
+    all the EquivalentUnitType values occur. The rows are inserted in bulk
+    with executemany, and the emissions totals of the recipes are computed
+    while generating them. The same arguments and seed give the same data.
+
+    : return: tuple of the numbers of food items, equivalents, recipes and
+        ingredients added
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    next_ids = {
+        model: (db.session.query(func.max(model.id)).scalar() or 0) + 1
+        for model in (FoodItem, FoodItemEquivalent, Recipe, Ingredient)
+    }
+
+    food_item_rows = []
+    equivalent_rows = []
+    # food item id: (emission per kg, [(equivalent id, conversion factor, quantity range)])
+    food_item_data = {}
+    other_units = [unit for unit in EquivalentUnitType if unit is not EquivalentUnitType.KG]
+    for food_item_id, name in enumerate(_food_item_names(food_items, rng), next_ids[FoodItem]):
+        emission_per_kg = round(max(rng.lognormvariate(1.0, 1.0), 0.05), 2)
+        food_item_rows.append({
+            "id": food_item_id,
+            "name": name,
+            "emission_per_kg": emission_per_kg,
+            "vegan": rng.random() < 0.6,
+            "organic": rng.random() < 0.2,
+            "domestic": rng.random() < 0.4,
+            "updated_at": now,
+        })
+        density = rng.uniform(0.5, 1.3)
+        equivalents = []
+        for unit in [EquivalentUnitType.KG] + rng.sample(other_units, rng.randint(1, 4)):
+            mass, quantities = UNITS[unit]
+            # Volume units depend on the density of the food, mass units don't
+            conversion_factor = mass * density if unit in _VOLUME_UNITS else mass
+            equivalent_id = next_ids[FoodItemEquivalent] + len(equivalent_rows)
+            equivalent_rows.append({
+                "id": equivalent_id,
+                "food_item_id": food_item_id,
+                "unit_type": unit.value,
+                "conversion_factor": round(conversion_factor, 6),
+                "updated_at": now,
+            })
+            equivalents.append((equivalent_id, equivalent_rows[-1]["conversion_factor"], quantities))
+        food_item_data[food_item_id] = (emission_per_kg, equivalents)
+
+    _insert(FoodItem.__table__, food_item_rows)
+    _insert(FoodItemEquivalent.__table__, equivalent_rows)
+
+    # Popularity rank is independent of the id and the name
+    ranked_ids = list(food_item_data)
+    rng.shuffle(ranked_ids)
+    food_item_names = {row["id"]: row["name"] for row in food_item_rows}
+    cum_weights = _zipf_cum_weights(len(ranked_ids), exponent)
+
+    recipe_rows = []
+    ingredient_rows = []
+    ingredient_id = next_ids[Ingredient]
+    for recipe_id in range(next_ids[Recipe], next_ids[Recipe] + recipes):
+        count = min(rng.randint(min_ingredients, max_ingredients), len(ranked_ids))
+        chosen = []
+        while len(chosen) < count:
+            for food_item_id in rng.choices(ranked_ids, cum_weights=cum_weights, k=count - len(chosen)):
+                if food_item_id not in chosen:
+                    chosen.append(food_item_id)
+        emissions_total = 0.0
+        for food_item_id in chosen:
+            emission_per_kg, equivalents = food_item_data[food_item_id]
+            equivalent_id, conversion_factor, (low, high) = rng.choice(equivalents)
+            quantity = round(rng.uniform(low, high), 2)
+            emissions_total += emission_per_kg * quantity * conversion_factor
+            ingredient_rows.append({
+                "id": ingredient_id,
+                "recipe_id": recipe_id,
+                "food_item_id": food_item_id,
+                "food_item_equivalent_id": equivalent_id,
+                "quantity": quantity,
+                "updated_at": now,
+            })
+            ingredient_id += 1
+        main = food_item_names[chosen[0]] if chosen else "plain"
+        recipe_rows.append({
+            "id": recipe_id,
+            "name": "{0} {1}".format(main, rng.choice(DISHES))[:64],
+            "emissions_total": emissions_total,
+            "updated_at": now,
+        })
+        if len(ingredient_rows) >= BATCH_SIZE:
+            _insert(Recipe.__table__, recipe_rows)
+            _insert(Ingredient.__table__, ingredient_rows)
+            recipe_rows = []
+            ingredient_rows = []
+    _insert(Recipe.__table__, recipe_rows)
+    _insert(Ingredient.__table__, ingredient_rows)
+
+    db.session.commit()
+    return len(food_item_rows), len(equivalent_rows), recipes, ingredient_id - next_ids[Ingredient]
@@ -3,10 +3,12 @@
 
 const API_URL = "/api/";
 const CLIENT_URL = "/client/";
+const MASON = "application/vnd.mason+json";
 
 const RELATIONS = {
     RECIPES : "clicook:recipes-all",
-    FOOD_ITEMS: "clicook:food-items-all"
+    FOOD_ITEMS: "clicook:food-items-all",
+    ITEM: "clicook:item"
 };
 
 $(document).ready(function(e){
@@ -50,7 +52,8 @@ function showResource(href, title){
         title_h.text(title);
     }
 
-    $.get(href, function(r){
+    getResource(href, function(r){
+        expandItemControls(r);
         renderData(r, data_div);
         let controls = r['@controls'];
         renderControls(r, controls, controls_div);
@@ -59,6 +62,37 @@ function showResource(href, title){
     });
 }
 
+function getResource(href, success){
+    // Collections send their compact form with an item URI template instead
+    // of per-item controls, other resources ignore the parameter
+    return $.ajax({
+        url: href,
+        headers: { Accept: MASON + "; compact=1" },
+        dataType: "json",
+        success: success,
+        error: handleAjaxError
+    });
+}
+
+function expandTemplate(template, values){
+    // RFC 6570 simple string expansion
+    return template.replace(/\{(\w+)\}/g, (match, name) => encodeURIComponent(values[name]));
+}
+
+function expandItemControls(r){
+    // Give the items of a compact collection their self controls back
+    let controls = r['@controls'];
+    if(!r.items || !controls || !controls[RELATIONS.ITEM]){
+        return;
+    }
+    let template = controls[RELATIONS.ITEM].href;
+    for(let item of r.items){
+        if(!item['@controls']){
+            item['@controls'] = { self: { href: expandTemplate(template, item) } };
+        }
+    }
+}
+
 function renderControls(r, controls, target){
 
     // Select control to return to if we open a form
@@ -79,6 +113,21 @@ function renderControls(r, controls, target){
         let control = controls[key];
         let button = $.parseHTML(`<button class="btn mx-2">${name}</button>`);
 
+        if(control.isHrefTemplate){
+            // Ask for the template variables and follow the expanded link
+            $(button).addClass('btn-link');
+            $(button).click(() => {
+                bootbox.prompt(control.title || name, function(value){
+                    if(value){
+                        let href = control.href.replace(/\{\w+\}/g, encodeURIComponent(value));
+                        showResource(href, control.title);
+                    }
+                });
+            });
+            $(target).append(button);
+            continue;
+        }
+
         switch(control.method){
             case "POST":
                 $(button).addClass('btn-primary');
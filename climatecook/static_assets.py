@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+import click
+from flask import abort, current_app, request, safe_join, send_file, url_for
+from flask.cli import with_appcontext
+
+from climatecook.compression import accepts_gzip, is_compressible
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# Versioned asset URLs never change content, so they can be cached for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# A .gz sibling is only kept if it saves at least this share of the size
+MIN_SAVING = 0.05
+
+
+def asset_hash(path):
+    """
+    Returns a short hash of the content of a file. The hashes are kept per
+    app and recomputed only when the size or the mtime of the file changes.
+    """
+    hashes = current_app.extensions.setdefault("static_hashes", {})
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = hashes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    hashes[path] = (key, digest)
+    return digest
+
+
+def asset_url(filename):
+    """
+    Builds the URL of a static file of the client with the hash of its
+    content, e.g. /client/static/scripts/index.js?v=0123456789abcdef. The
+    URL changes with the content, so it is served as immutable.
+    """
+    path = safe_join(STATIC_FOLDER, filename)
+    return url_for("client.static", filename=filename, v=asset_hash(path))
+
+
+def send_asset(filename):
+    """
+    Sends a static file of the client. The precompressed .gz sibling made
+    by build-static is sent instead if the client accepts gzip and the
+    sibling is not older than the file. Requests with the current content
+    hash in the v parameter get far-future immutable cache headers.
+    """
+    path = safe_join(STATIC_FOLDER, filename)
+    if not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    compressed = _get_compressed(path)
+    if compressed is not None and accepts_gzip():
+        response = send_file(compressed, mimetype=mimetype, conditional=True)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    if compressed is not None:
+        response.vary.add("Accept-Encoding")
+    if request.args.get("v") == asset_hash(path):
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        response.expires = None
+    return response
+
+
+def _get_compressed(path):
+    try:
+        if os.stat(path + ".gz").st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return path + ".gz"
+    except OSError:
+        pass
+    return None
+
+
+def build_static(folder=STATIC_FOLDER, level=9):
+    """
+    Writes a gzip compressed .gz sibling for every compressible file under
+    folder, and removes the siblings that do not save enough.
+
+    : return: list of (path, size, compressed size) of the written files
+    """
+    written = []
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if name.endswith(".gz"):
+                continue
+            path = os.path.join(root, name)
+            mimetype = mimetypes.guess_type(name)[0]
+            if not is_compressible(mimetype) and not name.endswith((".map", ".ttf", ".eot")):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            # mtime=0 keeps the output the same for the same input
+            compressed = gzip.compress(data, level, mtime=0)
+            if len(compressed) > len(data) * (1 - MIN_SAVING):
+                if os.path.exists(path + ".gz"):
+                    os.remove(path + ".gz")
+                continue
+            with open(path + ".gz", "wb") as f:
+                f.write(compressed)
+            written.append((path, len(data), len(compressed)))
+    return written
+
+
+@click.command("build-static")
+@click.option("--level", default=9, type=click.IntRange(1, 9), help="gzip compression level")
+@with_appcontext
+def build_static_command(level):
+    """
+    Precompresses the static files of the client.
+    """
+    written = build_static(level=level)
+    total = sum(size for _, size, _ in written)
+    compressed = sum(size for _, _, size in written)
+    for path, size, compressed_size in written:
+        click.echo("{0}: {1} -> {2} bytes".format(os.path.relpath(path, STATIC_FOLDER), size, compressed_size))
+    click.echo("Compressed {0} files: {1} -> {2} bytes".format(len(written), total, compressed))
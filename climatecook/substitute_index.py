@@ -0,0 +1,123 @@
+import bisect
+import itertools
+import threading
+
+from flask import current_app
+
+FLAGS = ("vegan", "organic", "domestic")
+
+
+class SubstituteIndex(object):
+    """
+    In-memory index of the food items that can replace an ingredient. Every
+    food item is put in one bucket per unit type of its equivalents, and in
+    that bucket once for every combination of the FLAGS it has, so a lookup
+    with required flags reads a single bucket. The buckets are sorted by the
+    emissions of one unit, so the substitutes with lower emissions than an
+    ingredient are the head of the bucket before a binary search position.
+
+    The index is built lazily from the loader on first use and after
+    invalidate(). It is stored with the version stamp of the data it was
+    built from, and a lookup with a different stamp rebuilds it, which keeps
+    the index correct when another process writes to the database.
+    """
+
+    def __init__(self, loader):
+        """
+        : param loader: callable returning an iterable of the equivalents
+            with their food items as (equivalent id, unit_type,
+            conversion_factor, food item id, name, emission_per_kg, vegan,
+            organic, domestic)
+        """
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._buckets = None
+        self._stamp = None
+
+    def _ensure_built(self, stamp):
+        if self._buckets is not None and self._stamp == stamp:
+            return
+        buckets = {}
+        for row in self._loader():
+            equivalent_id, unit_type, conversion_factor, id, name, emission_per_kg = row[:6]
+            flags = tuple(flag for flag, value in zip(FLAGS, row[6:]) if value)
+            entry = (emission_per_kg * conversion_factor, id, equivalent_id, name, emission_per_kg, flags)
+            for count in range(len(flags) + 1):
+                for required in itertools.combinations(flags, count):
+                    buckets.setdefault((unit_type, required), []).append(entry)
+        for bucket in buckets.values():
+            bucket.sort()
+        self._buckets = buckets
+        self._stamp = stamp
+
+    def invalidate(self):
+        """
+        Drops the index so that it is rebuilt from the loader on next use.
+        """
+        with self._lock:
+            self._buckets = None
+
+    def lower(self, stamp, unit_type, unit_emissions, k, required=()):
+        """
+        Returns up to k food items that have an equivalent of the unit type
+        and all the required flags, and emit less than unit_emissions per
+        unit, lowest first.
+
+        : param tuple stamp: current version stamp of the food items and
+            equivalents, see get_version
+        : param str unit_type: unit of the equivalent to replace
+        : param float unit_emissions: emissions of one unit of the ingredient
+        : param int k: maximum number of substitutes
+        : param required: names of the FLAGS the substitutes must have
+        : return: list of (unit emissions, food item id, equivalent id, name,
+            emission_per_kg, flags)
+        """
+        required = tuple(flag for flag in FLAGS if flag in required)
+        with self._lock:
+            self._ensure_built(stamp)
+            bucket = self._buckets.get((unit_type, required), [])
+            end = bisect.bisect_left(bucket, (unit_emissions,))
+            result = []
+            food_item_ids = set()
+            for entry in itertools.islice(bucket, end):
+                # A food item with several equivalents of the unit is listed once
+                if entry[1] not in food_item_ids:
+                    food_item_ids.add(entry[1])
+                    result.append(entry)
+                    if len(result) == k:
+                        break
+            return result
+
+
+def get_version():
+    """
+    Version stamp of the substitute index: the collection versions of the
+    food items and the equivalents, which triggers bump on every write.
+    """
+    from climatecook import db
+    from climatecook.models import CollectionVersion, FoodItem, FoodItemEquivalent
+    names = (FoodItem.__tablename__, FoodItemEquivalent.__tablename__)
+    versions = dict(db.session.query(CollectionVersion.name, CollectionVersion.version)
+        .filter(CollectionVersion.name.in_(names)).all())
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def _load_equivalents():
+    from climatecook import db
+    from climatecook.models import FoodItem, FoodItemEquivalent
+    return db.session.query(FoodItemEquivalent.id, FoodItemEquivalent.unit_type,
+            FoodItemEquivalent.conversion_factor, FoodItem.id, FoodItem.name, FoodItem.emission_per_kg,
+            FoodItem.vegan, FoodItem.organic, FoodItem.domestic) \
+        .join(FoodItem, FoodItem.id == FoodItemEquivalent.food_item_id) \
+        .all()
+
+
+def get_substitute_index():
+    """
+    Returns the food item substitute index of the current application,
+    creating it on first use.
+    """
+    index = current_app.extensions.get("food_item_substitutes")
+    if index is None:
+        index = current_app.extensions.setdefault("food_item_substitutes", SubstituteIndex(_load_equivalents))
+    return index
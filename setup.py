@@ -9,8 +9,9 @@ setup(
     install_requires=[
         "flask",
         "flask-restful",
-        "flask-sqlalchemy",
+        "flask-sqlalchemy>=2.4",
         "jsonschema",
+        "numpy",
         "SQLAlchemy",
     ]
 )
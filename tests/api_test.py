@@ -1,14 +1,25 @@
+import csv
+import datetime
+import gzip
+import io
 import json
+import logging
 import os
 import tempfile
 import random
 
 import pytest
 from jsonschema import validate
+from sqlalchemy import event
 
 
 from climatecook import create_app, db
 from climatecook.models import Recipe, FoodItem, FoodItemEquivalent, Ingredient
+from climatecook.models import recompute_emissions, recompute_emissions_command
+from climatecook import metrics, static_assets
+from climatecook.query_budget import QueryBudgetExceeded, get_query_budget
+from climatecook.seed import seed_db
+from climatecook.recipe_cache import get_recipe_cache
 
 # based on http://flask.pocoo.org/docs/1.0/testing/
 # we don't need a client for database testing, just the db handle
@@ -35,7 +46,8 @@ def _populate_db():
     for i in range(1, 4):
         r = Recipe(
             id=i,
-            name="test-recipe-{}".format(i)
+            name="test-recipe-{}".format(i),
+            emissions_total=float(i)
         )
         db.session.add(r)
 
@@ -214,6 +226,22 @@ def _check_control_post_method(ctrl, client, obj, obj_type):
     assert resp.status_code == 201
 
 
+def _collect_pages(client, href, rel):
+    """
+    Follows the given paging control ("next" or "prev") starting from href
+    and returns the names of all items in the order they were visited.
+    """
+    names = []
+    while href is not None:
+        resp = client.get(href)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        names.extend(item["name"] for item in body["items"])
+        control = body["@controls"].get(rel)
+        href = control["href"] if control else None
+    return names
+
+
 class TestRecipeCollection(object):
 
     RESOURCE_URL = "/api/recipes/"
@@ -304,6 +332,287 @@ class TestRecipeCollection(object):
         _check_control_get_method_redirect("profile", client, body)
 
 
+    def test_get_emissions_total(self, client):
+        """
+        Tests that the collection reports the same emissions totals as the
+        recipe items, including recipes without any ingredients.
+        """
+        resp = client.post(self.RESOURCE_URL, json=_get_obj("recipe"))
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 4
+        for item in body["items"]:
+            resp = client.get(item["@controls"]["self"]["href"])
+            assert json.loads(resp.data)["emissions_total"] == pytest.approx(item["emissions_total"])
+        totals = {item["name"]: item["emissions_total"] for item in body["items"]}
+        assert totals["test-recipe-2"] == pytest.approx(2.0)
+        assert totals["test-recipe"] == 0
+
+    def test_get_pages(self, client):
+        """
+        Tests the keyset pagination of the GET method. Walks the collection
+        forward and backward using the next and prev controls.
+        """
+        with client.application.app_context():
+            for i in range(10, 25):
+                db.session.add(Recipe(id=i, name="test-recipe-{}".format(i % 4)))
+            db.session.commit()
+            expected = [r.name for r in Recipe.query.order_by(Recipe.name, Recipe.id)]
+
+        resp = client.get(self.RESOURCE_URL + "?limit=4")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 4
+        assert "prev" not in body["@controls"]
+        assert _collect_pages(client, self.RESOURCE_URL + "?limit=4", "next") == expected
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert _collect_pages(client, body["@controls"]["prev"]["href"], "prev") == \
+            expected[4:8] + expected[0:4]
+
+        resp = client.get(self.RESOURCE_URL + "?limit=2&name=test-recipe-1")
+        body = json.loads(resp.data)
+        assert "name=test-recipe-1" in body["@controls"]["next"]["href"]
+        assert all(name == "test-recipe-1" for name in
+            _collect_pages(client, self.RESOURCE_URL + "?limit=2&name=test-recipe-1", "next"))
+
+    def test_get_invalid_page(self, client):
+        """
+        Tests the GET method with invalid paging parameters.
+        """
+        for query in ["?limit=0", "?limit=lalilulelo", "?after=lalilulelo", "?after=WyJhIl0"]:
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+            body = json.loads(resp.data)
+            _check_control_get_method_redirect("profile", client, body)
+
+    def test_get_compact(self, client):
+        """
+        Tests the compact representation selected with the media type
+        parameter, and that it has its own ETag.
+        """
+        full = client.get(self.RESOURCE_URL)
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json; compact=1"})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != full.headers["ETag"]
+        body = json.loads(resp.data)
+        assert body["@controls"]["clicook:item"]["href"] == "/api/recipes/{id}/"
+        assert body["items"][0] == {"id": 1, "name": "test-recipe-1", "emissions_total": 1.0}
+        resp = client.get(self.RESOURCE_URL, headers={
+            "Accept": "application/vnd.mason+json; compact=1",
+            "If-None-Match": full.headers["ETag"]
+        })
+        assert resp.status_code == 200
+        assert "clicook:item" in json.loads(resp.data)["@controls"]
+
+    def test_get_conditional(self, client):
+        """
+        Tests that the collection is revalidated with its ETag and
+        Last-Modified until a recipe changes.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        last_modified = resp.headers["Last-Modified"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        assert resp.headers["ETag"] == etag
+        resp = client.get(self.RESOURCE_URL, headers={"If-Modified-Since": last_modified})
+        assert resp.status_code == 304
+
+        client.put("/api/recipes/2/", json={"name": "renamed-recipe", "id": None})
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        assert len(json.loads(resp.data)["items"]) == 3
+        resp = client.get(self.RESOURCE_URL + "?name=renamed", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 1
+
+    def test_get_statement_count(self, client):
+        """
+        Tests that the number of SQL statements issued by the GET method does
+        not depend on the number of recipes in the collection.
+        """
+        with client.application.app_context():
+            engine = db.engine
+        statements = []
+
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", _count)
+        try:
+            client.get(self.RESOURCE_URL)
+            baseline = len(statements)
+
+            with client.application.app_context():
+                for i in range(10, 60):
+                    db.session.add(Recipe(id=i, name="bulk-recipe-{}".format(i)))
+                    db.session.add(Ingredient(recipe_id=i, food_item_id=1, food_item_equivalent_id=1, quantity=2.0))
+                db.session.commit()
+
+            del statements[:]
+            resp = client.get(self.RESOURCE_URL)
+            assert len(json.loads(resp.data)["items"]) == 53
+            assert len(statements) == baseline
+        finally:
+            event.remove(engine, "before_cursor_execute", _count)
+
+
+class TestRecipeExport(object):
+
+    RESOURCE_URL = "/api/recipes/export"
+
+    def test_get_ndjson(self, client):
+        """
+        Tests the default NDJSON export. Every recipe is on its own line with its
+        ingredients, including recipes without any.
+        """
+        client.post("/api/recipes/", json={"name": "empty-recipe"})
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        recipes = [json.loads(line) for line in resp.data.decode().splitlines()]
+        assert [recipe["name"] for recipe in recipes] == [
+            "test-recipe-1", "test-recipe-2", "test-recipe-3", "empty-recipe"]
+        assert recipes[1]["emissions_total"] == 2.0
+        assert recipes[1]["ingredients"] == [{
+            "id": 2,
+            "food_item_id": 2,
+            "food_item_name": "test-food-item-2",
+            "food_item_equivalent_id": 2,
+            "unit_type": "kilogram",
+            "quantity": 1.0,
+            "emissions": 2.0
+        }]
+        assert recipes[3]["ingredients"] == []
+
+    def test_get_csv(self, client):
+        """
+        Tests the CSV export with one row per ingredient.
+        """
+        client.post("/api/recipes/1/", json={"food_item_id": 4, "food_item_equivalent_id": 4, "quantity": 1})
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "text/csv"})
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/csv"
+        rows = list(csv.DictReader(io.StringIO(resp.data.decode())))
+        assert len(rows) == 4
+        assert [row["food_item_name"] for row in rows[:2]] == ["test-food-item-1", "lonely-food-item"]
+        assert rows[1]["unit_type"] == "teaspoon"
+        assert float(rows[0]["emissions_total"]) == pytest.approx(1.0 + 5.5 * 202.88)
+
+    def test_get_not_acceptable(self, client):
+        """
+        Tests the export with a media type that isn't supported.
+        """
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "text/html"})
+        assert resp.status_code == 406
+        body = json.loads(resp.data)
+        _check_control_get_method_redirect("profile", client, body)
+
+
+class TestRecipeRanking(object):
+
+    RESOURCE_URL = "/api/recipes/ranking"
+
+    def _ids(self, client, query=""):
+        resp = client.get(self.RESOURCE_URL + query)
+        assert resp.status_code == 200
+        return [item["id"] for item in json.loads(resp.data)["items"]]
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the controls of the ranking and its
+        items, and the order and size of the ranking. Recipes without
+        ingredients are left out.
+        """
+        client.post("/api/recipes/", json={"name": "empty-recipe"})
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body)
+        _check_control_get_method("collection", client, body)
+        _check_control_get_method_redirect("profile", client, body)
+        assert [item["emissions_total"] for item in body["items"]] == [1.0, 2.0, 3.0]
+        for item in body["items"]:
+            _check_control_get_method("self", client, item)
+
+        assert self._ids(client, "?order=desc") == [3, 2, 1]
+        assert self._ids(client, "?order=DESC&k=2") == [3, 2]
+        assert self._ids(client, "?k=1") == [1]
+
+    def test_get_filters(self, client):
+        """
+        Tests the vegan, max_emissions and name filters, and that the ETag
+        changes when the vegan flag of a food item does.
+        """
+        assert self._ids(client, "?vegan=true") == []
+        etag = client.get(self.RESOURCE_URL + "?vegan=true").headers["ETag"]
+        assert client.get(self.RESOURCE_URL + "?vegan=true", headers={"If-None-Match": etag}).status_code == 304
+        with client.application.app_context():
+            FoodItem.query.get(2).vegan = True
+            FoodItem.query.get(4).vegan = True
+            db.session.commit()
+        assert client.get(self.RESOURCE_URL + "?vegan=true", headers={"If-None-Match": etag}).status_code == 200
+        assert self._ids(client, "?vegan=1") == [2]
+        assert self._ids(client, "?vegan=0") == [1, 2, 3]
+
+        assert self._ids(client, "?max_emissions=2.5&order=desc") == [2, 1]
+        assert self._ids(client, "?max_emissions=0.5") == []
+        assert self._ids(client, "?name=TEST-RECIPE-3") == [3]
+        assert self._ids(client, "?name=test-recipe&max_emissions=1.5") == [1]
+
+        # A single non-vegan ingredient makes the recipe non-vegan
+        client.post("/api/recipes/2/", json={"food_item_id": 1, "food_item_equivalent_id": 1, "quantity": 1})
+        assert self._ids(client, "?vegan=1") == []
+
+    def test_get_conditional_zero_emissions(self, client):
+        """
+        Tests that the ETag changes when an ingredient without emissions is
+        added, which leaves the emissions totals of the recipes unchanged.
+        """
+        with client.application.app_context():
+            FoodItem.query.get(2).vegan = True
+            db.session.commit()
+        resp = client.post("/api/food-items/1/", json={"unit_type": "cup", "conversion_factor": 0})
+        assert resp.status_code == 201
+        equivalent_id = int(resp.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+        zero_ingredient = {"food_item_id": 1, "food_item_equivalent_id": equivalent_id, "quantity": 1}
+
+        resp = client.get(self.RESOURCE_URL + "?vegan=1")
+        assert [item["id"] for item in json.loads(resp.data)["items"]] == [2]
+        client.post("/api/recipes/2/", json=zero_ingredient)
+        resp = client.get(self.RESOURCE_URL + "?vegan=1", headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
+        # A recipe without ingredients enters the ranking with its first one
+        resp = client.post("/api/recipes/", json={"name": "empty-recipe"})
+        recipe_url = resp.headers["Location"]
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        client.post(recipe_url, json=zero_ingredient)
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"][0]["emissions_total"] == 0.0
+
+    def test_get_invalid(self, client):
+        """
+        Tests that invalid parameters are answered with 400.
+        """
+        for query in ("?order=sideways", "?k=0", "?k=101", "?k=ten", "?vegan=maybe", "?max_emissions=abc",
+                "?max_emissions=nan"):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+            body = json.loads(resp.data)
+            _check_control_get_method_redirect("profile", client, body)
+
+
 class TestRecipeItem(object):
 
     RESOURCE_URL = "/api/recipes/1/"
@@ -333,6 +642,110 @@ class TestRecipeItem(object):
             assert "food_item_id" in item
             assert "food_item_equivalent_id" in item
             assert "quantity" in item
+            assert "emissions" in item
+            assert "emissions_share" in item
+
+    def test_get_breakdown(self, client):
+        """
+        Tests that every ingredient carries its emissions and share of the
+        total, that they follow changes of the food items, and that the
+        recipe and its ingredients are loaded without a query per ingredient.
+        """
+        resp = client.post(self.RESOURCE_URL, json={"food_item_id": 4, "food_item_equivalent_id": 4, "quantity": 0.5})
+        assert resp.status_code == 201
+
+        statements = []
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert len(statements) == 2
+        emissions = [item["emissions"] for item in body["items"]]
+        assert emissions == [1.0, pytest.approx(5.5 * 0.5 * 202.88)]
+        assert sum(emissions) == pytest.approx(body["emissions_total"])
+        shares = [item["emissions_share"] for item in body["items"]]
+        assert shares == [pytest.approx(emission / sum(emissions)) for emission in emissions]
+
+        valid = _get_obj("food_item")
+        valid["id"] = 1
+        valid["emission_per_kg"] = 5.5 * 0.5 * 202.88
+        assert client.put("/api/food-items/1/", json=valid).status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert [item["emissions_share"] for item in body["items"]] == [pytest.approx(0.5), pytest.approx(0.5)]
+
+    def test_get_deleted_equivalent(self, client):
+        """
+        Tests that an ingredient whose equivalent has been deleted, e.g. in
+        a database without enforced foreign keys, is listed with no emissions
+        instead of failing the recipe.
+        """
+        resp = client.post(self.RESOURCE_URL, json={"food_item_id": 4, "food_item_equivalent_id": 4, "quantity": 0.5})
+        assert resp.status_code == 201
+        with client.application.app_context():
+            db.session.execute("PRAGMA foreign_keys=OFF")
+            FoodItemEquivalent.query.filter_by(id=4).delete()
+            db.session.commit()
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["emissions"] for item in body["items"]] == [1.0, 0.0]
+        assert [item["emissions_share"] for item in body["items"]] == [1.0, 0.0]
+
+    def test_get_conditional(self, client):
+        """
+        Tests that the recipe document changes its ETag when its ingredients
+        or the emissions of its food items change.
+        """
+        def _etag():
+            resp = client.get(self.RESOURCE_URL)
+            assert resp.status_code == 200
+            return resp.headers["ETag"]
+
+        etag = _etag()
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        resp = client.get("/api/recipes/2/", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
+        client.put("/api/recipes/1/ingredients/1/", json={
+            "id": None, "recipe_id": 1, "food_item_id": 1, "food_item_equivalent_id": 1, "quantity": 3.0})
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 200
+        etag = _etag()
+        valid = _get_obj("food_item")
+        valid["id"] = 1
+        valid["emission_per_kg"] = 2.0
+        assert client.put("/api/food-items/1/", json=valid).status_code == 204
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 200
+        etag = _etag()
+        client.delete("/api/recipes/1/ingredients/1/")
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 200
+
+    def test_get_modified_since(self, client):
+        """
+        Tests that deleting an ingredient without emissions moves the
+        Last-Modified of the recipe, so that clients revalidating by date see
+        the change.
+        """
+        resp = client.post("/api/food-items/1/", json={"unit_type": "cup", "conversion_factor": 0})
+        assert resp.status_code == 201
+        equivalent_id = int(resp.headers["Location"].rstrip("/").split("/")[-1])
+        resp = client.post(self.RESOURCE_URL, json={
+            "food_item_id": 1, "food_item_equivalent_id": equivalent_id, "quantity": 1.0})
+        assert resp.status_code == 201
+        ingredient_url = resp.headers["Location"]
+        with client.application.app_context():
+            Recipe.query.update({Recipe.updated_at: datetime.datetime(2020, 1, 1)})
+            Ingredient.query.update({Ingredient.updated_at: datetime.datetime(2020, 1, 1)})
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL)
+        last_modified = resp.headers["Last-Modified"]
+        assert last_modified == "Wed, 01 Jan 2020 00:00:00 GMT"
+        assert client.get(self.RESOURCE_URL, headers={"If-Modified-Since": last_modified}).status_code == 304
+
+        assert client.delete(ingredient_url).status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-Modified-Since": last_modified})
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 1
 
     def test_get_not_found(self, client):
         """
@@ -512,6 +925,122 @@ class TestRecipeItem(object):
         _check_control_get_method_redirect("profile", client, body)
 
 
+class TestRecipeCache(object):
+
+    def _cache(self, client):
+        with client.application.app_context():
+            return get_recipe_cache()
+
+    def _get_all(self, client):
+        for i in range(1, 4):
+            assert client.get("/api/recipes/{}/".format(i)).status_code == 200
+
+    def test_hits(self, client):
+        """
+        Tests that repeated GETs are served from the cache with an identical
+        document.
+        """
+        first = client.get("/api/recipes/1/")
+        second = client.get("/api/recipes/1/")
+        assert second.data == first.data
+        stats = self._cache(client).stats()
+        assert stats["entries"] == 1
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["size"] == len(first.data)
+
+    def test_invalidate_dependencies(self, client):
+        """
+        Tests that changing a food item or an equivalent evicts only the
+        recipes that use it, and that the next GET sees the change.
+        """
+        cache = self._cache(client)
+        self._get_all(client)
+        assert len(cache) == 3
+
+        valid = _get_obj("food_item")
+        valid["id"] = 2
+        valid["emission_per_kg"] = 4.0
+        assert client.put("/api/food-items/2/", json=valid).status_code == 204
+        assert len(cache) == 2
+        body = json.loads(client.get("/api/recipes/2/").data)
+        assert body["emissions_total"] == 4.0
+
+        valid = _get_obj("food_item_equivalent")
+        valid["id"] = 3
+        valid["food_item_id"] = 3
+        valid["unit_type"] = "kilogram"
+        valid["conversion_factor"] = 2.0
+        assert client.put("/api/food-items/3/equivalents/3/", json=valid).status_code == 204
+        assert len(cache) == 2
+        body = json.loads(client.get("/api/recipes/3/").data)
+        assert body["emissions_total"] == 6.0
+
+        client.delete("/api/recipes/1/ingredients/1/")
+        assert len(cache) == 2
+        body = json.loads(client.get("/api/recipes/1/").data)
+        assert body["items"] == []
+
+    def test_stale_entry(self, client):
+        """
+        Tests that an entry is not used after the recipe was changed behind
+        the cache's back, e.g. by another process.
+        """
+        self._get_all(client)
+        with client.application.app_context():
+            Recipe.query.get(1).name = "changed-recipe"
+            db.session.commit()
+        body = json.loads(client.get("/api/recipes/1/").data)
+        assert body["name"] == "changed-recipe"
+        assert self._cache(client).stats()["misses"] == 4
+
+    def test_evictions(self, client):
+        """
+        Tests that the least recently used documents are evicted to keep the
+        cache under its maximum size.
+        """
+        cache = self._cache(client)
+        size = len(client.get("/api/recipes/1/").data)
+        cache.max_size = size * 2
+        client.get("/api/recipes/2/")
+        client.get("/api/recipes/1/")
+        client.get("/api/recipes/3/")
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["evictions"] == 1
+        assert stats["size"] <= cache.max_size
+        client.get("/api/recipes/1/")
+        assert cache.stats()["hits"] == 2
+
+
+class TestUrlBuilder(object):
+
+    def test_same_as_api_url_for(self, client):
+        """
+        Tests that the compiled URLs are the same as from api.url_for, also
+        for values that do not go through the templates and under a script
+        root.
+        """
+        from climatecook.api import api
+        from climatecook.resources.food_items import FoodItemEquivalentResource
+        from climatecook.resources.recipes import IngredientItem, RecipeItem
+        from climatecook.resources.urls import url_for
+
+        cases = [
+            (RecipeItem, {"recipe_id": 1}),
+            (RecipeItem, {"recipe_id": 123456}),
+            (RecipeItem, {"recipe_id": "a b"}),
+            (RecipeItem, {"recipe_id": 1, "compact": 1}),
+            (IngredientItem, {"ingredient_id": 5, "recipe_id": 2}),
+            (FoodItemEquivalentResource, {"food_item_id": 3, "food_item_equivalent_id": 4}),
+        ]
+        for script_root in ("", "/prefix"):
+            with client.application.test_request_context(base_url="http://localhost" + script_root):
+                for _ in range(2):
+                    for resource, values in cases:
+                        assert url_for(resource, **values) == api.url_for(resource, **values)
+
+
 class TestIngredientItem(object):
 
     RESOURCE_URL = "/api/recipes/1/ingredients/1/"
@@ -530,6 +1059,7 @@ class TestIngredientItem(object):
         body = json.loads(resp.data)
         _check_namespace(client, body)
         _check_control_get_method("self", client, body)
+        _check_control_get_method("clicook:substitutes", client, body)
         _check_control_put_method("edit", client, body, "ingredient")
         _check_control_delete_method("clicook:delete", client, body)
 
@@ -685,6 +1215,186 @@ class TestIngredientItem(object):
         assert resp.status_code == 404
 
 
+class TestIngredientSubstitutes(object):
+
+    RESOURCE_URL = "/api/recipes/3/ingredients/3/substitutes"
+
+    def _items(self, client, url=RESOURCE_URL):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return json.loads(resp.data)["items"]
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the controls, and that the substitutes
+        are the food items with the same unit and lower emissions, lowest
+        first, with the emissions saved in the recipe.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body)
+        _check_control_get_method("up", client, body)
+        _check_control_get_method_redirect("profile", client, body)
+        assert body["emissions"] == 3.0
+        assert [item["food_item_id"] for item in body["items"]] == [1, 2]
+        assert [item["food_item_equivalent_id"] for item in body["items"]] == [1, 2]
+        assert [item["emissions_saved"] for item in body["items"]] == [2.0, 1.0]
+        assert [item["recipe_emissions_total"] for item in body["items"]] == [1.0, 2.0]
+        for item in body["items"]:
+            _check_control_get_method("self", client, item)
+
+        assert [item["food_item_id"] for item in self._items(client, self.RESOURCE_URL + "?limit=1")] == [1]
+        assert self._items(client, "/api/recipes/1/ingredients/1/substitutes") == []
+
+    def test_get_flags(self, client):
+        """
+        Tests that the flags limit the substitutes to the food items that
+        have them, and that edits of food items and equivalents are seen.
+        """
+        assert self._items(client, self.RESOURCE_URL + "?vegan=true") == []
+
+        valid = _get_obj("food_item")
+        valid["id"] = 2
+        valid["vegan"] = True
+        valid["emission_per_kg"] = 2.0
+        assert client.put("/api/food-items/2/", json=valid).status_code == 204
+        assert [item["food_item_id"] for item in self._items(client, self.RESOURCE_URL + "?vegan=1")] == [2]
+        assert self._items(client, self.RESOURCE_URL + "?vegan=1&organic=1") == []
+        assert [item["food_item_id"] for item in self._items(client, self.RESOURCE_URL + "?vegan=0")] == [1, 2]
+
+        # The lonely food item has no kilogram equivalent until one is added
+        resp = client.post("/api/food-items/4/", json={"unit_type": "kilogram", "conversion_factor": 0.1})
+        assert resp.status_code == 201
+        items = self._items(client)
+        assert [item["food_item_id"] for item in items] == [4, 1, 2]
+        assert items[0]["emissions"] == pytest.approx(0.55)
+        client.delete(resp.headers["Location"])
+        assert [item["food_item_id"] for item in self._items(client)] == [1, 2]
+
+    def test_get_not_found(self, client):
+        """
+        Tests the GET method with an ingredient that doesn't exist or belongs
+        to another recipe.
+        """
+        for url in ("/api/recipes/1/ingredients/3/substitutes", "/api/recipes/3/ingredients/99/substitutes"):
+            resp = client.get(url)
+            assert resp.status_code == 404
+            body = json.loads(resp.data)
+            _check_control_get_method_redirect("profile", client, body)
+
+    def test_get_invalid(self, client):
+        """
+        Tests that invalid parameters are answered with 400.
+        """
+        for query in ("?limit=0", "?limit=101", "?limit=all", "?vegan=maybe", "?domestic=2"):
+            assert client.get(self.RESOURCE_URL + query).status_code == 400
+
+    def test_stale_index(self, client):
+        """
+        Tests that the index is rebuilt after food items and equivalents are
+        changed behind its back, e.g. by another process.
+        """
+        assert [item["food_item_id"] for item in self._items(client)] == [1, 2]
+        with client.application.app_context():
+            FoodItem.query.get(1).emission_per_kg = 100.0
+            db.session.commit()
+        assert [item["food_item_id"] for item in self._items(client)] == [2]
+        with client.application.app_context():
+            FoodItemEquivalent.query.get(1).conversion_factor = 0.01
+            db.session.commit()
+        assert [item["food_item_id"] for item in self._items(client)] == [1, 2]
+
+
+class TestEmissionsTotal(object):
+
+    def _get_emissions_total(self, client, recipe_id):
+        resp = client.get("/api/recipes/{}/".format(recipe_id))
+        assert resp.status_code == 200
+        return json.loads(resp.data)["emissions_total"]
+
+    def _assert_consistent(self, client):
+        with client.application.app_context():
+            assert recompute_emissions(update=False) == []
+
+    def test_ingredient_changes(self, client):
+        """
+        Tests that adding, editing and deleting ingredients keeps the stored
+        emissions totals up to date.
+        """
+        resp = client.post("/api/recipes/1/", json={
+            "food_item_id": 2,
+            "food_item_equivalent_id": 2,
+            "quantity": 3.0
+        })
+        assert resp.status_code == 201
+        assert self._get_emissions_total(client, 1) == pytest.approx(7.0)
+        self._assert_consistent(client)
+
+        ingredient_url = resp.headers["Location"]
+        resp = client.put(ingredient_url, json={
+            "id": None,
+            "recipe_id": 3,
+            "food_item_id": 2,
+            "food_item_equivalent_id": 2,
+            "quantity": 0.5
+        })
+        assert resp.status_code == 204
+        assert self._get_emissions_total(client, 1) == pytest.approx(1.0)
+        assert self._get_emissions_total(client, 3) == pytest.approx(4.0)
+        self._assert_consistent(client)
+
+        resp = client.delete(resp.headers["Location"])
+        assert resp.status_code == 204
+        assert self._get_emissions_total(client, 3) == pytest.approx(3.0)
+        self._assert_consistent(client)
+
+    def test_food_item_changes(self, client):
+        """
+        Tests that editing the emissions of a food item or the conversion
+        factor of an equivalent updates the recipes using them.
+        """
+        food_item = _get_obj("food_item")
+        food_item["id"] = 2
+        food_item["emission_per_kg"] = 10.0
+        resp = client.put("/api/food-items/2/", json=food_item)
+        assert resp.status_code == 204
+        assert self._get_emissions_total(client, 2) == pytest.approx(10.0)
+        assert self._get_emissions_total(client, 1) == pytest.approx(1.0)
+
+        resp = client.put("/api/food-items/2/equivalents/2/", json={
+            "id": 2,
+            "food_item_id": 2,
+            "unit_type": "kilogram",
+            "conversion_factor": 0.25
+        })
+        assert resp.status_code == 204
+        assert self._get_emissions_total(client, 2) == pytest.approx(2.5)
+        self._assert_consistent(client)
+
+    def test_recompute_command(self, client):
+        """
+        Tests that the recompute-emissions command detects and fixes stale
+        totals.
+        """
+        app = client.application
+        with app.app_context():
+            Recipe.query.filter_by(id=2).update({"emissions_total": 100.0})
+            db.session.commit()
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(recompute_emissions_command, ["--check"])
+        assert result.exit_code == 1
+        assert "1 stale emissions totals found" in result.output
+        assert self._get_emissions_total(client, 2) == 100.0
+
+        result = runner.invoke(recompute_emissions_command)
+        assert result.exit_code == 0
+        assert self._get_emissions_total(client, 2) == pytest.approx(2.0)
+        self._assert_consistent(client)
+
+
 class TestFoodItemCollection(object):
 
     RESOURCE_URL = "/api/food-items/"
@@ -738,6 +1448,138 @@ class TestFoodItemCollection(object):
         _check_control_post_method("clicook:add-food-item", client, body, "food_item")
         assert len(body["items"]) == 0
 
+    def test_get_search(self, client):
+        """
+        Test the GET method with the full-text search parameter 'q'. Also
+        checks that the search control is a URI template for the parameter.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        ctrl = body["@controls"]["clicook:search-food-items"]
+        assert ctrl["isHrefTemplate"]
+        assert ctrl["schema"]["required"] == ["q"]
+
+        resp = client.get(ctrl["href"].replace("{q}", "ITEM 2"))
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["test-food-item-2"]
+
+        resp = client.get(self.RESOURCE_URL + "?q=fo")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 4
+        for item in body["items"]:
+            _check_control_get_method("self", client, item)
+
+        resp = client.put("/api/food-items/4/", json={"name": "crushed tomatoes", "emission_per_kg": 1.0})
+        assert resp.status_code == 204
+        for q in ["tomato", "Tomatoes", "crush tom"]:
+            resp = client.get(self.RESOURCE_URL + "?q=" + q)
+            body = json.loads(resp.data)
+            assert [item["name"] for item in body["items"]] == ["crushed tomatoes"]
+        resp = client.get(self.RESOURCE_URL + "?q=lonely")
+        assert len(json.loads(resp.data)["items"]) == 0
+
+        resp = client.get(self.RESOURCE_URL + "?q=%21%21")
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 0
+
+    def test_get_pages(self, client):
+        """
+        Tests the keyset pagination of the GET method.
+        """
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 3
+        names = _collect_pages(client, self.RESOURCE_URL + "?limit=3", "next")
+        assert names == ["lonely-food-item", "test-food-item-1", "test-food-item-2", "test-food-item-3"]
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 1
+        assert "next" not in body["@controls"]
+        _check_control_get_method("prev", client, body)
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == names[:3]
+        assert "prev" not in body["@controls"]
+
+    def test_get_compact(self, client):
+        """
+        Tests the compact representation selected with the query parameter.
+        Items carry their ids and the item URI template expands to their
+        self links.
+        """
+        full = json.loads(client.get(self.RESOURCE_URL).data)
+        resp = client.get(self.RESOURCE_URL + "?compact=1&limit=3")
+        assert resp.status_code == 200
+        assert "Accept" in resp.headers["Vary"]
+        body = json.loads(resp.data)
+        template = body["@controls"]["clicook:item"]
+        assert template["isHrefTemplate"] is True
+        assert template["href"] == "/api/food-items/{id}/"
+        assert "compact=1" in body["@controls"]["next"]["href"]
+        for item, full_item in zip(body["items"], full["items"]):
+            assert "@controls" not in item
+            assert template["href"].replace("{id}", str(item["id"])) == full_item["@controls"]["self"]["href"]
+            assert item["name"] == full_item["name"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert [item["name"] for item in json.loads(resp.data)["items"]] == ["test-food-item-3"]
+
+    def test_get_streamed(self, client):
+        """
+        Tests that the collection is streamed, and that the streamed document
+        is the same as the one json.dumps gives for any batch size.
+        """
+        resp = client.get(self.RESOURCE_URL, buffered=False)
+        assert resp.is_streamed
+        assert len(json.loads(resp.get_data())["items"]) == 4
+
+        from climatecook.resources.masonbuilder import MasonBuilder
+        with client.application.test_request_context():
+            for count in range(0, 6):
+                items = [{"id": i, "name": "item-{}".format(i)} for i in range(count)]
+                for body in (MasonBuilder(), MasonBuilder(name="collection")):
+                    resp = body.stream(iter(items), batch_size=2)
+                    body["items"] = items
+                    assert resp.get_data(as_text=True) == json.dumps(body)
+                    del body["items"]
+
+    def test_get_static_controls(self, client):
+        """
+        Tests that the schemas and the static controls are built once, shared
+        between responses and cannot be modified.
+        """
+        from climatecook.resources.food_items import FoodItemBuilder
+        schema = FoodItemBuilder.food_item_schema()
+        assert FoodItemBuilder.food_item_schema() is schema
+        with pytest.raises(TypeError):
+            schema["required"].append("id")
+        with pytest.raises(TypeError):
+            schema["properties"]["name"] = {}
+
+        first = json.loads(client.get(self.RESOURCE_URL).data)
+        client.post(self.RESOURCE_URL, json=_get_obj("food_item"))
+        second = json.loads(client.get(self.RESOURCE_URL).data)
+        for ctrl in ("clicook:add-food-item", "clicook:search-food-items", "clicook:recipes-all"):
+            assert second["@controls"][ctrl] == first["@controls"][ctrl]
+        assert first["@controls"]["clicook:add-food-item"]["schema"] == schema
+        with client.application.test_request_context():
+            body = FoodItemBuilder()
+            body.add_control_add_food_item()
+            other = FoodItemBuilder()
+            other.add_control_add_food_item()
+            assert body["@controls"]["clicook:add-food-item"] is other["@controls"]["clicook:add-food-item"]
+
+    def test_get_invalid_page(self, client):
+        """
+        Tests the GET method with invalid paging parameters.
+        """
+        resp = client.get(self.RESOURCE_URL + "?limit=100000")
+        assert resp.status_code == 400
+        body = json.loads(resp.data)
+        _check_control_get_method_redirect("profile", client, body)
+
     def test_post_valid(self, client):
         """
         Tests the POST method using a valid object.
@@ -811,6 +1653,189 @@ class TestFoodItemCollection(object):
         _check_control_get_method_redirect("profile", client, body)
 
 
+class TestFoodItemBulkImport(object):
+
+    RESOURCE_URL = "/api/food-items/bulk"
+
+    def _post(self, client, lines, query=""):
+        data = "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines)
+        return client.post(self.RESOURCE_URL + query, data=data, content_type="application/x-ndjson")
+
+    def test_post_valid(self, client):
+        """
+        Tests the POST method with valid food items, spread over several
+        batches. Checks that the items and their equivalents can be found.
+        """
+        lines = []
+        for i in range(5):
+            lines.append({
+                "name": "bulk-food-item-{}".format(i),
+                "emission_per_kg": i + 0.5,
+                "vegan": True,
+                "equivalents": [
+                    {"unit_type": "kilogram", "conversion_factor": 1},
+                    {"unit_type": "cup", "conversion_factor": 0.25}
+                ]
+            })
+        # The next search is served from the index
+        client.get("/api/food-items/suggest?prefix=bulk")
+        resp = self._post(client, lines, "?batch_size=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["imported"] == 5
+        assert body["failed"] == 0
+        _check_control_get_method("collection", client, body)
+
+        resp = client.get("/api/food-items/?name=bulk")
+        items = json.loads(resp.data)["items"]
+        assert [item["name"] for item in items] == ["bulk-food-item-{}".format(i) for i in range(5)]
+        resp = client.get(items[3]["@controls"]["self"]["href"])
+        body = json.loads(resp.data)
+        assert body["emission_per_kg"] == 3.5
+        assert body["vegan"] is True
+        assert sorted(item["unit_type"] for item in body["items"]) == ["cup", "kilogram"]
+
+        resp = client.get("/api/food-items/suggest?prefix=bulk")
+        assert len(json.loads(resp.data)["items"]) == 5
+        resp = client.get("/api/food-items/?q=bulk")
+        assert len(json.loads(resp.data)["items"]) == 5
+
+    def test_post_invalid_lines(self, client):
+        """
+        Tests that invalid lines are reported without failing the valid ones.
+        """
+        resp = self._post(client, [
+            {"name": "bulk-ok-1", "emission_per_kg": 1.0},
+            "{not json",
+            {"emission_per_kg": 1.0},
+            "",
+            {"name": "bulk-bad-emission", "emission_per_kg": -1},
+            {"name": "bulk-bad-unit", "emission_per_kg": 1, "equivalents": [{"unit_type": "bucket",
+                "conversion_factor": 1}]},
+            {"name": "bulk-ok-2", "emission_per_kg": 2, "equivalents": [{"unit_type": "gram",
+                "conversion_factor": 0.001}]},
+        ])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["imported"] == 2
+        assert body["failed"] == 4
+        assert [error["line"] for error in body["errors"]] == [2, 3, 5, 6]
+        assert body["errors"][1]["message"] == "Missing field:name"
+        resp = client.get("/api/food-items/?name=bulk")
+        assert [item["name"] for item in json.loads(resp.data)["items"]] == ["bulk-ok-1", "bulk-ok-2"]
+
+    def test_post_invalid_content_type(self, client):
+        """
+        Tests the POST method with a JSON content type.
+        """
+        resp = client.post(self.RESOURCE_URL, json={"name": "bulk", "emission_per_kg": 1.0})
+        assert resp.status_code == 415
+        body = json.loads(resp.data)
+        _check_control_get_method_redirect("profile", client, body)
+
+    def test_post_invalid_batch_size(self, client):
+        """
+        Tests the POST method with an invalid batch size.
+        """
+        resp = self._post(client, [{"name": "bulk", "emission_per_kg": 1.0}], "?batch_size=0")
+        assert resp.status_code == 400
+
+
+class TestFoodItemSuggestions(object):
+
+    RESOURCE_URL = "/api/food-items/suggest"
+
+    def _suggest(self, client, query):
+        resp = client.get(self.RESOURCE_URL + query)
+        assert resp.status_code == 200
+        return [(item["id"], item["name"]) for item in json.loads(resp.data)["items"]]
+
+    def test_get(self, client):
+        """
+        Tests the GET method with different prefixes and limits. Also checks
+        that the control in the food item collection points here.
+        """
+        resp = client.get("/api/food-items/")
+        ctrl = json.loads(resp.data)["@controls"]["clicook:suggest-food-items"]
+        assert ctrl["isHrefTemplate"]
+        assert self._suggest(client, ctrl["href"][len(self.RESOURCE_URL):].replace("{prefix}", "lone")) == \
+            [(4, "lonely-food-item")]
+
+        assert self._suggest(client, "?prefix=test") == \
+            [(1, "test-food-item-1"), (2, "test-food-item-2"), (3, "test-food-item-3")]
+        assert self._suggest(client, "?prefix=TEST-food&limit=2") == \
+            [(1, "test-food-item-1"), (2, "test-food-item-2")]
+        assert self._suggest(client, "?prefix=macaron") == []
+        assert len(self._suggest(client, "")) == 4
+
+    def test_get_invalid_limit(self, client):
+        """
+        Tests the GET method with an invalid limit.
+        """
+        resp = client.get(self.RESOURCE_URL + "?prefix=test&limit=0")
+        assert resp.status_code == 400
+        body = json.loads(resp.data)
+        _check_control_get_method_redirect("profile", client, body)
+
+    def test_get_no_queries(self, client):
+        """
+        Tests that suggestions only read the version of the index once it is
+        built.
+        """
+        self._suggest(client, "?prefix=test")
+        with client.application.app_context():
+            engine = db.engine
+        statements = []
+
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", _count)
+        try:
+            self._suggest(client, "?prefix=lonely")
+        finally:
+            event.remove(engine, "before_cursor_execute", _count)
+        assert len(statements) == 1
+        assert "collection_version" in statements[0]
+
+    def test_index_updates(self, client):
+        """
+        Tests that adding, renaming and deleting food items updates the
+        suggestions.
+        """
+        assert self._suggest(client, "?prefix=cheese") == []
+        food_item = _get_obj("food_item")
+        food_item["name"] = "Cheese"
+        resp = client.post("/api/food-items/", json=food_item)
+        assert resp.status_code == 201
+        assert self._suggest(client, "?prefix=cheese") == [(5, "Cheese")]
+
+        food_item["id"] = 6
+        food_item["name"] = "Cheddar cheese"
+        resp = client.put("/api/food-items/5/", json=food_item)
+        assert resp.status_code == 204
+        assert self._suggest(client, "?prefix=cheese") == []
+        assert self._suggest(client, "?prefix=cheddar") == [(6, "Cheddar cheese")]
+
+        resp = client.delete("/api/food-items/6/")
+        assert resp.status_code == 204
+        assert self._suggest(client, "?prefix=ch") == []
+
+    def test_other_process(self, client):
+        """
+        Tests that food items written by another process, here another app
+        on the same database, are suggested.
+        """
+        assert self._suggest(client, "?prefix=zz") == []
+        other = create_app({"SQLALCHEMY_DATABASE_URI": client.application.config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True})
+        food_item = _get_obj("food_item")
+        food_item["name"] = "zzapple"
+        resp = other.test_client().post("/api/food-items/", json=food_item)
+        assert resp.status_code == 201
+        assert self._suggest(client, "?prefix=zz") == [(5, "zzapple")]
+
+
 class TestFoodItemResource(object):
 
     RESOURCE_URL = "/api/food-items/4/"
@@ -837,6 +1862,42 @@ class TestFoodItemResource(object):
         # TODO: Check items controls once ingredients are done
         assert "items" in body
 
+    def test_get_conditional(self, client):
+        """
+        Tests that the food item document is revalidated until the food item
+        or its equivalents change.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 304
+        resp = client.post(self.RESOURCE_URL, json={"unit_type": "cup", "conversion_factor": 0.2})
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 2
+        etag = resp.headers["ETag"]
+        client.delete("/api/food-items/4/equivalents/4/")
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 200
+
+    def test_get_modified_since(self, client):
+        """
+        Tests that deleting an equivalent moves the Last-Modified of the food
+        item, so that clients revalidating by date see the change.
+        """
+        with client.application.app_context():
+            FoodItem.query.update({FoodItem.updated_at: datetime.datetime(2020, 1, 1)})
+            FoodItemEquivalent.query.update({FoodItemEquivalent.updated_at: datetime.datetime(2020, 1, 1)})
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL)
+        last_modified = resp.headers["Last-Modified"]
+        assert last_modified == "Wed, 01 Jan 2020 00:00:00 GMT"
+        assert client.get(self.RESOURCE_URL, headers={"If-Modified-Since": last_modified}).status_code == 304
+
+        assert client.delete("/api/food-items/4/equivalents/4/").status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-Modified-Since": last_modified})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
     def test_get_not_found(self, client):
         """
         Tests the GET method. Checks that the response status code is 200, and
@@ -1089,6 +2150,19 @@ class TestFoodItemEquivalentResource(object):
         assert "unit_type" in body
         assert "conversion_factor" in body
 
+    def test_get_conditional(self, client):
+        """
+        Tests the ETag of a single equivalent.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        assert "Last-Modified" in resp.headers
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 304
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": '"other", ' + etag}).status_code == 304
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": '"other"'})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["unit_type"] == "teaspoon"
+
     def test_get_not_found(self, client):
         """
         Tests the GET method. Checks that the response status code is 200, and
@@ -1215,9 +2289,476 @@ class TestFoodItemEquivalentResource(object):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 404
 
+    def test_delete_in_use(self, client):
+        """
+        Tests that an equivalent used by ingredients can't be deleted.
+        """
+        resp = client.delete("/api/food-items/1/equivalents/1/")
+        assert resp.status_code == 409
+        body = json.loads(resp.data)
+        _check_control_get_method_redirect("profile", client, body)
+        assert client.get("/api/food-items/1/equivalents/1/").status_code == 200
+        assert client.get("/api/recipes/1/").status_code == 200
+
     def test_delete_not_found(self, client):
         """
         Tests the DELETE method using an invalid id.
         """
         resp = client.delete(self.INVALID_RESOURCE_URL)
         assert resp.status_code == 404
+
+
+class TestEmissionsReport(object):
+
+    RESOURCE_URL = "/api/reports/emissions"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the controls and the statistics of the
+        populated database, where the three recipes have one non-vegan
+        ingredient each.
+        """
+        resp = client.get("/api/")
+        _check_control_get_method("clicook:emissions-report", client, json.loads(resp.data))
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body)
+        _check_control_get_method("clicook:recipes-all", client, body)
+        _check_control_get_method_redirect("profile", client, body)
+        assert body["@controls"]["clicook:food-item"]["isHrefTemplate"]
+
+        assert body["ingredients"] == 3
+        assert body["emissions_total"] == 6.0
+        recipes = body["recipes"]
+        assert (recipes["count"], recipes["mean"], recipes["min"], recipes["max"]) == (3, 2.0, 1.0, 3.0)
+        assert recipes["percentiles"]["p50"] == 2.0
+        assert sum(recipes["histogram"]["counts"]) == 3
+        assert recipes["vegan"] == {"count": 0, "mean": None}
+        assert recipes["non_vegan"] == {"count": 3, "mean": 2.0}
+        assert body["food_items"]["count"] == 3
+        assert [share["food_item_id"] for share in body["food_items"]["shares"]] == [3, 2, 1]
+        assert [share["share"] for share in body["food_items"]["shares"]] == [
+            pytest.approx(0.5), pytest.approx(1 / 3.0), pytest.approx(1 / 6.0)]
+
+    def test_get_cached(self, client):
+        """
+        Tests that the report is served from the cache until the next write,
+        and answered with 304 to a matching If-None-Match.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        statements = []
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        assert client.get(self.RESOURCE_URL).data == resp.data
+        assert len(statements) == 1
+        assert client.get(self.RESOURCE_URL, headers={"If-None-Match": etag}).status_code == 304
+
+        with client.application.app_context():
+            FoodItem.query.get(2).vegan = True
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["recipes"]["vegan"] == {"count": 1, "mean": 2.0}
+
+        client.post("/api/recipes/2/", json={"food_item_id": 4, "food_item_equivalent_id": 4, "quantity": 0.1})
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["recipes"]["vegan"] == {"count": 0, "mean": None}
+        assert body["emissions_total"] == pytest.approx(6.0 + 5.5 * 0.1 * 202.88)
+        assert body["food_items"]["shares"][0]["food_item_id"] == 4
+
+
+class TestCompression(object):
+
+    def test_get_compressed(self, client):
+        """
+        Tests that a large enough document is gzipped only for clients that
+        accept it, and that its ETag is weak but still matches.
+        """
+        plain = client.get("/api/recipes/1/")
+        assert len(plain.data) >= 1024
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+        resp = client.get("/api/recipes/1/", headers={"Accept-Encoding": "gzip, deflate"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert int(resp.headers["Content-Length"]) == len(resp.data)
+        assert gzip.decompress(resp.data) == plain.data
+        assert resp.headers["ETag"] == "W/" + plain.headers["ETag"]
+
+        resp = client.get("/api/recipes/1/", headers={
+            "Accept-Encoding": "gzip",
+            "If-None-Match": resp.headers["ETag"]
+        })
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == "W/" + plain.headers["ETag"]
+
+    def test_get_small_not_compressed(self, client):
+        """
+        Tests that documents under COMPRESS_MIN_SIZE are sent as is.
+        """
+        client.application.config["COMPRESS_MIN_SIZE"] = 10 ** 6
+        resp = client.get("/api/recipes/1/", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert "Content-Encoding" not in resp.headers
+        json.loads(resp.data)
+
+    def test_get_streamed(self, client):
+        """
+        Tests that streamed collections and exports are gzipped on the fly.
+        """
+        for url in ("/api/food-items/", "/api/recipes/export"):
+            plain = client.get(url)
+            resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+            assert resp.status_code == 200
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert "Content-Length" not in resp.headers
+            assert gzip.decompress(resp.data) == plain.data
+
+
+class TestClientStatic(object):
+
+    @pytest.fixture
+    def static_folder(self, tmpdir, monkeypatch):
+        tmpdir.mkdir("scripts").join("app.js").write("var x = 1;\n" * 500)
+        monkeypatch.setattr(static_assets, "STATIC_FOLDER", str(tmpdir))
+        return tmpdir
+
+    def test_index_versioned_urls(self, client):
+        """
+        Tests that the client page links its assets with content hashes and
+        that those URLs are served as immutable.
+        """
+        resp = client.get("/client/")
+        assert resp.status_code == 200
+        page = resp.data.decode("utf-8")
+        assert "/client/static/scripts/index.js?v=" in page
+        start = page.index("/client/static/scripts/index.js?v=")
+        url = page[start:page.index('"', start)]
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert resp.headers["Cache-Control"] == static_assets.IMMUTABLE_CACHE_CONTROL
+        resp.close()
+
+        resp = client.get("/client/static/scripts/index.js?v=outdated")
+        assert resp.status_code == 200
+        assert "immutable" not in resp.headers.get("Cache-Control", "")
+        resp.close()
+
+    def test_get_precompressed(self, client, static_folder):
+        """
+        Tests that the .gz siblings made by build_static are sent to clients
+        that accept gzip, and not once the file is newer than its sibling.
+        """
+        path = static_folder.join("scripts", "app.js")
+        written = static_assets.build_static(str(static_folder))
+        assert [entry[0] for entry in written] == [str(path)]
+
+        resp = client.get("/client/static/scripts/app.js", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.mimetype in ("application/javascript", "text/javascript")
+        assert gzip.decompress(resp.data) == path.read_binary()
+        resp.close()
+
+        resp = client.get("/client/static/scripts/app.js")
+        assert "Content-Encoding" not in resp.headers
+        assert resp.data == path.read_binary()
+        resp.close()
+
+        path.setmtime(static_folder.join("scripts", "app.js.gz").mtime() + 10)
+        resp = client.get("/client/static/scripts/app.js", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+        resp.close()
+
+    def test_get_not_found(self, client, static_folder):
+        """
+        Tests that missing files and paths outside the static folder give 404.
+        """
+        assert client.get("/client/static/scripts/missing.js").status_code == 404
+        assert client.get("/client/static/../client.py").status_code == 404
+
+
+class TestInstrumentation(object):
+
+    def test_server_timing(self, client):
+        """
+        Tests that responses carry the SQL, URL and serialization timings in
+        a Server-Timing header.
+        """
+        resp = client.get("/api/food-items/1/")
+        assert resp.status_code == 200
+        metrics = {}
+        for entry in resp.headers["Server-Timing"].split(", "):
+            name, _, params = entry.partition(";")
+            metrics[name] = dict(param.split("=", 1) for param in params.split(";"))
+        assert set(metrics) == {"sql", "url", "serialize", "total"}
+        assert metrics["sql"]["desc"] != '"0 statements"'
+        assert float(metrics["total"]["dur"]) >= float(metrics["sql"]["dur"])
+
+    def test_log_line(self, client, caplog):
+        """
+        Tests that a structured line is logged for every request, and that
+        it covers the body of streamed responses.
+        """
+        caplog.set_level(logging.INFO, logger="climatecook.requests")
+        resp = client.get("/api/food-items/")
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        resp.close()
+        records = [r for r in caplog.records if r.name == "climatecook.requests"]
+        assert len(records) == 1
+        fields = json.loads(records[0].getMessage())
+        assert fields == records[0].timings
+        assert fields["method"] == "GET"
+        assert fields["path"] == "/api/food-items/"
+        assert fields["endpoint"] == "api.fooditemcollection"
+        assert fields["status"] == 200
+        assert fields["sql_count"] >= 1
+        # The item links are built while the body is streamed, after the
+        # header has been set
+        header_urls = int(resp.headers["Server-Timing"].split('desc="')[2].split(" ")[0])
+        assert fields["url_count"] == header_urls + len(items)
+
+    def test_disabled(self):
+        """
+        Tests that nothing is added when INSTRUMENT_REQUESTS is off.
+        """
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "INSTRUMENT_REQUESTS": False})
+        with app.app_context():
+            db.create_all()
+        resp = app.test_client().get("/api/recipes/")
+        assert resp.status_code == 200
+        resp.data
+        assert "Server-Timing" not in resp.headers
+
+
+class TestMetrics(object):
+
+    RESOURCE_URL = "/api/metrics"
+
+    def _get_samples(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.headers["Content-Type"] == metrics.CONTENT_TYPE
+        samples = {}
+        for line in resp.data.decode("utf-8").splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def _request(self, client, url):
+        resp = client.get(url)
+        resp.data
+        resp.close()
+        return resp
+
+    def test_get(self, client):
+        """
+        Tests that requests to the resources are counted in the histograms
+        and that recipe cache lookups give the hit ratio.
+        """
+        self._request(client, "/api/recipes/1/")
+        self._request(client, "/api/recipes/1/")
+        self._request(client, "/api/recipes/")
+        samples = self._get_samples(client)
+
+        labels = 'method="GET",resource="RecipeItem"'
+        assert samples['climatecook_http_requests_total{' + labels + ',status="200"}'] == 2
+        assert samples["climatecook_http_request_duration_seconds_count{" + labels + "}"] == 2
+        assert samples["climatecook_http_request_sql_statements_count{" + labels + "}"] == 2
+        assert samples["climatecook_http_request_sql_statements_sum{" + labels + "}"] >= 2
+        buckets = [value for name, value in samples.items()
+            if name.startswith("climatecook_http_response_size_bytes_bucket{" + labels)]
+        assert buckets == sorted(buckets)
+        assert buckets[-1] == 2
+        assert samples['climatecook_cache_requests_total{cache="recipe",result="hit"}'] == 1
+        assert samples['climatecook_cache_requests_total{cache="recipe",result="miss"}'] == 1
+        assert samples['climatecook_cache_hit_ratio{cache="recipe"}'] == 0.5
+
+        # Every method of every resource has its histograms from the start
+        for resource, method in metrics.get_resource_methods(client.application):
+            name = 'climatecook_http_request_duration_seconds_count{{method="{0}",resource="{1}"}}'.format(
+                method, resource)
+            assert name in samples
+        assert 'climatecook_http_request_duration_seconds_count{method="PUT",resource="RecipeItem"}' in samples
+
+    def test_get_multiprocess(self, tmpdir, monkeypatch):
+        """
+        Tests that with METRICS_DIR the metrics of all processes are summed.
+        """
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "METRICS_DIR": str(tmpdir)})
+        with app.app_context():
+            db.create_all()
+        client = app.test_client()
+        self._request(client, "/api/recipes/")
+        with app.app_context():
+            metrics.count_cache_lookup("recipe", True)
+
+        real_pid = os.getpid()
+        monkeypatch.setattr(os, "getpid", lambda: real_pid + 1)
+        self._request(client, "/api/recipes/")
+        with app.app_context():
+            metrics.count_cache_lookup("recipe", False)
+        monkeypatch.undo()
+
+        assert len(tmpdir.listdir()) == 2
+        samples = self._get_samples(client)
+        labels = 'method="GET",resource="RecipeCollection"'
+        assert samples['climatecook_http_requests_total{' + labels + ',status="200"}'] == 2
+        assert samples['climatecook_cache_hit_ratio{cache="recipe"}'] == 0.5
+
+    def test_mmap_store(self, tmpdir):
+        """
+        Tests that the file of a store grows as needed and keeps its values
+        when it is opened again.
+        """
+        path = str(tmpdir.join("metrics-1.db"))
+        store = metrics.MmapStore(path)
+        amounts = [("key-{0}".format(i) * 10, float(i)) for i in range(2000)]
+        store.add_many(amounts)
+        store.add_many(amounts[:1] + amounts[-1:])
+        assert os.path.getsize(path) > metrics.MmapStore.INITIAL_SIZE
+        expected = dict(amounts)
+        expected[amounts[-1][0]] *= 2
+        assert store.collect() == expected
+        assert metrics.MmapStore(path).collect() == expected
+
+
+@pytest.fixture
+def budget_client():
+    """
+    Client of an app that raises QueryBudgetExceeded when a request exceeds
+    the query budget of its resource method, against a seeded database of a
+    few hundred recipes and a few thousand ingredients.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "QUERY_BUDGET_MODE": "raise"
+    })
+    with app.app_context():
+        db.create_all()
+        seed_db(food_items=200, recipes=300, seed=1)
+
+    yield app.test_client()
+
+    with app.app_context():
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+class TestQueryBudget(object):
+
+    def _request(self, client, method, url, **kwargs):
+        resp = client.open(url, method=method, **kwargs)
+        # Streamed responses are checked once they have been sent
+        resp.data
+        resp.close()
+        assert resp.status_code < 400, resp.data
+        endpoint = client.application.url_map.bind("localhost").match(url.split("?")[0], method=method)[0]
+        self.covered.add((client.application.view_functions[endpoint].view_class.__name__, method))
+        return resp
+
+    def _location_id(self, resp):
+        return int(resp.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+
+    def test_all_methods_declare_budget(self, client):
+        """
+        Tests that every method of every resource declares a query budget.
+        """
+        for view in client.application.view_functions.values():
+            resource = getattr(view, "view_class", None)
+            if resource is not None:
+                for method in resource.methods:
+                    get_query_budget(resource, method)
+
+    def test_budgets(self, budget_client):
+        """
+        Tests that every method of every resource stays within its query
+        budget on the seeded database.
+        """
+        client = budget_client
+        self.covered = set()
+        with client.application.app_context():
+            recipe = Recipe.query.join(Ingredient).first()
+            ingredient = recipe.ingredients[0]
+            food_item = FoodItem.query.get(ingredient.food_item_id)
+            equivalent = FoodItemEquivalent.query.filter_by(food_item_id=food_item.id).first()
+            word = food_item.name.split()[0]
+
+        for url in ("/api/recipes/", "/api/recipes/?compact=1", "/api/recipes/export",
+                "/api/reports/emissions",
+                "/api/recipes/ranking?vegan=1&k=50", "/api/recipes/ranking?order=desc&name=" + word,
+                "/api/recipes/{0}/".format(recipe.id),
+                "/api/recipes/{0}/ingredients/{1}/".format(recipe.id, ingredient.id),
+                "/api/recipes/{0}/ingredients/{1}/substitutes".format(recipe.id, ingredient.id),
+                "/api/recipes/{0}/ingredients/{1}/substitutes?vegan=1".format(recipe.id, ingredient.id),
+                "/api/food-items/", "/api/food-items/?q=" + word, "/api/food-items/?name=" + word[:2],
+                "/api/food-items/suggest?prefix=" + word[:2],
+                "/api/food-items/{0}/".format(food_item.id),
+                "/api/food-items/{0}/equivalents/{1}/".format(food_item.id, equivalent.id)):
+            self._request(client, "GET", url)
+
+        resp = self._request(client, "POST", "/api/recipes/", json={"name": "budget-recipe"})
+        recipe_id = self._location_id(resp)
+        recipe_url = "/api/recipes/{0}/".format(recipe_id)
+        self._request(client, "PUT", recipe_url, json={"id": recipe_id, "name": "budget-recipe-2"})
+        # The recipe keeps one ingredient, which its delete has to remove too
+        for _ in range(2):
+            resp = self._request(client, "POST", recipe_url, json={
+                "food_item_id": food_item.id, "food_item_equivalent_id": equivalent.id, "quantity": 1.5})
+        ingredient_id = self._location_id(resp)
+        ingredient_url = "{0}ingredients/{1}/".format(recipe_url, ingredient_id)
+        self._request(client, "PUT", ingredient_url, json={"id": ingredient_id, "recipe_id": recipe_id,
+            "food_item_id": food_item.id, "food_item_equivalent_id": equivalent.id, "quantity": 2.5})
+        self._request(client, "DELETE", ingredient_url)
+        self._request(client, "DELETE", recipe_url)
+
+        # Food items used by many recipes update the totals of all of them
+        self._request(client, "PUT", "/api/food-items/{0}/".format(food_item.id), json={
+            "id": food_item.id, "name": food_item.name, "emission_per_kg": 12.5})
+        self._request(client, "PUT", "/api/food-items/{0}/equivalents/{1}/".format(food_item.id, equivalent.id),
+            json={"food_item_id": food_item.id, "unit_type": equivalent.unit_type, "conversion_factor": 0.5})
+        resp = self._request(client, "POST", "/api/food-items/", json={
+            "name": "budget-food-item", "emission_per_kg": 2.0})
+        food_item_id = self._location_id(resp)
+        food_item_url = "/api/food-items/{0}/".format(food_item_id)
+        resp = self._request(client, "POST", food_item_url, json={"unit_type": "cup", "conversion_factor": 0.2})
+        self._request(client, "DELETE", "{0}equivalents/{1}/".format(food_item_url, self._location_id(resp)))
+        self._request(client, "DELETE", food_item_url)
+        lines = [json.dumps({"name": "budget-import-{0}".format(i), "emission_per_kg": 1.0}) for i in range(20)]
+        self._request(client, "POST", "/api/food-items/bulk", data="\n".join(lines),
+            content_type="application/x-ndjson")
+
+        assert self.covered == set(metrics.get_resource_methods(client.application))
+
+    def test_exceeded(self, budget_client, monkeypatch, caplog):
+        """
+        Tests that exceeding a budget raises in raise mode and logs in log
+        mode, also for streamed responses.
+        """
+        from climatecook.resources.recipes import RecipeCollection, RecipeItem
+
+        monkeypatch.setattr(RecipeItem.get, "query_budget", 1)
+        monkeypatch.setattr(RecipeCollection.get, "query_budget", 1)
+        with pytest.raises(QueryBudgetExceeded):
+            budget_client.get("/api/recipes/1/")
+        resp = budget_client.get("/api/recipes/")
+        with pytest.raises(QueryBudgetExceeded):
+            resp.data
+            resp.close()
+
+        budget_client.application.config["QUERY_BUDGET_MODE"] = "log"
+        with caplog.at_level(logging.WARNING, logger="climatecook.query_budget"):
+            resp = budget_client.get("/api/recipes/2/")
+        assert resp.status_code == 200
+        message = caplog.records[0].getMessage()
+        assert message.startswith("GET RecipeItem issued 2 SQL statements")
+        assert message.endswith("its budget is 1")
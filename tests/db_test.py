@@ -8,9 +8,12 @@ from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 from climatecook import create_app, db
-from climatecook.models import Recipe
+from climatecook.analytics import HISTOGRAM_BINS, emissions_report, get_version, load_columns
+from climatecook.models import Recipe, get_collection_version, migrate_db_command, startswith_nocase
+from climatecook.models import EquivalentUnitType, recompute_emissions, seed_db_command
 # from climatecook.models import Rating, RecipeCategory
 from climatecook.models import Ingredient, FoodItem, FoodItemEquivalent
+from climatecook.seed import seed_db
 # from climatecook.models import FoodItemCategory
 
 
@@ -677,3 +680,252 @@ def test_fooditemequivalent_create_with_invalid_conversion(app_handle):
 #         db.session.add(fooditemcategory)
 #         with pytest.raises(IntegrityError):
 #             db.session.commit()
+
+
+def _query_plan(query):
+    """
+    Returns the EXPLAIN QUERY PLAN details of an ORM query.
+    """
+    compiled = query.statement.compile(db.engine)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + str(compiled), params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def test_hot_queries_use_indexes(app_handle):
+    """
+    Check that none of the lookups done by the API falls back to a full table
+    scan.
+    """
+    with app_handle.app_context():
+        queries = [
+            Ingredient.query.filter_by(recipe_id=1),
+            Ingredient.query.filter_by(food_item_id=1),
+            Ingredient.query.filter_by(food_item_equivalent_id=1),
+            FoodItemEquivalent.query.filter_by(food_item_id=1),
+            FoodItem.query.filter(startswith_nocase(FoodItem.name, "tomato")).order_by(FoodItem.name),
+            Recipe.query.filter(startswith_nocase(Recipe.name, "soup")).order_by(Recipe.name),
+        ]
+        for query in queries:
+            plan = _query_plan(query)
+            assert plan
+            for detail in plan:
+                assert not detail.startswith("SCAN"), "{0}: {1}".format(query, detail)
+
+        plan = _query_plan(db.session.query(db.func.count(Ingredient.id)).filter_by(food_item_id=1))
+        assert not any(detail.startswith("SCAN") for detail in plan)
+
+
+def test_startswith_nocase(app_handle):
+    """
+    Check that the prefix filter is case-insensitive and treats LIKE wildcards
+    in the prefix literally.
+    """
+    with app_handle.app_context():
+        db.session.add(Recipe(name="Tomato_soup"))
+        db.session.add(Recipe(name="tomatoes"))
+        db.session.add(Recipe(name="potato"))
+        db.session.commit()
+        assert Recipe.query.filter(startswith_nocase(Recipe.name, "TOMATO")).count() == 2
+        assert Recipe.query.filter(startswith_nocase(Recipe.name, "tomato_")).count() == 1
+        assert Recipe.query.filter(startswith_nocase(Recipe.name, "%")).count() == 0
+
+
+def test_migrate_db(app_handle):
+    """
+    Check that migrate-db adds the indexes and the emissions column to a
+    database created without them.
+    """
+    with app_handle.app_context():
+        db.drop_all()
+        db.session.execute("CREATE TABLE recipe (id INTEGER NOT NULL PRIMARY KEY, name VARCHAR(64) NOT NULL)")
+        db.session.execute("INSERT INTO recipe (id, name) VALUES (1, 'donkey-recipe')")
+        db.session.commit()
+
+    result = app_handle.test_cli_runner().invoke(migrate_db_command)
+    assert result.exit_code == 0
+    assert "Added column recipe.emissions_total" in result.output
+    assert "Added column recipe.updated_at" in result.output
+    assert "Created index ix_recipe_name_nocase" in result.output
+    assert "food_item_fts" not in result.output
+
+    with app_handle.app_context():
+        indexes = [i["name"] for i in db.inspect(db.engine).get_indexes("ingredient")]
+        assert "ix_ingredient_recipe_id" in indexes
+        assert Recipe.query.get(1).emissions_total == 0.0
+        assert Recipe.query.get(1).updated_at is not None
+        Recipe.query.get(1).name = "migrated-recipe"
+        db.session.commit()
+        assert get_collection_version("recipe")[0] == 1
+
+    result = app_handle.test_cli_runner().invoke(migrate_db_command)
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def _dump_seeded(app):
+    with app.app_context():
+        return [
+            [tuple(row) for row in db.session.execute(
+                "SELECT * FROM {0} ORDER BY id".format(name)).fetchall()]
+            for name in ("food_item", "food_item_equivalent", "recipe", "ingredient")
+        ]
+
+
+def test_seed_db(app_handle):
+    """
+    Check that seed-db adds consistent synthetic data within the requested
+    bounds, and the same data for the same seed.
+    """
+    args = ["--food-items", "500", "--recipes", "200", "--min-ingredients", "5", "--max-ingredients", "15",
+        "--seed", "7"]
+    result = app_handle.test_cli_runner().invoke(seed_db_command, args)
+    assert result.exit_code == 0, result.output
+    assert "Added 500 food items" in result.output
+
+    with app_handle.app_context():
+        assert FoodItem.query.count() == 500
+        assert Recipe.query.count() == 200
+        counts = [count for (count,) in db.session.execute(
+            "SELECT count(*) FROM ingredient GROUP BY recipe_id").fetchall()]
+        assert len(counts) == 200
+        assert min(counts) >= 5 and max(counts) <= 15
+        units = {unit for (unit,) in db.session.query(FoodItemEquivalent.unit_type).distinct()}
+        assert units == {unit.value for unit in EquivalentUnitType}
+        assert recompute_emissions(update=False) == []
+        assert get_collection_version("recipe")[0] == 200
+        # Ingredient popularity is skewed: the top 5% of the food items make
+        # up a large share of the ingredients
+        uses = sorted((count for (count,) in db.session.execute(
+            "SELECT count(*) FROM ingredient GROUP BY food_item_id").fetchall()), reverse=True)
+        assert sum(uses[:25]) > sum(uses) * 0.3
+
+    other_fd, other_fname = tempfile.mkstemp()
+    try:
+        other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + other_fname, "TESTING": True})
+        with other.app_context():
+            db.create_all()
+        assert other.test_cli_runner().invoke(seed_db_command, args).exit_code == 0
+        first, second = _dump_seeded(app_handle), _dump_seeded(other)
+        # Only the timestamps differ
+        strip = [[row[:-1] for row in rows] for rows in first], [[row[:-1] for row in rows] for rows in second]
+        assert strip[0] == strip[1]
+    finally:
+        os.close(other_fd)
+        os.unlink(other_fname)
+
+    # Seeding again appends after the existing rows
+    result = app_handle.test_cli_runner().invoke(seed_db_command, ["--food-items", "5", "--recipes", "3"])
+    assert result.exit_code == 0, result.output
+    with app_handle.app_context():
+        assert FoodItem.query.count() == 505
+        assert Recipe.query.count() == 203
+        assert recompute_emissions(update=False) == []
+
+
+def test_seed_db_invalid(app_handle):
+    """
+    Check that seed-db rejects inconsistent arguments.
+    """
+    runner = app_handle.test_cli_runner()
+    result = runner.invoke(seed_db_command, ["--min-ingredients", "10", "--max-ingredients", "5"])
+    assert result.exit_code != 0
+    result = runner.invoke(seed_db_command, ["--food-items", "0", "--recipes", "5"])
+    assert result.exit_code != 0
+
+
+def test_emissions_report(app_handle):
+    """
+    Check that the vectorized emissions report matches the same statistics
+    computed row by row, and that writes to every table of the catalog
+    change its version.
+    """
+    with app_handle.app_context():
+        seed_db(food_items=100, recipes=150, min_ingredients=1, max_ingredients=8, seed=3)
+        report = emissions_report(load_columns())
+
+        totals = {}
+        non_vegan = set()
+        food_item_totals = {}
+        for ingredient in Ingredient.query.all():
+            emissions = ingredient.get_emissions()
+            totals[ingredient.recipe_id] = totals.get(ingredient.recipe_id, 0.0) + emissions
+            food_item_totals[ingredient.food_item_id] = food_item_totals.get(ingredient.food_item_id, 0.0) + emissions
+            if not FoodItem.query.get(ingredient.food_item_id).vegan:
+                non_vegan.add(ingredient.recipe_id)
+        total = sum(totals.values())
+        assert report["ingredients"] == Ingredient.query.count()
+        assert report["emissions_total"] == pytest.approx(total)
+
+        recipes = report["recipes"]
+        assert recipes["count"] == len(totals) == 150
+        assert recipes["mean"] == pytest.approx(total / len(totals))
+        assert recipes["max"] == pytest.approx(max(totals.values()))
+        ordered = sorted(totals.values())
+        assert recipes["percentiles"]["p50"] == pytest.approx((ordered[74] + ordered[75]) / 2)
+        assert sum(recipes["histogram"]["counts"]) == 150
+        assert len(recipes["histogram"]["edges"]) == HISTOGRAM_BINS + 1
+        vegan_totals = [value for recipe_id, value in totals.items() if recipe_id not in non_vegan]
+        assert recipes["vegan"]["count"] == len(vegan_totals)
+        assert recipes["vegan"]["mean"] == pytest.approx(sum(vegan_totals) / len(vegan_totals))
+        assert recipes["non_vegan"]["count"] == len(non_vegan)
+
+        shares = report["food_items"]["shares"]
+        assert report["food_items"]["count"] == len(shares) == len(food_item_totals)
+        assert [share["emissions"] for share in shares] == sorted(
+            [pytest.approx(value) for value in food_item_totals.values()], key=lambda value: -value.expected)
+        for share in shares:
+            assert share["share"] == pytest.approx(food_item_totals[share["food_item_id"]] / total)
+
+        for statement in (
+                "UPDATE ingredient SET quantity = quantity WHERE id = 1",
+                "UPDATE food_item_equivalent SET conversion_factor = conversion_factor WHERE id = 1",
+                "UPDATE food_item SET vegan = vegan WHERE id = 1",
+                "UPDATE recipe SET name = name WHERE id = 1"):
+            stamp = get_version()[0]
+            db.session.execute(statement)
+            db.session.commit()
+            assert get_version()[0] != stamp
+
+    with create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True}).app_context():
+        db.create_all()
+        report = emissions_report(load_columns())
+        assert report["emissions_total"] == 0
+        assert report["recipes"]["count"] == 0
+        assert report["recipes"]["mean"] is None
+        assert report["food_items"]["shares"] == []
+
+
+def test_production_profile():
+    """
+    Check that the production profile pools connections and applies the
+    pragmas to them.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "DATABASE_PROFILE": "production",
+        "SQLITE_PRAGMAS": {"busy_timeout": 1234}
+    })
+    try:
+        with app.app_context():
+            assert db.engine.pool.__class__.__name__ == "QueuePool"
+            assert db.session.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert db.session.execute("PRAGMA synchronous").scalar() == 1
+            assert db.session.execute("PRAGMA temp_store").scalar() == 2
+            assert db.session.execute("PRAGMA busy_timeout").scalar() == 1234
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+def test_unknown_profile():
+    """
+    Check that an unknown database profile is rejected.
+    """
+    with pytest.raises(ValueError):
+        create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "DATABASE_PROFILE": "donkey"})